@@ -1,91 +1,331 @@
+import atexit
 import hashlib
 import json
 import os
-import pandas as pd
+import threading
+import time
 import streamlit as st
-try:
-    from streamlit_gsheets import GSheetsConnection
-except ImportError:
-    GSheetsConnection = None
 from config import SECURITY_CONFIG
+from logic import RoiAggregates
+from storage import get_user_store, merge_progress
+
+class ProgressJournal:
+    """Diario write-behind de cambios de progreso.
+
+    Cada cambio se añade a un archivo local (JSON lines) y a un resumen en memoria
+    agrupado por usuario. Un hilo en segundo plano vuelca los cambios en lotes cada
+    cierto intervalo o al superar un número de usuarios pendientes. Tras un fallo del
+    proceso, los cambios del archivo se vuelven a aplicar al arrancar (resume()).
+
+    Antes de aplicar un lote se quita del archivo: si el proceso cae durante el volcado
+    se pierde ese lote, pero nunca se suman dos veces sus sesiones al recuperarlo.
+
+    Mientras se vuelca un lote, sus cambios siguen visibles (pending_for / pending_users)
+    hasta que el callback llama a finish_inflight() tras actualizar la tabla en memoria.
+    """
+
+    def __init__(self, path, apply_batch, settings=None):
+        self.path = path
+        self._apply_batch = apply_batch
+        self._settings = settings if settings is not None else SECURITY_CONFIG
+        self._pending = {}  # usuario -> {"score": última puntuación o None, "sessions": incremento}
+        self._inflight = {}  # lote que se está volcando, con el mismo formato
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._replay()
+
+    @staticmethod
+    def _merge(pending, username, score, sessions):
+        change = pending.setdefault(username, {"score": None, "sessions": 0})
+        if score is not None:
+            change["score"] = score
+        change["sessions"] += sessions
+
+    def _replay(self):
+        """Recupera los cambios no volcados de una ejecución anterior."""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Línea incompleta por un corte durante la escritura
+                    self._merge(self._pending, entry["u"], entry.get("score"), entry.get("sessions", 0))
+        except OSError:
+            return
+
+    def resume(self):
+        """Programa el volcado de los cambios recuperados del archivo, si los hay."""
+        with self._lock:
+            recovered = bool(self._pending)
+        if recovered:
+            self._start()
+            self._wakeup.set()
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="progress-journal", daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def record(self, username, score=None, increment_session=False):
+        """Registra un cambio de progreso; el volcado se hace en segundo plano."""
+        sessions = 1 if increment_session else 0
+        with self._lock:
+            try:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps({"u": username, "score": score, "sessions": sessions}) + "\n")
+            except OSError as e:
+                print(f"No se pudo escribir el diario de progreso: {e}")
+            self._merge(self._pending, username, score, sessions)
+            full = len(self._pending) >= self._settings.get("progress_flush_max_pending", 50)
+        self._start()
+        if full:
+            self._wakeup.set()
+
+    def pending_for(self, username):
+        """Cambios aún no volcados de un usuario: (última puntuación o None, incremento de sesiones)."""
+        with self._lock:
+            score, sessions = None, 0
+            for changes in (self._inflight, self._pending):
+                change = changes.get(username)
+                if change:
+                    score = change["score"] if change["score"] is not None else score
+                    sessions += change["sessions"]
+            return score, sessions
+
+    def pending_users(self):
+        """Usuarios con cambios aún no volcados."""
+        with self._lock:
+            return list(self._inflight.keys() | self._pending.keys())
+
+    def finish_inflight(self):
+        """El lote en curso ya está en la tabla en memoria: deja de superponerse."""
+        with self._lock:
+            self._inflight = {}
+
+    def _compact(self):
+        """Reescribe el archivo con los cambios pendientes (llamar con el cerrojo tomado)."""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for username, change in self._pending.items():
+                f.write(json.dumps({"u": username, "score": change["score"], "sessions": change["sessions"]}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def flush(self):
+        """Vuelca los cambios pendientes como un único lote agrupado por usuario."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return True
+                batch, self._pending = self._pending, {}
+                try:
+                    # El archivo deja de contener el lote antes de aplicarlo (ver docstring)
+                    self._compact()
+                except OSError as e:
+                    print(f"No se pudo compactar el diario de progreso (se reintentará): {e}")
+                    self._pending = batch
+                    return False
+                self._inflight = batch
+            try:
+                self._apply_batch(batch)
+            except Exception as e:
+                print(f"Error volcando el progreso de usuarios (se reintentará): {e}")
+                with self._lock:
+                    # Los cambios llegados durante el volcado son más recientes
+                    for username, change in self._pending.items():
+                        self._merge(batch, username, change["score"], change["sessions"])
+                    self._pending = batch
+                    self._inflight = {}
+                    try:
+                        self._compact()
+                    except OSError as e:
+                        print(f"No se pudo reescribir el diario de progreso: {e}")
+                return False
+            with self._lock:
+                self._inflight = {}
+            return True
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self._settings.get("progress_flush_interval_seconds", 5))
+            self._wakeup.clear()
+            self.flush()
+
+
+def hash_password(password):
+    """Genera un hash SHA-256 de la contraseña."""
+    return hashlib.sha256(password.encode()).hexdigest()
+
+
+# Credenciales base del cliente por defecto (usuario -> contraseña)
+DEFAULT_CREDENTIALS = {
+    "admin": "admin123",
+    "empleado": "olivia2024"
+}
+
 
 class AuthManager:
-    def __init__(self):
-        self._initialize_db()
+    """Gestión de usuarios y progreso.
+
+    La inicialización (almacenamiento, diario de progreso y usuarios por defecto) se
+    hace de forma perezosa en el primer uso, para que la página de login se muestre
+    sin acceder a la red. Cada cliente (tenant) tiene su propio AuthManager con su
+    almacenamiento, su diario y su configuración de seguridad (`security`, por defecto
+    SECURITY_CONFIG). `default_users` (usuario -> {"password_hash", "role"}) son las cuentas
+    que se crean al arrancar o cuya contraseña se actualiza si ha cambiado.
+    """
+
+    def __init__(self, store_factory=get_user_store, journal_file=None, security=None, default_users=None):
+        self._store_factory = store_factory
+        self._default_users = default_users or {}
+        self._security = security if security is not None else SECURITY_CONFIG
+        self._journal_file = journal_file
+        # Tabla de usuarios en memoria compartida por todas las sesiones (usuario -> fila)
+        self._users = None
+        self._users_loaded_at = 0.0
+        self._users_lock = threading.Lock()
+        # Aplicar un lote y recargar la tabla se excluyen: una recarga a mitad de volcado ya
+        # traería el lote y fusionarlo después contaría dos veces sus sesiones
+        self._store_lock = threading.Lock()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+        self.store = None
+        self.journal = None
+        # Agregados de ROI mantenidos de forma incremental para el dashboard de admin
+        self.roi = RoiAggregates()
 
-    def _hash_password(self, password):
-        """Genera un hash SHA-256 de la contraseña."""
-        return hashlib.sha256(password.encode()).hexdigest()
+    def _ensure_initialized(self):
+        """Inicializa el almacenamiento una sola vez (seguro entre hilos e idempotente)."""
+        if self._initialized:
+            return
+        with self._init_lock:
+            if self._initialized:
+                return
+            self.store = self._store_factory()
+            journal_file = self._journal_file or self._security["progress_journal_file"]
+            os.makedirs(os.path.dirname(journal_file) or ".", exist_ok=True)
+            self.journal = ProgressJournal(journal_file, self._flush_progress_batch, self._security)
+            self._initialize_db()
+            self._initialized = True
+            self.journal.resume()
 
     def _initialize_db(self):
         """Crea la hoja con usuarios por defecto o actualiza credenciales."""
-        # Definir credenciales base
-        default_creds = {
-            "admin": "admin123",
-            "empleado": "olivia2024"
-        }
-        
-        data = self._load_db()
-            
-        updated = False
+        if not self._default_users:
+            return
+        data = self._get_users()
+        changes = {}
         # Verificar/Crear usuarios por defecto
-        for user, pwd in default_creds.items():
-            pwd_hash = self._hash_password(pwd)
+        for user, account in self._default_users.items():
+            pwd_hash = account["password_hash"]
             if user not in data:
-                data[user] = {
+                changes[user] = {
                     "password_hash": pwd_hash,
                     "score": 0,
                     "active_sessions": 0,
-                    "role": "admin" if user == "admin" else "user"
+                    "role": account["role"]
                 }
-                updated = True
             elif data[user].get("password_hash") != pwd_hash:
                 # Actualizar contraseña si ha cambiado en código
-                data[user]["password_hash"] = pwd_hash
-                updated = True
+                changes[user] = dict(data[user], password_hash=pwd_hash)
                 
-        if updated:
-            self._save_db(data)
+        if changes and self.store.available:
+            # Solo se escriben las filas de los usuarios por defecto: el diario puede estar
+            # volcando progreso en paralelo y reescribir la tabla completa lo pisaría
+            try:
+                self.store.ensure_users(changes)
+            except Exception as e:
+                st.error(f"Error guardando usuarios: {e}")
+                return
+            self.invalidate_users()
 
-    def _load_db(self):
-        """Carga la base de datos de usuarios desde Google Sheets."""
-        if GSheetsConnection is None:
-            return {}
-        try:
-            conn = st.connection("gsheets", type=GSheetsConnection)
-            df = conn.read(worksheet="Users", ttl=0)
-            if df.empty:
-                return {}
-            df = df.dropna(how="all")
-            if "username" not in df.columns:
-                return {}
-            return df.set_index("username").to_dict(orient="index")
-        except Exception:
-            return {}
-
-    def _save_db(self, data):
-        """Guarda la base de datos de usuarios en Google Sheets."""
-        if GSheetsConnection is None:
+    def _get_users(self):
+        """Devuelve la tabla de usuarios en memoria, refrescándola de Sheets si ha caducado su TTL."""
+        ttl = self._security.get("users_cache_ttl_seconds", 30)
+        with self._users_lock:
+            if self._users is not None and time.time() - self._users_loaded_at <= ttl:
+                return self._users
+        with self._store_lock, self._users_lock:
+            if self._users is None or time.time() - self._users_loaded_at > ttl:
+                if not self.store.available:
+                    self._users = {}
+                else:
+                    try:
+                        self._users = self.store.load_users()
+                    except Exception as e:
+                        # Se mantiene la última copia conocida y se reintenta en la siguiente consulta
+                        print(f"Error leyendo usuarios: {e}")
+                        return self._users or {}
+                self._users_loaded_at = time.time()
+                self._rebuild_roi()
+            return self._users
+
+    def _set_users(self, data):
+        """Sustituye la tabla en memoria tras una escritura propia de la app."""
+        with self._users_lock:
+            self._users = data
+            self._users_loaded_at = time.time()
+            self._rebuild_roi()
+
+    def _rebuild_roi(self):
+        """Recalcula los agregados de ROI desde la tabla, incluyendo cambios aún no volcados."""
+        users = {}
+        for username, user in self._users.items():
+            score, sessions = self.journal.pending_for(username) if self.journal else (None, 0)
+            users[username] = {
+                "score": score if score is not None else user.get("score", 0),
+                "active_sessions": user.get("active_sessions", 0) + sessions,
+            }
+        if self.journal:
+            # Usuarios nuevos que solo existen en el diario
+            for username in self.journal.pending_users():
+                if username not in users:
+                    score, sessions = self.journal.pending_for(username)
+                    users[username] = {"score": score or 0, "active_sessions": sessions}
+        self.roi.rebuild(users)
+
+    def invalidate_users(self):
+        """Fuerza la recarga de la tabla de usuarios en la siguiente consulta."""
+        with self._users_lock:
+            self._users = None
+
+    def loaded_users(self):
+        """Usuarios en memoria ahora mismo (0 si la tabla no está cargada)."""
+        users = self._users
+        return len(users) if users else 0
+
+    def _apply_progress_batch(self, batch, from_journal=False):
+        """Aplica un lote de cambios de progreso agrupados por usuario y actualiza la tabla en memoria."""
+        if not self.store.available:
             return
-        try:
-            df = pd.DataFrame.from_dict(data, orient="index")
-            df.index.name = "username"
-            df.reset_index(inplace=True)
-            conn = st.connection("gsheets", type=GSheetsConnection)
-            conn.update(worksheet="Users", data=df)
-        except Exception as e:
-            st.error(f"Error guardando en Google Sheets: {e}")
+        with self._store_lock:
+            self.store.apply_progress(batch)
+            with self._users_lock:
+                if self._users is not None:
+                    users = {username: dict(user) for username, user in self._users.items()}
+                    self._users = merge_progress(users, batch)
+                if from_journal:
+                    # En la misma sección crítica: ningún lector ve el lote dos veces ni ninguna
+                    self.journal.finish_inflight()
+
+    def _flush_progress_batch(self, batch):
+        self._apply_progress_batch(batch, from_journal=True)
 
     def authenticate(self, username, password):
         """Verifica las credenciales del usuario."""
-        data = self._load_db()
-        user = data.get(username)
+        self._ensure_initialized()
+        user = self._get_users().get(username)
         
         if not user:
             return False
             
         # Verificar hash
-        input_hash = self._hash_password(password)
+        input_hash = hash_password(password)
         stored_hash = user.get("password_hash")
         
         # Compatibilidad: Si no hay hash (formato antiguo), actualizamos
@@ -96,29 +336,43 @@ class AuthManager:
         return input_hash == stored_hash
 
     def get_user_progress(self, username):
-        """Obtiene el progreso actual del usuario."""
-        data = self._load_db()
-        user = data.get(username, {})
+        """Obtiene el progreso actual del usuario (incluye los cambios aún no volcados)."""
+        self._ensure_initialized()
+        users = self._get_users()
+        # Tabla y diario se leen juntos para no contar dos veces un lote que se está volcando
+        with self._users_lock:
+            user = (self._users if self._users is not None else users).get(username, {})
+            score, sessions = self.journal.pending_for(username)
         return {
-            "score": user.get("score", 0),
-            "active_sessions": user.get("active_sessions", 0)
+            "score": score if score is not None else user.get("score", 0),
+            "active_sessions": user.get("active_sessions", 0) + sessions
         }
 
     def update_user_progress(self, username, score=None, increment_session=False):
-        """Actualiza la puntuación y sesiones del usuario."""
-        data = self._load_db()
-        
-        if username not in data:
-            # Si el usuario no existe, lo creamos
-            data[username] = {"score": 0, "active_sessions": 0}
-            
-        if score is not None:
-            data[username]["score"] = score
-            
-        if increment_session:
-            data[username]["active_sessions"] = data[username].get("active_sessions", 0) + 1
-            
-        self._save_db(data)
+        """Actualiza la puntuación y sesiones del usuario.
+
+        El cambio se registra en el diario write-behind y se vuelca en segundo plano.
+        """
+        self._ensure_initialized()
+        current = self.get_user_progress(username)
+        if not self._security.get("progress_write_behind", True):
+            self._apply_progress_batch({username: {"score": score, "sessions": 1 if increment_session else 0}})
+        else:
+            self.journal.record(username, score=score, increment_session=increment_session)
+        # Mantener los agregados de ROI al día sin recalcular toda la tabla
+        self.roi.update(
+            username,
+            current["active_sessions"] + (1 if increment_session else 0),
+            score if score is not None else current["score"]
+        )
+
+    def flush_progress(self):
+        """Vuelca ya el diario de progreso al almacén. Devuelve False si el volcado falla."""
+        self._ensure_initialized()
+        return self.journal.flush() if self.journal else True
 
-# Instancia global para usar en la app
-auth_manager = AuthManager()
\ No newline at end of file
+    def get_roi_metrics(self, time_saved_per_interaction, cost_per_hour, participation_threshold=10):
+        """Métricas de ROI a partir de los agregados incrementales (None si no hay usuarios)."""
+        self._ensure_initialized()
+        self._get_users()  # Refresca la tabla (y los agregados) si ha caducado el TTL
+        return self.roi.metrics(time_saved_per_interaction, cost_per_hour, participation_threshold)
@@ -0,0 +1,99 @@
+"""Micro-benchmark: cliente de Gemini compartido frente a un cliente nuevo por petición.
+
+Levanta un servidor HTTP local que imita el endpoint generateContent y cuenta
+cuántas conexiones TCP recibe. Con el cliente compartido las peticiones
+reutilizan la misma conexión keep-alive.
+
+Uso:
+    python benchmarks/bench_gemini_client.py --requests 50
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logic
+from config import CLIENT_CONFIG, PERFORMANCE_CONFIG
+
+RESPONSE_BODY = json.dumps({
+    "candidates": [{"content": {"role": "model", "parts": [{"text": "ok"}]}, "finishReason": "STOP"}],
+    "usageMetadata": {"promptTokenCount": 10, "candidatesTokenCount": 1, "totalTokenCount": 11},
+}).encode("utf-8")
+
+
+class StubGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Necesario para keep-alive
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(RESPONSE_BODY)))
+        self.end_headers()
+        self.wfile.write(RESPONSE_BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+class CountingServer(ThreadingHTTPServer):
+    daemon_threads = True
+    connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+
+def run(label, get_client, n_requests, server):
+    model_name = CLIENT_CONFIG.get("ai_model", "gemini-2.0-flash")
+    server.connections = 0
+    start = time.perf_counter()
+    for _ in range(n_requests):
+        # Se guarda la referencia: si el cliente se libera durante la llamada, cierra su pool de conexiones
+        client = get_client()
+        client.models.generate_content(model=model_name, contents="ping")
+    elapsed = time.perf_counter() - start
+    result = {
+        "mode": label,
+        "requests": n_requests,
+        "connections": server.connections,
+        "total_s": round(elapsed, 4),
+        "per_request_ms": round(elapsed / n_requests * 1000, 3),
+    }
+    print(json.dumps(result))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+
+    if not logic._import_genai():
+        print("❌ La librería 'google-genai' no está instalada.")
+        sys.exit(1)
+
+    server = CountingServer(("127.0.0.1", 0), StubGeminiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    PERFORMANCE_CONFIG["gemini_base_url"] = base_url
+    api_key = "bench-key"
+
+    def fresh_client():
+        return logic.genai.Client(api_key=api_key, http_options=logic.types.HttpOptions(base_url=base_url))
+
+    try:
+        run("cliente_nuevo_por_peticion", fresh_client, args.requests, server)
+        run("cliente_compartido", lambda: logic.get_gemini_client(api_key), args.requests, server)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Benchmark del cálculo de ROI: versión vectorizada frente al bucle original por usuario.
+
+Genera tablas sintéticas de usuarios de varios tamaños, comprueba que ambas
+implementaciones dan el mismo resultado y mide su tiempo.
+
+Uso:
+    python benchmarks/bench_roi.py --sizes 1000 10000 100000 1000000
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+
+from logic import BELTS, compute_roi_metrics
+
+
+def reference_roi_metrics(data, time_saved_per_interaction, cost_per_hour, participation_threshold=10):
+    """Implementación original (diccionario de usuarios y bucles en Python), como referencia."""
+    users = [u for k, u in data.items() if k != 'admin']
+    N = len(users)
+    if N == 0:
+        return {"N": 0, "P": 0, "F": 0, "AH_op": 0, "Me": 1.0, "Total_Value": 0.0, "active_count": 0}
+    active_users = [u for u in users if u.get("active_sessions", 0) >= participation_threshold]
+    n_active = len(active_users)
+    P = n_active / N
+    avg_freq = sum(u.get("active_sessions", 0) for u in active_users) / n_active if n_active > 0 else 0
+    AH_op = (N * P) * (avg_freq * time_saved_per_interaction)
+    max_level_idx = max(len(BELTS) - 1, 1)
+    sum_me = 0
+    if n_active > 0:
+        for u in active_users:
+            score = u.get("score", 0)
+            idx = 0
+            for i, belt in enumerate(BELTS):
+                if score >= belt["threshold"]:
+                    idx = i
+                else:
+                    break
+            sum_me += 1 + (idx / max_level_idx)
+        Me = sum_me / n_active
+    else:
+        Me = 1.0
+    total_value = (AH_op * Me) * cost_per_hour
+    return {"N": N, "P": P, "F": avg_freq, "AH_op": AH_op, "Me": Me, "Total_Value": total_value, "active_count": n_active}
+
+
+def synthetic_users(n_users, seed=42):
+    """Tabla de usuarios sintética con sesiones y puntuaciones de cola larga."""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "username": [f"user{i}" for i in range(n_users)] + ["admin"],
+        "score": np.append(rng.integers(0, 1500, n_users), 0),
+        "active_sessions": np.append(rng.geometric(0.08, n_users), 0),
+    })
+    return df.set_index("username")
+
+
+def timed(fn, repeat):
+    best = math.inf
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    ts, ch, threshold = 0.25, 50.0, 10
+    for size in args.sizes:
+        df = synthetic_users(size)
+        data = df.to_dict(orient="index")
+        vectorized, t_vec = timed(lambda: compute_roi_metrics(df, ts, ch, threshold), args.repeat)
+        reference, t_ref = timed(lambda: reference_roi_metrics(data, ts, ch, threshold), args.repeat)
+        same = all(math.isclose(vectorized[k], reference[k], rel_tol=1e-12) for k in reference)
+        print(json.dumps({
+            "users": size,
+            "vectorized_ms": round(t_vec * 1000, 3),
+            "reference_ms": round(t_ref * 1000, 3),
+            "speedup": round(t_ref / t_vec, 1) if t_vec else None,
+            "identical": same,
+        }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Benchmark de arranque: tiempo de importación y tiempo hasta el primer render.
+
+1. Importa los módulos de la app en un proceso nuevo con `python -X importtime`
+   y muestra el tiempo total y los módulos más lentos.
+2. Ejecuta streamlit_app.py con streamlit.testing (AppTest) en un proceso nuevo
+   y mide cuánto tarda en mostrarse la pantalla de login.
+
+Uso:
+    python benchmarks/bench_startup.py --top 15
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_MODULES = "config, retrieval, knowledge, kb_watcher, storage, telemetry, scheduler, logic, auth, tenants, quiz_bank, response_cache"
+
+FIRST_RENDER_SCRIPT = """
+import json, time
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file("streamlit_app.py", default_timeout=120)
+at.run()
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    "first_render_s": round(elapsed, 4),
+    "title": at.title[0].value if at.title else None,
+    "exceptions": [str(e.value) for e in at.exception],
+}))
+"""
+
+
+def parse_importtime(stderr):
+    """Convierte la salida de -X importtime en lista de (módulo, self_us, acumulado_us)."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            rows.append((name.rstrip(), int(self_us), int(cumulative_us)))
+        except ValueError:
+            continue
+    return rows
+
+
+def measure_imports(top):
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {APP_MODULES}"],
+        cwd=REPO_DIR, capture_output=True, text=True,
+    )
+    wall = time.perf_counter() - start
+    rows = parse_importtime(proc.stderr)
+    # Los módulos de primer nivel no llevan sangría en el nombre
+    top_level = [r for r in rows if not r[0].startswith("  ")]
+    slowest = sorted(rows, key=lambda r: r[2], reverse=True)[:top]
+    return {
+        "ok": proc.returncode == 0,
+        "error": proc.stderr.strip().splitlines()[-1] if proc.returncode else None,
+        "wall_s": round(wall, 4),
+        "imports_cumulative_ms": round(sum(r[2] for r in top_level) / 1000, 2),
+        "slowest": [{"module": name.strip(), "cumulative_ms": round(cum / 1000, 2)} for name, _, cum in slowest],
+    }
+
+
+def measure_first_render():
+    proc = subprocess.run(
+        [sys.executable, "-c", FIRST_RENDER_SCRIPT],
+        cwd=REPO_DIR, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        return {"ok": False, "error": proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else None}
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["ok"] = True
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--top", type=int, default=15, help="Módulos más lentos a mostrar")
+    args = parser.parse_args()
+
+    print(json.dumps({"imports": measure_imports(args.top), "first_render": measure_first_render()}, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
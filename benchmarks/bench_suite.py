@@ -0,0 +1,277 @@
+"""Suite de micro-benchmarks de la app con Gemini y Google Sheets simulados.
+
+Mide, sobre corpus y tablas de usuarios sintéticos de varios tamaños:
+
+- knowledge.*: lectura en streaming (load_knowledge_base), construcción de la base
+  que usa la app (build_knowledge_base), recarga incremental tras cambiar un archivo
+  y construcción/búsqueda del índice BM25. El corpus sintético es de texto: la caché
+  de extracción (solo PDF) no interviene.
+- prompt.*: construcción de la petición de chat (con y sin presupuesto de historial).
+- llm.*: generate_quiz_questions y stream_chat_response contra FakeGenaiClient
+  (mide la sobrecarga de la app más la latencia simulada).
+- quiz.evaluate: evaluate_quiz.
+- roi.calculate: calculate_roi_metrics leyendo de FakeGSheetsConnection.
+- auth.*: primer login (inicialización + lectura de usuarios), login en caliente,
+  registro de progreso y métricas de ROI incrementales.
+
+Los resultados se escriben como JSON (--output) y pueden compararse con una ejecución
+anterior (--baseline); el proceso termina con código 1 si algún caso empeora más de
+--max-regression veces.
+
+Uso:
+    python benchmarks/bench_suite.py --sizes small medium --output bench.json
+    python benchmarks/bench_suite.py --baseline bench.json --max-regression 1.25
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from config import PERFORMANCE_CONFIG, SECURITY_CONFIG
+
+# Ajustes previos a importar la app: sin log de telemetría ni caché de contexto
+PERFORMANCE_CONFIG["telemetry_log_file"] = None
+PERFORMANCE_CONFIG["context_caching"] = False
+
+import auth
+import logic
+import storage
+from knowledge import build_knowledge_base, folder_snapshot, load_knowledge_base, read_documents, update_knowledge_base
+from retrieval import BM25Index, chunk_documents, select_chunks
+
+from fakes import FakeGenaiClient, FakeSheetsUserStore, synthetic_corpus, synthetic_quiz, synthetic_text, synthetic_users
+
+SIZES = {
+    "small": {"files": 10, "chars_per_file": 20_000, "users": 1_000, "history": 10, "questions": 5},
+    "medium": {"files": 50, "chars_per_file": 50_000, "users": 10_000, "history": 40, "questions": 50},
+    "large": {"files": 200, "chars_per_file": 100_000, "users": 100_000, "history": 200, "questions": 500},
+}
+
+SYSTEM_INSTRUCTION = "Eres un coach de formación. Responde de forma breve y práctica."
+
+
+def measure(name, size, fn, repeat, setup=None, **params):
+    """Ejecuta fn `repeat` veces (setup sin cronometrar antes de cada una) y resume los tiempos."""
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    result = {
+        "name": name,
+        "size": size,
+        "params": params,
+        "runs": repeat,
+        "best_ms": round(min(times) * 1000, 3),
+        "median_ms": round(statistics.median(times) * 1000, 3),
+        "mean_ms": round(statistics.fmean(times) * 1000, 3),
+    }
+    print(json.dumps(result, ensure_ascii=False), file=sys.stderr)
+    return result
+
+
+def synthetic_history(n_messages, chars=400):
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": synthetic_text(chars, seed=i)}
+        for i in range(n_messages)
+    ]
+
+
+def bench_knowledge(size, spec, workdir, repeat):
+    folder = os.path.join(workdir, "kb")
+    total_bytes = synthetic_corpus(folder, spec["files"], spec["chars_per_file"])
+    PERFORMANCE_CONFIG["extraction_cache_folder"] = os.path.join(workdir, "kb_cache")
+    params = {"files": spec["files"], "bytes": total_bytes}
+
+    results = [
+        measure("knowledge.load", size, lambda: load_knowledge_base(folder, workers=1), repeat, **params),
+        measure("knowledge.build", size, lambda: build_knowledge_base(folder), repeat, **params),
+    ]
+
+    # Recarga en caliente: se modifica un único archivo y se actualiza la base existente
+    kb = build_knowledge_base(folder)
+    changed = os.path.join(folder, sorted(os.listdir(folder))[0])
+    with open(changed, "a", encoding="utf-8") as f:
+        f.write("\n" + synthetic_text(2000, seed=999))
+    snapshot = folder_snapshot(folder)
+    results.append(measure("knowledge.update_one_file", size, lambda: update_knowledge_base(kb, snapshot, warn=print),
+                           repeat, **params))
+
+    documents = read_documents(folder, workers=1)
+    chunks = chunk_documents(documents, PERFORMANCE_CONFIG["chunk_chars"], PERFORMANCE_CONFIG["chunk_overlap_chars"])
+    results.append(measure("knowledge.index_build", size, lambda: BM25Index(chunks), repeat, chunks=len(chunks), **params))
+    index = BM25Index(chunks)
+    query = "¿Cómo gestiono una reclamación de garantía con un cliente en tienda?"
+    results.append(measure(
+        "knowledge.search", size,
+        lambda: select_chunks(index, query, PERFORMANCE_CONFIG["retrieval_top_k"], PERFORMANCE_CONFIG["retrieval_token_budget"]),
+        repeat, chunks=len(chunks),
+    ))
+    return results, load_knowledge_base(folder, workers=1)
+
+
+def bench_prompts(size, spec, kb_text, repeat):
+    client = FakeGenaiClient()
+    history = synthetic_history(spec["history"])
+    knowledge_context = kb_text[:PERFORMANCE_CONFIG["retrieval_token_budget"] * 4]
+    params = {"history": len(history), "context_chars": len(knowledge_context)}
+    state = {}
+
+    def fresh_summary():
+        state["summary"] = {"text": "", "covered": 0}
+
+    return [
+        measure("prompt.chat_request", size,
+                lambda: logic._build_chat_request(client, history, SYSTEM_INSTRUCTION, knowledge_context),
+                repeat, **params),
+        measure("prompt.chat_request_budgeted", size,
+                lambda: logic._build_chat_request(client, history, SYSTEM_INSTRUCTION, knowledge_context, state["summary"]),
+                repeat, setup=fresh_summary, **params),
+    ]
+
+
+def bench_llm(size, spec, kb_text, repeat, latency_s, output_tokens):
+    client = FakeGenaiClient(latency_s=latency_s, ttft_s=latency_s / 4, output_tokens=output_tokens)
+    knowledge_context = kb_text[:PERFORMANCE_CONFIG["retrieval_token_budget"] * 4]
+    history = synthetic_history(min(spec["history"], 10))
+    params = {"latency_s": latency_s, "output_tokens": output_tokens}
+
+    original = logic.init_gemini
+    logic.init_gemini = lambda: client
+    try:
+        return [
+            measure("llm.quiz", size,
+                    lambda: logic.generate_quiz_questions("Atención al cliente", "Medio", "Principiante", knowledge_context),
+                    repeat, **params),
+            measure("llm.chat_stream", size,
+                    lambda: "".join(logic.stream_chat_response(history, history[-1]["content"], SYSTEM_INSTRUCTION, knowledge_context)),
+                    repeat, **params),
+        ]
+    finally:
+        logic.init_gemini = original
+
+
+def bench_quiz(size, spec, repeat):
+    questions, answers = synthetic_quiz(spec["questions"])
+    return [measure("quiz.evaluate", size, lambda: logic.evaluate_quiz(questions, answers), repeat, questions=len(questions))]
+
+
+def bench_users(size, spec, workdir, repeat, sheets_delay_s):
+    users = synthetic_users(spec["users"])
+    store = FakeSheetsUserStore(users, delay_s=sheets_delay_s)
+    storage._user_store = store
+    SECURITY_CONFIG["progress_journal_file"] = os.path.join(workdir, "progress_journal.jsonl")
+    params = {"users": len(users), "sheets_delay_s": sheets_delay_s}
+    results = [
+        measure("roi.calculate", size, lambda: logic.calculate_roi_metrics(0.25, 50.0, 10), repeat, **params),
+    ]
+
+    state = {}
+
+    def fresh_manager():
+        state["manager"] = auth.AuthManager()
+
+    results.append(measure("auth.login_cold", size,
+                           lambda: state["manager"].authenticate("empleado", "olivia2024"),
+                           repeat, setup=fresh_manager, **params))
+
+    manager = state["manager"]
+    results.append(measure("auth.login_warm", size, lambda: manager.authenticate("empleado", "olivia2024"), repeat, **params))
+
+    usernames = [f"user{i}" for i in range(min(spec["users"], 100))]
+
+    def record_progress():
+        for username in usernames:
+            manager.update_user_progress(username, score=100, increment_session=True)
+
+    results.append(measure("auth.update_progress_x100", size, record_progress, repeat, **params))
+    results.append(measure("auth.roi_metrics", size, lambda: manager.get_roi_metrics(0.25, 50.0, 10), repeat, **params))
+    manager.journal.flush()
+    return results
+
+
+def git_commit():
+    try:
+        proc = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True)
+        return proc.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline_path, max_regression):
+    """Compara las medianas con una ejecución anterior; devuelve los casos que empeoran."""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {(r["name"], r["size"]): r for r in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        previous = baseline.get((result["name"], result["size"]))
+        if not previous or not previous["median_ms"]:
+            continue
+        ratio = result["median_ms"] / previous["median_ms"]
+        result["baseline_median_ms"] = previous["median_ms"]
+        result["ratio"] = round(ratio, 3)
+        if ratio > max_regression:
+            regressions.append(result)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=["small", "medium"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Latencia simulada de Gemini por llamada (s)")
+    parser.add_argument("--llm-output-tokens", type=int, default=300, help="Tokens de salida simulados por respuesta")
+    parser.add_argument("--sheets-delay", type=float, default=0.0, help="Retardo simulado de cada lectura/escritura en Sheets (s)")
+    parser.add_argument("--output", help="Archivo JSON donde guardar los resultados")
+    parser.add_argument("--baseline", help="Resultados JSON de una ejecución anterior para comparar")
+    parser.add_argument("--max-regression", type=float, default=1.25, help="Ratio de mediana a partir del cual se considera regresión")
+    args = parser.parse_args()
+
+    logic._import_genai()
+    results = []
+    workdir = tempfile.mkdtemp(prefix="bench-suite-")
+    try:
+        for size in args.sizes:
+            spec = SIZES[size]
+            size_dir = os.path.join(workdir, size)
+            knowledge_results, kb_text = bench_knowledge(size, spec, size_dir, args.repeat)
+            results += knowledge_results
+            results += bench_prompts(size, spec, kb_text, args.repeat)
+            results += bench_llm(size, spec, kb_text, args.repeat, args.llm_latency, args.llm_output_tokens)
+            results += bench_quiz(size, spec, args.repeat)
+            results += bench_users(size, spec, size_dir, args.repeat, args.sheets_delay)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    regressions = compare(results, args.baseline, args.max_regression) if args.baseline else []
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+        },
+        "results": results,
+        "regressions": [f"{r['name']} [{r['size']}] x{r['ratio']}" for r in regressions],
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,428 @@
+"""Comprobaciones deterministas de las piezas concurrentes e incrementales.
+
+Cubre SingleFlight, LLMScheduler, RoiAggregates, BM25Index.updated, ProgressJournal y
+las recargas de AuthManager durante un volcado, sin red ni credenciales. La coordinación
+entre hilos usa eventos y la profundidad de las colas en lugar de esperas fijas, de modo
+que el resultado no depende de la máquina.
+Termina con código 1 si alguna comprobación falla.
+
+Uso:
+    python benchmarks/check_concurrency.py
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import PERFORMANCE_CONFIG, SECURITY_CONFIG
+from auth import AuthManager, ProgressJournal
+from logic import RoiAggregates, SingleFlight, _roi_from_aggregates, belt_index
+from retrieval import BM25Index, Chunk
+from storage import merge_progress
+from scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, LLMScheduler
+
+from fakes import WORDS
+
+WAIT_S = 5  # Límite de seguridad para no colgar la comprobación si algo falla
+
+
+@contextmanager
+def overridden(config, **values):
+    """Cambia claves de un diccionario de configuración durante el bloque."""
+    previous = {key: config.get(key) for key in values}
+    config.update(values)
+    try:
+        yield
+    finally:
+        config.update(previous)
+
+
+def wait_until(condition, what):
+    deadline = time.monotonic() + WAIT_S
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError(f"Tiempo agotado esperando: {what}")
+        time.sleep(0.001)
+
+
+def start(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+# --- SingleFlight ---
+
+def check_single_flight():
+    flight = SingleFlight()
+    release = threading.Event()
+    runs, results = [], []
+    n = 8
+
+    def leader_fn():
+        runs.append(1)
+        release.wait(WAIT_S)
+        return {"ok": True}
+
+    threads = [start(lambda: results.append(flight.do("k", leader_fn, WAIT_S))) for _ in range(n)]
+    wait_until(lambda: flight.stats["coalesced"] == n - 1, "llamadas agrupadas")
+    release.set()
+    for thread in threads:
+        thread.join(WAIT_S)
+    assert len(runs) == 1, f"la función se ejecutó {len(runs)} veces"
+    assert results == [{"ok": True}] * n, results
+    assert not flight._flights, "quedan vuelos abiertos"
+
+    # Un fallo llega a todas las llamadas agrupadas
+    release.clear()
+    errors = []
+
+    def failing_fn():
+        release.wait(WAIT_S)
+        raise ValueError("fallo")
+
+    def call():
+        try:
+            flight.do("e", failing_fn, WAIT_S)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [start(call) for _ in range(4)]
+    wait_until(lambda: flight.stats["coalesced"] == n - 1 + 3, "llamadas agrupadas con error")
+    release.set()
+    for thread in threads:
+        thread.join(WAIT_S)
+    assert len(errors) == 4 and len({id(e) for e in errors}) == 1, errors
+
+    # Quien espera más del timeout recibe TimeoutError y la llamada original sigue
+    release.clear()
+    leader = start(lambda: results.append(flight.do("t", leader_fn, WAIT_S)))
+    wait_until(lambda: "t" in flight._flights, "llamada en curso")
+    try:
+        flight.do("t", leader_fn, timeout=0.01)
+        raise AssertionError("se esperaba TimeoutError")
+    except TimeoutError:
+        pass
+    release.set()
+    leader.join(WAIT_S)
+    assert flight.stats["timeouts"] == 1 and results[-1] == {"ok": True}
+
+
+# --- LLMScheduler ---
+
+class _Unavailable(Exception):
+    code = 503
+
+
+class _BadRequest(Exception):
+    code = 400
+
+
+def check_scheduler():
+    with overridden(PERFORMANCE_CONFIG, llm_max_concurrency=1, llm_requests_per_minute=10 ** 6,
+                    llm_tokens_per_minute=10 ** 9, llm_backoff_base_seconds=0, llm_backoff_max_seconds=0,
+                    llm_max_retries=2):
+        scheduler = LLMScheduler()
+        release = threading.Event()
+        blocker = start(scheduler.run, lambda: release.wait(WAIT_S))
+        wait_until(lambda: scheduler._active == 1, "llamada en curso")
+
+        # Con el único hueco ocupado, se encolan en orden: fondo, fondo, interactiva, interactiva
+        order = []
+        queued = [("bg1", PRIORITY_BACKGROUND), ("bg2", PRIORITY_BACKGROUND),
+                  ("int1", PRIORITY_INTERACTIVE), ("int2", PRIORITY_INTERACTIVE)]
+        threads = []
+        for depth, (name, priority) in enumerate(queued, start=1):
+            threads.append(start(scheduler.run, lambda name=name: order.append(name), priority))
+            wait_until(lambda depth=depth: len(scheduler._queue) == depth, f"{name} en cola")
+        release.set()
+        for thread in [blocker] + threads:
+            thread.join(WAIT_S)
+        assert order == ["int1", "int2", "bg1", "bg2"], order
+        assert scheduler._active == 0 and not scheduler._queue
+
+        # Errores transitorios: se reintenta hasta el máximo y se avisa en cada reintento
+        attempts, retried = [], []
+
+        def flaky():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise _Unavailable("503")
+            return "ok"
+
+        assert scheduler.run(flaky, on_retry=retried.append) == "ok"
+        assert len(attempts) == 3 and len(retried) == 2 and scheduler.stats["retries"] == 2
+
+        # Errores definitivos: sin reintentos y el hueco queda libre
+        attempts.clear()
+
+        def bad():
+            attempts.append(1)
+            raise _BadRequest("400")
+
+        try:
+            scheduler.run(bad)
+            raise AssertionError("se esperaba _BadRequest")
+        except _BadRequest:
+            pass
+        assert len(attempts) == 1 and scheduler.stats["failures"] == 1 and scheduler._active == 0
+
+        # Un stream que falla a mitad no se reintenta (ya se han entregado fragmentos)
+        def broken_stream():
+            yield "a"
+            raise _Unavailable("503")
+
+        received = []
+        try:
+            for chunk in scheduler.stream(broken_stream):
+                received.append(chunk)
+            raise AssertionError("se esperaba _Unavailable")
+        except _Unavailable:
+            pass
+        assert received == ["a"] and scheduler._active == 0
+
+
+# --- RoiAggregates ---
+
+def reference_metrics(users, time_saved, cost, threshold):
+    """Métricas recorriendo la tabla completa, como referencia de los agregados."""
+    rows = [u for name, u in users.items() if name != "admin"]
+    active = [u for u in rows if u["active_sessions"] >= threshold]
+    return _roi_from_aggregates(len(rows), len(active), sum(u["active_sessions"] for u in active),
+                                sum(belt_index(u["score"]) for u in active), time_saved, cost)
+
+
+def assert_same_metrics(expected, actual):
+    assert expected.keys() == actual.keys(), (expected, actual)
+    for key in expected:
+        assert abs(expected[key] - actual[key]) <= 1e-9 * max(1.0, abs(expected[key])), (key, expected, actual)
+
+
+def check_roi_aggregates():
+    rng = random.Random(7)
+    users = {"admin": {"score": 0, "active_sessions": 0}}
+    for i in range(300):
+        users[f"user{i}"] = {"score": rng.randint(0, 1500), "active_sessions": rng.randint(0, 40)}
+    aggregates = RoiAggregates()
+    aggregates.rebuild(users)
+    thresholds = (1, 10, 25)
+    for threshold in thresholds:
+        assert_same_metrics(reference_metrics(users, 0.25, 50.0, threshold), aggregates.metrics(0.25, 50.0, threshold))
+
+    # Cambios incrementales (incluidos usuarios nuevos) sobre umbrales ya memorizados
+    for step in range(2000):
+        name = f"user{rng.randint(0, 349)}"
+        user = users.setdefault(name, {"score": 0, "active_sessions": 0})
+        user["active_sessions"] += rng.randint(0, 2)
+        user["score"] = min(user["score"] + rng.randint(0, 60), 2000)
+        aggregates.update(name, user["active_sessions"], user["score"])
+        if step % 250 == 0:
+            for threshold in thresholds + (rng.randint(1, 40),):
+                assert_same_metrics(reference_metrics(users, 0.25, 50.0, threshold),
+                                    aggregates.metrics(0.25, 50.0, threshold))
+
+    # Actualizaciones concurrentes: el resultado no depende del reparto entre hilos
+    def worker(names):
+        for name in names:
+            users[name]["active_sessions"] += 1
+            aggregates.update(name, users[name]["active_sessions"], users[name]["score"])
+
+    names = [name for name in users if name != "admin"]
+    threads = [start(worker, names[i::4]) for i in range(4)]
+    for thread in threads:
+        thread.join(WAIT_S)
+    for threshold in thresholds:
+        assert_same_metrics(reference_metrics(users, 0.25, 50.0, threshold), aggregates.metrics(0.25, 50.0, threshold))
+
+
+# --- BM25Index.updated ---
+
+def _chunks(rng, document, pages):
+    return [Chunk(document, page, " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 60))))
+            for page in range(1, pages + 1)]
+
+
+def _same_index(expected, actual):
+    assert actual.chunks == expected.chunks
+    assert actual.lengths == expected.lengths
+    assert {t: sorted(p) for t, p in actual.postings.items()} == {t: sorted(p) for t, p in expected.postings.items()}
+    assert actual.idf.keys() == expected.idf.keys()
+    assert all(abs(actual.idf[t] - expected.idf[t]) < 1e-12 for t in expected.idf)
+    assert abs(actual.avg_length - expected.avg_length) < 1e-12
+
+
+def check_bm25_updated():
+    rng = random.Random(11)
+    documents = {f"doc{i}.md": _chunks(rng, f"doc{i}.md", rng.randint(1, 6)) for i in range(12)}
+    chunks = [chunk for pages in documents.values() for chunk in pages]
+    index = BM25Index(chunks)
+    before = {t: list(p) for t, p in index.postings.items()}
+
+    # Se quita un documento, se cambia otro, se añade uno nuevo y se repite un fragmento
+    documents.pop("doc3.md")
+    documents["doc5.md"] = _chunks(rng, "doc5.md", 3)
+    documents["nuevo.md"] = _chunks(rng, "nuevo.md", 4)
+    new_chunks = [chunk for pages in documents.values() for chunk in pages] + [documents["doc0.md"][0]]
+    updated = index.updated(new_chunks)
+    _same_index(BM25Index(new_chunks), updated)
+    assert index.postings == before, "updated() modificó el índice original"
+    for query in ("cliente venta", "protocolo de seguridad", "inventario proveedor entrega", "zzz"):
+        expected = [(round(s, 9), c) for s, c in BM25Index(new_chunks).search(query)]
+        actual = [(round(s, 9), c) for s, c in updated.search(query)]
+        assert sorted(expected, key=repr) == sorted(actual, key=repr), query
+
+    # Casos límite: todo nuevo y todo eliminado
+    _same_index(BM25Index(new_chunks), BM25Index([]).updated(new_chunks))
+    _same_index(BM25Index([]), index.updated([]))
+
+
+# --- ProgressJournal ---
+
+def check_progress_journal():
+    with overridden(SECURITY_CONFIG, progress_flush_interval_seconds=3600, progress_flush_max_pending=10 ** 6):
+        path = os.path.join(tempfile.mkdtemp(), "journal.jsonl")
+        store = {}
+        entered, release = threading.Event(), threading.Event()
+        fail = []
+
+        def apply_batch(batch):
+            entered.set()
+            release.wait(WAIT_S)
+            if fail:
+                raise OSError("almacén no disponible")
+            for username, change in batch.items():
+                user = store.setdefault(username, {"score": 0, "sessions": 0})
+                if change["score"] is not None:
+                    user["score"] = change["score"]
+                user["sessions"] += change["sessions"]
+            journal.finish_inflight()
+
+        journal = ProgressJournal(path, apply_batch)
+        journal.record("ana", score=100, increment_session=True)
+        journal.record("ana", increment_session=True)
+        journal.record("luis", score=40)
+        assert journal.pending_for("ana") == (100, 2)
+
+        # Durante el volcado el lote sigue visible y los cambios nuevos se suman a él
+        flusher = start(journal.flush)
+        assert entered.wait(WAIT_S)
+        # El lote ya no está en el archivo: una caída ahora no lo recuperaría dos veces
+        assert _replayed(path) == {}, _replayed(path)
+        journal.record("ana", score=150, increment_session=True)
+        assert journal.pending_for("ana") == (150, 3), journal.pending_for("ana")
+        assert sorted(journal.pending_users()) == ["ana", "luis"]
+        release.set()
+        flusher.join(WAIT_S)
+        assert store == {"ana": {"score": 100, "sessions": 2}, "luis": {"score": 40, "sessions": 0}}, store
+        assert journal.pending_for("ana") == (150, 1) and journal.pending_users() == ["ana"]
+
+        # El archivo solo contiene lo pendiente y se recupera al reiniciar
+        assert _replayed(path) == {"ana": {"score": 150, "sessions": 1}}, _replayed(path)
+
+        # Un volcado fallido devuelve el lote a pendientes sin perder lo llegado mientras tanto
+        entered.clear()
+        release.clear()
+        fail.append(True)
+        flusher = start(journal.flush)
+        assert entered.wait(WAIT_S)
+        journal.record("luis", increment_session=True)
+        release.set()
+        flusher.join(WAIT_S)
+        assert journal.pending_for("ana") == (150, 1) and journal.pending_for("luis") == (None, 1)
+        assert _replayed(path) == {"ana": {"score": 150, "sessions": 1}, "luis": {"score": None, "sessions": 1}}
+        fail.clear()
+        assert journal.flush() is True
+        assert store["ana"] == {"score": 150, "sessions": 3} and store["luis"] == {"score": 40, "sessions": 1}, store
+        assert journal.pending_users() == []
+
+
+def _replayed(path):
+    """Cambios que recuperaría un proceso nuevo a partir de una copia del archivo."""
+    copy = f"{path}.copia"
+    shutil.copyfile(path, copy)
+    # Sin resume(): solo se lee el archivo, no se vuelca
+    return ProgressJournal(copy, lambda batch: None)._pending
+
+
+class _SlowStore:
+    """Almacén en memoria cuyo apply_progress, ya escrito el lote, espera a que se le dé paso."""
+
+    available = True
+
+    def __init__(self, users):
+        self.users = users
+        self.entered, self.release = threading.Event(), threading.Event()
+
+    def load_users(self):
+        return {username: dict(user) for username, user in self.users.items()}
+
+    def ensure_users(self, data):
+        for username, user in data.items():
+            self.users.setdefault(username, dict(user))["password_hash"] = user["password_hash"]
+
+    def apply_progress(self, batch):
+        self.users = merge_progress(self.load_users(), batch)
+        self.entered.set()
+        self.release.wait(WAIT_S)
+
+
+def check_auth_reload_during_flush():
+    with overridden(SECURITY_CONFIG, progress_flush_interval_seconds=3600, progress_flush_max_pending=10 ** 6,
+                    users_cache_ttl_seconds=3600):
+        store = _SlowStore({"ana": {"password_hash": "x", "score": 0, "active_sessions": 0, "role": "user"}})
+        manager = AuthManager(lambda: store, os.path.join(tempfile.mkdtemp(), "journal.jsonl"))
+        manager.update_user_progress("ana", increment_session=True)
+        assert manager.get_user_progress("ana")["active_sessions"] == 1
+
+        # Se fuerza una recarga de la tabla con el lote ya en el almacén pero aún sin fusionar
+        flusher = start(manager.flush_progress)
+        assert store.entered.wait(WAIT_S)
+        manager.invalidate_users()
+        progress = []
+        reader = start(lambda: progress.append(manager.get_user_progress("ana")))
+        reader.join(0.05)  # Da tiempo al lector a llegar a la recarga
+        store.release.set()
+        for thread in (flusher, reader):
+            thread.join(WAIT_S)
+        assert store.users["ana"]["active_sessions"] == 1, store.users
+        assert progress == [{"score": 0, "active_sessions": 1}], progress
+        assert manager.get_user_progress("ana")["active_sessions"] == 1
+        manager.invalidate_users()
+        assert manager.get_user_progress("ana")["active_sessions"] == 1
+        assert manager.get_roi_metrics(0.25, 50.0, 1)["F"] == 1.0
+
+
+CHECKS = [
+    ("SingleFlight", check_single_flight),
+    ("LLMScheduler", check_scheduler),
+    ("RoiAggregates", check_roi_aggregates),
+    ("BM25Index.updated", check_bm25_updated),
+    ("ProgressJournal", check_progress_journal),
+    ("AuthManager: recarga durante un volcado", check_auth_reload_during_flush),
+]
+
+
+def main():
+    failed = 0
+    for name, check in CHECKS:
+        started = time.perf_counter()
+        try:
+            check()
+        except Exception:
+            failed += 1
+            print(f"FALLO {name}")
+            traceback.print_exc()
+            continue
+        print(f"ok    {name} ({(time.perf_counter() - started) * 1000:.0f} ms)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
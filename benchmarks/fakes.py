@@ -0,0 +1,215 @@
+"""Dobles locales y deterministas para los benchmarks (sin red ni credenciales).
+
+- FakeGenaiClient: imita genai.Client (models.generate_content, generate_content_stream
+  y caches) con latencia y número de tokens de salida configurables. Responde según el
+  prompt: roles (lista de 4 strings), temas (lista de strings), tests (preguntas en JSON),
+  resúmenes y chat (texto).
+- FakeGSheetsConnection: imita GSheetsConnection sobre un DataFrame en memoria con un
+  retardo de E/S simulado en cada lectura y escritura.
+- synthetic_corpus / synthetic_users / synthetic_quiz: datos sintéticos reproducibles.
+"""
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from storage import GSheetsUserStore
+
+WORDS = (
+    "cliente venta producto servicio proceso calidad equipo objetivo formación tienda "
+    "pedido stock precio oferta campaña atención reclamación garantía devolución factura "
+    "protocolo seguridad higiene turno horario inventario proveedor logística entrega "
+    "comunicación liderazgo feedback coaching evaluación competencia escenario caso "
+    "indicador resultado mejora incidencia revisión norma política marca experiencia"
+).split()
+
+
+def _sentence(rng, n_words):
+    words = [rng.choice(WORDS) for _ in range(n_words)]
+    return " ".join(words).capitalize() + "."
+
+
+def synthetic_text(n_chars, seed=0):
+    """Texto sintético en párrafos, con el vocabulario típico de un manual de formación."""
+    rng = random.Random(seed)
+    parts, size = [], 0
+    while size < n_chars:
+        paragraph = " ".join(_sentence(rng, rng.randint(6, 18)) for _ in range(rng.randint(3, 7)))
+        parts.append(paragraph)
+        size += len(paragraph) + 2
+    return "\n\n".join(parts)[:n_chars]
+
+
+def synthetic_corpus(folder, n_files, chars_per_file, seed=0):
+    """Crea n_files documentos .md en folder y devuelve el total de bytes escritos."""
+    os.makedirs(folder, exist_ok=True)
+    total = 0
+    for i in range(n_files):
+        text = f"# Módulo {i}\n\n" + synthetic_text(chars_per_file, seed=seed * 100003 + i)
+        path = os.path.join(folder, f"modulo_{i:04d}.md")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        total += os.path.getsize(path)
+    return total
+
+
+def synthetic_users(n_users, seed=0):
+    """Tabla de usuarios {usuario: fila} con el esquema de la hoja Users (incluye admin)."""
+    rng = random.Random(seed)
+    users = {
+        "admin": {"password_hash": hashlib.sha256(b"admin123").hexdigest(), "score": 0, "active_sessions": 0, "role": "admin"},
+        "empleado": {"password_hash": hashlib.sha256(b"olivia2024").hexdigest(), "score": 0, "active_sessions": 0, "role": "user"},
+    }
+    for i in range(n_users):
+        users[f"user{i}"] = {
+            "password_hash": hashlib.sha256(f"pwd{i}".encode()).hexdigest(),
+            "score": rng.randint(0, 1500),
+            "active_sessions": int(rng.expovariate(1 / 12)),
+            "role": "user",
+        }
+    return users
+
+
+def synthetic_quiz(n_questions, seed=0):
+    """Preguntas con el formato de generate_quiz_questions y respuestas de usuario aleatorias."""
+    rng = random.Random(seed)
+    questions = []
+    for i in range(n_questions):
+        options = [_sentence(rng, 4) for _ in range(3)]
+        questions.append({"question": f"¿{_sentence(rng, 8)[:-1]}? ({i})", "options": options, "answer": rng.choice(options)})
+    answers = {i: rng.choice(q["options"]) for i, q in enumerate(questions)}
+    return questions, answers
+
+
+# --- Gemini ---
+
+def _estimate_prompt_tokens(contents, config):
+    text = contents if isinstance(contents, str) else repr(contents)
+    system = getattr(config, "system_instruction", None) or ""
+    return (len(text) + len(system)) // 4 + 1
+
+
+class _FakeModels:
+    def __init__(self, client):
+        self._client = client
+
+    def _response_text(self, contents, config):
+        """Respuesta con la forma que espera logic.py para cada tipo de prompt."""
+        rng = random.Random(self._client.seed + self._client.calls)
+        prompt = contents if isinstance(contents, str) else repr(contents)
+        if getattr(config, "response_mime_type", None) == "application/json":
+            if "roles jerárquicos" in prompt:
+                return json.dumps([f"{_sentence(rng, 2)[:-1]} (nivel {i})" for i in range(1, 5)], ensure_ascii=False)
+            if "lista de 5 a 8 temas" in prompt:
+                return json.dumps([_sentence(rng, 2)[:-1] for _ in range(rng.randint(5, 8))], ensure_ascii=False)
+            questions, _ = synthetic_quiz(5, seed=rng.randint(0, 10 ** 6))
+            return json.dumps(questions, ensure_ascii=False)
+        if "Responde ÚNICAMENTE con el resumen" in prompt:
+            # Resúmenes de documentos (map-reduce): unas 150 palabras
+            return synthetic_text(1000, seed=rng.randint(0, 10 ** 6))
+        return synthetic_text(self._client.output_tokens * 4, seed=rng.randint(0, 10 ** 6))
+
+    def _usage(self, contents, config, text):
+        return SimpleNamespace(
+            prompt_token_count=_estimate_prompt_tokens(contents, config),
+            candidates_token_count=len(text) // 4 + 1,
+            cached_content_token_count=None,
+        )
+
+    def generate_content(self, model, contents, config=None):
+        self._client._count()
+        time.sleep(self._client.latency_s)
+        text = self._response_text(contents, config)
+        return SimpleNamespace(text=text, usage_metadata=self._usage(contents, config, text))
+
+    def generate_content_stream(self, model, contents, config=None):
+        self._client._count()
+        text = self._response_text(contents, config)
+        chunk_chars = max(self._client.stream_chunk_tokens * 4, 1)
+        chunks = [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)] or [""]
+        time.sleep(self._client.ttft_s)
+        per_chunk = max(self._client.latency_s - self._client.ttft_s, 0) / max(len(chunks) - 1, 1)
+        for i, chunk in enumerate(chunks):
+            if i:
+                time.sleep(per_chunk)
+            last = i == len(chunks) - 1
+            yield SimpleNamespace(text=chunk, usage_metadata=self._usage(contents, config, text) if last else None)
+
+
+class _FakeCaches:
+    def __init__(self):
+        self._next = 0
+
+    def create(self, model, config=None):
+        self._next += 1
+        return SimpleNamespace(name=f"cachedContents/fake-{self._next}")
+
+    def update(self, name, config=None):
+        return SimpleNamespace(name=name)
+
+    def delete(self, name):
+        return None
+
+
+class FakeGenaiClient:
+    """Sustituto de genai.Client con latencia y tokens de salida configurables."""
+
+    def __init__(self, latency_s=0.0, ttft_s=0.0, output_tokens=200, stream_chunk_tokens=20, seed=0):
+        self.latency_s = latency_s
+        self.ttft_s = min(ttft_s, latency_s) if latency_s else ttft_s
+        self.output_tokens = output_tokens
+        self.stream_chunk_tokens = stream_chunk_tokens
+        self.seed = seed
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.models = _FakeModels(self)
+        self.caches = _FakeCaches()
+
+    def _count(self):
+        with self._lock:
+            self.calls += 1
+
+
+# --- Google Sheets ---
+
+class FakeGSheetsConnection:
+    """Sustituto de GSheetsConnection: pestañas como DataFrames en memoria con retardo de E/S."""
+
+    def __init__(self, worksheets=None, delay_s=0.0):
+        self._worksheets = dict(worksheets or {})
+        self.delay_s = delay_s
+        self.reads = 0
+        self.writes = 0
+
+    def read(self, worksheet, ttl=None):
+        import pandas as pd
+        time.sleep(self.delay_s)
+        self.reads += 1
+        df = self._worksheets.get(worksheet)
+        return df.copy() if df is not None else pd.DataFrame()
+
+    def update(self, worksheet, data):
+        time.sleep(self.delay_s)
+        self.writes += 1
+        self._worksheets[worksheet] = data.copy()
+
+
+class FakeSheetsUserStore(GSheetsUserStore):
+    """GSheetsUserStore conectado a una FakeGSheetsConnection."""
+
+    available = True
+
+    def __init__(self, users=None, delay_s=0.0):
+        import pandas as pd
+        worksheets = {}
+        if users:
+            df = pd.DataFrame.from_dict(users, orient="index")
+            df.index.name = "username"
+            worksheets["Users"] = df.reset_index()
+        self.connection = FakeGSheetsConnection(worksheets, delay_s)
+
+    def _connection(self):
+        return self.connection
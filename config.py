@@ -70,12 +70,100 @@ Espera a que el usuario te salude para comenzar la FASE 1.
 # Configuración de Seguridad y Persistencia
 SECURITY_CONFIG = {
     "enable_auth": True, # Cambiar a False para deshabilitar la seguridad
-    "data_file": os.path.join(BASE_DIR, "user_progress.json")
+    "data_file": os.path.join(BASE_DIR, "user_progress.json"),
+    "storage_backend": "gsheets", # Almacenamiento de usuarios: "gsheets" o "sqlite"
+    "gsheets_connection": "gsheets", # Nombre de la conexión en secrets ([connections.gsheets])
+    "sqlite_file": os.path.join(BASE_DIR, "users.db"), # Base de datos local si storage_backend = "sqlite"
+    "progress_write_behind": True, # Volcar el progreso en segundo plano y por lotes
+    "progress_journal_file": os.path.join(BASE_DIR, ".progress_journal.jsonl"), # Diario local de cambios pendientes
+    "progress_flush_interval_seconds": 5, # Intervalo máximo entre volcados
+    "progress_flush_max_pending": 50, # Volcar antes si hay este número de usuarios con cambios
+    "users_cache_ttl_seconds": 30, # Vida de la tabla de usuarios en memoria antes de releer Sheets
+    "admin_password_hash": None, # SHA-256 de la contraseña del usuario admin de un cliente (lo fija create_client.py)
 }
 
-def apply_custom_styles():
+# Configuración de Rendimiento
+PERFORMANCE_CONFIG = {
+    "extraction_cache_folder": os.path.join(BASE_DIR, ".kb_cache"), # Caché persistente de texto extraído (por hash de archivo)
+    "extraction_cache_max_mb": 1024, # Tamaño máximo de la caché: tras cada carga se borran las entradas usadas hace más tiempo
+    "extraction_workers": 0, # Procesos para extraer PDFs en paralelo (0 = uno por núcleo, 1 = secuencial)
+    "extraction_pages_per_task": 8, # Páginas de PDF que procesa cada tarea del pool
+    "kb_max_file_bytes": 20 * 1024 * 1024, # Tamaño máximo de texto por documento (el resto se recorta con aviso)
+    "kb_max_total_bytes": 200 * 1024 * 1024, # Tamaño máximo de texto de toda la base (los documentos siguientes se omiten)
+    "kb_mmap_min_bytes": 1024 * 1024, # Los archivos de texto a partir de este tamaño se leen con mmap
+    "kb_watch_enabled": True, # Vigilar la carpeta de documentos y recargar la base sin reiniciar
+    "kb_watch_poll_seconds": 2, # Intervalo de revisión de la carpeta si no hay eventos del sistema (watchdog)
+    "kb_watch_debounce_seconds": 1.0, # Espera tras un cambio para agrupar copias de varios archivos
+    "chunk_chars": 1500, # Tamaño de cada fragmento indexado de la Base de Conocimiento
+    "chunk_overlap_chars": 200, # Solapamiento entre fragmentos consecutivos
+    "retrieval_enabled": True, # Enviar solo los fragmentos relevantes (BM25) en lugar de toda la base
+    "retrieval_top_k": 8, # Máximo de fragmentos por prompt
+    "retrieval_token_budget": 6000, # Presupuesto aproximado de tokens para los fragmentos
+    "gemini_base_url": None, # Endpoint alternativo de Gemini (proxy o servidor local de pruebas)
+    "context_caching": False, # Registrar prompt de sistema + base de conocimiento como caché de contexto en Gemini
+    "context_cache_ttl_seconds": 3600, # Vida de la caché de contexto en Gemini
+    "context_cache_refresh_margin_seconds": 300, # Renovar la caché cuando le quede menos de este margen
+    "context_cache_max_entries": 16, # Cachés de contexto recordadas a la vez (una por cliente, base y prompt)
+    "context_cache_failure_backoff_seconds": 600, # Tras un rechazo de Gemini, no reintentar la caché de ese prefijo durante este tiempo
+    "quiz_bank_enabled": True, # Pregenerar tests en segundo plano para empezar el Dojo al instante
+    "quiz_bank_target_size": 3, # Tests en reserva por combinación (tema, dificultad, rol) ya usada; al seleccionarla solo se prepara uno
+    "quiz_bank_low_water": 1, # Rellenar la reserva cuando quede este número de tests o menos
+    "quiz_bank_min_questions": 3, # Preguntas válidas y no repetidas necesarias para guardar un test
+    "quiz_bank_workers": 1, # Hilos que generan tests en segundo plano
+    "quiz_bank_max_keys": 64, # Combinaciones con reserva en memoria (se descartan las menos usadas)
+    "quiz_bank_retry_seconds": 30, # Espera tras un fallo antes de reintentar el relleno
+    "chat_token_budget": 12000, # Tokens aproximados de prompt + base + historial antes de resumir el historial
+    "chat_keep_recent_messages": 6, # Últimos mensajes que se envían siempre literalmente
+    "chat_summary_batch_messages": 6, # Mensajes antiguos acumulados antes de ampliar el resumen
+    "chat_summary_max_words": 200, # Longitud máxima del resumen de la conversación
+    "chat_cache_enabled": True, # Caché de respuestas del chat (exacta + semántica)
+    "chat_cache_ttl_seconds": 3600, # Vida de cada respuesta cacheada
+    "chat_cache_max_entries": 512, # Entradas máximas por nivel (se descartan las menos usadas)
+    "chat_cache_history_tail": 2, # Mensajes previos del historial que forman parte de la clave
+    "chat_cache_semantic_threshold": 0.85, # Similitud coseno mínima para considerar una paráfrasis
+    "chat_cache_bypass_after_turns": 2, # Sin caché a partir de este número de turnos previos del usuario
+    "llm_max_concurrency": 4, # Llamadas simultáneas a Gemini en todo el proceso
+    "llm_requests_per_minute": 60, # Límite de peticiones por minuto (ajustar a la cuota del proyecto)
+    "llm_tokens_per_minute": 1000000, # Límite de tokens (entrada + salida) por minuto
+    "llm_output_tokens_estimate": 1000, # Reserva de tokens de salida por petición hasta conocer el consumo real
+    "llm_max_retries": 4, # Reintentos ante errores transitorios (429, 5xx, cortes de conexión)
+    "llm_backoff_base_seconds": 1.0, # Espera base del backoff exponencial (con jitter)
+    "llm_backoff_max_seconds": 30.0, # Espera máxima entre reintentos
+    "digest_enabled": True, # Descubrir roles y temas a partir de un resumen de cada documento
+    "digest_part_chars": 30000, # Los documentos más largos se resumen por partes en paralelo y luego se combinan
+    "digest_min_chars": 1500, # Los documentos más cortos se usan tal cual, sin resumir
+    "digest_max_words": 150, # Longitud máxima del resumen de cada documento
+    "digest_context_tokens": 30000, # Tokens máximos de los resúmenes juntos en el prompt de análisis (se recortan los más largos)
+    "digest_workers": 4, # Hilos que lanzan los resúmenes (la concurrencia real la limita el planificador)
+    "digest_retry_seconds": 120, # Espera antes de reintentar los resúmenes si alguno ha fallado
+    "kb_analysis_max_versions": 4, # Versiones de la base con roles y temas memorizados en memoria
+    "single_flight_timeout_seconds": 120, # Espera máxima de una petición agrupada con otra idéntica en curso
+    "telemetry_buffer_size": 1000, # Llamadas a Gemini que se conservan en memoria para el panel de rendimiento
+    "telemetry_log_file": os.path.join(BASE_DIR, ".llm_telemetry.jsonl"), # Log local de telemetría (None = desactivado)
+}
+
+# Configuración Multi-cliente (un único despliegue para varios clientes)
+TENANT_CONFIG = {
+    "default_tenant": "olivia", # Cliente por defecto: usa CLIENT_CONFIG y SECURITY_CONFIG tal cual
+    "query_param": "tenant", # Parámetro de URL para elegir cliente (ej. ?tenant=iberia)
+    "id_pattern": r"^[a-z0-9][a-z0-9-]{0,62}$", # Identificadores de cliente válidos (se usan en URL, carpetas y conexiones)
+    "tenants_file": os.path.join(BASE_DIR, "tenants.json"), # Clientes dados de alta con create_client.py
+    "tenants_folder": os.path.join(BASE_DIR, "tenants"), # Carpeta de datos por cliente (documentos, users.db...)
+    "memory_cap_mb": 512, # Memoria máxima estimada para bases de conocimiento y tablas de usuarios cargadas
+}
+
+# Clientes definidos en código: id -> valores que sustituyen a CLIENT_CONFIG / SECURITY_CONFIG.
+# Para los demás clientes, por defecto:
+#   knowledge_base_folder = tenants/<id>/knowledge_base
+#   sqlite_file = tenants/<id>/users.db, progress_journal_file = tenants/<id>/.progress_journal.jsonl
+#   gsheets_connection = "gsheets_<id>" (secreto [connections.gsheets_<id>] con su hoja de cálculo)
+TENANTS = {
+    "olivia": {},
+}
+
+def apply_custom_styles(client_config=None):
     """Aplica estilos CSS personalizados basados en la configuración del cliente."""
-    bg_url = CLIENT_CONFIG["background_url"]
+    bg_url = (client_config or CLIENT_CONFIG)["background_url"]
     
     css = f"""
     <style>
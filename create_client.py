@@ -1,54 +1,94 @@
+import getpass
+import hashlib
+import json
 import os
-import subprocess
+import re
 import sys
+from config import TENANT_CONFIG, TENANTS
 
-def run_command(command):
-    """Ejecuta comandos de Git silenciosamente salvo error."""
+# Longitud máxima del identificador (la misma que admite TENANT_CONFIG["id_pattern"])
+MAX_ID_LENGTH = 63
+
+def slug(nombre):
+    """Convierte el nombre del cliente a identificador de URL (ej: demo-liderazgo)."""
+    return re.sub(r"[^a-z0-9]+", "-", nombre.lower()).strip("-")[:MAX_ID_LENGTH].rstrip("-")
+
+def cargar_clientes(path):
     try:
-        subprocess.run(command, shell=True, check=True, text=True, capture_output=True)
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Error al ejecutar: {command}")
-        print(f"   Detalle: {e.stderr}")
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        print(f"❌ {path} no es un JSON válido: {e}")
         sys.exit(1)
 
+def guardar_clientes(path, clientes):
+    """Escritura atómica: la app en marcha relee el archivo cuando cambia."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(clientes, f, indent=2, ensure_ascii=False)
+        f.write("\n")
+    os.replace(tmp_path, path)
+
 def crear_cliente():
-    print("\n✨ --- ASISTENTE DE CREACIÓN DE NUEVA INSTANCIA PARA CLIENTE --- ✨\n")
+    print("\n✨ --- ASISTENTE DE ALTA DE NUEVO CLIENTE --- ✨\n")
 
     # 1. DATOS DEL CLIENTE
-    nombre_raw = input("1. Nombre del cliente (ej: Iberia, Demo Liderazgo): ")
-    # Convertimos a formato URL (ej: demo-liderazgo)
-    rama_cliente = nombre_raw.lower().replace(" ", "-")
-    
-    print(f"   🔹 Se creará la rama: '{rama_cliente}'")
+    nombre_raw = input("1. Nombre del cliente (ej: Iberia, Demo Liderazgo): ").strip()
+    tenant_id = slug(nombre_raw)
+    if not tenant_id:
+        print("❌ El nombre no es válido.")
+        return
+    if not re.match(TENANT_CONFIG["id_pattern"], tenant_id):
+        # El registro de la app ignoraría este cliente: mejor no darlo de alta
+        print(f"❌ El identificador '{tenant_id}' no cumple {TENANT_CONFIG['id_pattern']}.")
+        sys.exit(1)
+
+    tenants_file = TENANT_CONFIG["tenants_file"]
+    clientes = cargar_clientes(tenants_file)
+    if tenant_id in clientes or tenant_id in TENANTS:
+        print(f"❌ Ya existe un cliente con el identificador '{tenant_id}'.")
+        return
+
+    backend = input("2. Almacenamiento de usuarios (gsheets/sqlite) [gsheets]: ").strip().lower() or "gsheets"
+    if backend not in ("gsheets", "sqlite"):
+        print("❌ Almacenamiento desconocido.")
+        return
+
+    # Cada cliente tiene su propio admin: las credenciales por defecto son solo del cliente principal
+    password = getpass.getpass("3. Contraseña del usuario admin del cliente (mín. 8 caracteres): ")
+    if len(password) < 8 or getpass.getpass("   Repite la contraseña: ") != password:
+        print("❌ La contraseña es demasiado corta o no coincide.")
+        return
+
+    print(f"   🔹 Se dará de alta el cliente '{tenant_id}' en {tenants_file}")
     confirm = input("   ¿Continuar? (s/n): ")
     if confirm.lower() != 's': return
 
-    # 2. GESTIÓN DE GIT
-    print("\n⚙️  --- PROCESANDO GIT ---")
-    print("   ⏳ Volviendo a main y actualizando...")
-    run_command("git checkout main")
-    run_command("git pull origin main")
-    
-    print(f"   ⏳ Creando rama '{rama_cliente}'...")
-    # El -B fuerza la creación o reseteo si ya existía localmente
-    run_command(f"git checkout -B {rama_cliente}")
-
-    # 3. SUBIDA A LA NUBE
-    print("\n🚀 --- SUBIENDO A GITHUB ---")
-    run_command("git add .")
-    run_command(f'git commit -m "Alta cliente (Rama): {nombre_raw}"')
-    
-    print("   ⏳ Empujando a la nube...")
-    run_command(f"git push --force --set-upstream origin {rama_cliente}")
-    print("   ✅ Rama creada y subida a GitHub.")
-
-    # 4. INSTRUCCIONES FINALES
-    print(f"\n🎉 --- ¡ÉXITO! RAMA '{rama_cliente}' CREADA ---")
+    # 2. ALTA EN EL REGISTRO DE CLIENTES
+    carpeta = os.path.join(TENANT_CONFIG["tenants_folder"], tenant_id)
+    os.makedirs(os.path.join(carpeta, "knowledge_base"), exist_ok=True)
+    clientes[tenant_id] = {
+        "client_name": nombre_raw,
+        "storage_backend": backend,
+        "admin_password_hash": hashlib.sha256(password.encode()).hexdigest(),
+    }
+    guardar_clientes(tenants_file, clientes)
+    print(f"   ✅ Cliente registrado. Carpeta de datos: {carpeta}")
+
+    # 3. INSTRUCCIONES FINALES
+    print(f"\n🎉 --- ¡ÉXITO! CLIENTE '{tenant_id}' CREADO ---")
     print("\n📋 ACCIONES REQUERIDAS:")
-    print("1. Ve a Google Drive y crea una **NUEVA HOJA DE CÁLCULO** para este cliente.")
-    print("2. Dentro de esa hoja, crea una pestaña (worksheet) llamada exactamente `Users`.")
-    print(f"3. Comparte la hoja con el rol de 'Editor' a tu email de servicio: `asistente-ia@gen-lang-client-0006409633.iam.gserviceaccount.com`")
-    print(f"4. Al desplegar la rama '{rama_cliente}', configura el secreto `spreadsheet` con la URL de esta **NUEVA** hoja.")
+    print(f"1. Copia los documentos de formación del cliente en `{os.path.join(carpeta, 'knowledge_base')}`.")
+    if backend == "gsheets":
+        print("2. Ve a Google Drive y crea una **NUEVA HOJA DE CÁLCULO** para este cliente.")
+        print("3. Dentro de esa hoja, crea una pestaña (worksheet) llamada exactamente `Users`.")
+        print(f"4. Comparte la hoja con el rol de 'Editor' a tu email de servicio: `asistente-ia@gen-lang-client-0006409633.iam.gserviceaccount.com`")
+        print(f"5. En los secrets del despliegue, añade la sección `[connections.gsheets_{tenant_id}]` con `spreadsheet` = URL de esta **NUEVA** hoja.")
+    print("\n👤 El usuario `admin` (con la contraseña indicada) se crea en el primer acceso al cliente.")
+    print(f"🔗 Acceso: URL de la app con `?{TENANT_CONFIG['query_param']}={tenant_id}` (o indicando la organización en el login).")
+    print("   No hace falta una nueva rama ni un nuevo despliegue: la app en marcha detecta el cliente al instante.")
 
 if __name__ == "__main__":
-    crear_cliente()
\ No newline at end of file
+    crear_cliente()
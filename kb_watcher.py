@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+from config import PERFORMANCE_CONFIG
+from knowledge import folder_snapshot, update_knowledge_base
+
+
+class _WakeHandler:
+    """Manejador de eventos de watchdog: cualquier cambio en la carpeta despierta al vigilante."""
+
+    def __init__(self, wake):
+        self._wake = wake
+
+    def dispatch(self, event):
+        self._wake.set()
+
+
+def _start_observer(folder_path, wake):
+    """Observador de watchdog (inotify en Linux) sobre la carpeta. Devuelve None si no está disponible."""
+    try:
+        from watchdog.observers import Observer
+    except ImportError:
+        return None
+    try:
+        observer = Observer()
+        observer.daemon = True
+        observer.schedule(_WakeHandler(wake), folder_path, recursive=False)
+        observer.start()
+    except Exception as e:
+        print(f"No se pudo vigilar {folder_path} con eventos del sistema, se usará sondeo: {e}")
+        return None
+    return observer
+
+
+class KnowledgeBaseWatcher:
+    """Mantiene al día la Base de Conocimiento de una carpeta sin reiniciar la app.
+
+    Un hilo en segundo plano espera eventos del sistema de archivos (watchdog/inotify) o,
+    si no están disponibles, revisa la carpeta cada PERFORMANCE_CONFIG['kb_watch_poll_seconds'].
+    Ante un cambio se releen solo los archivos añadidos o modificados, se actualiza el índice
+    de forma incremental y se publica la nueva versión con `on_swap(anterior, nueva)`: las
+    sesiones abiertas la reciben en su siguiente rerun.
+    """
+
+    def __init__(self, kb, on_swap=None):
+        self.kb = kb
+        self.folder = kb.folder
+        self.mode = None  # "events" o "polling" una vez iniciado
+        self._on_swap = on_swap
+        self._refresh_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._observer = None
+        self._thread = None
+        self.stats = {"reloads": 0, "files_reread": 0, "files_removed": 0, "errors": 0, "last_reload_s": None}
+
+    def start(self):
+        if self._thread is not None:
+            return
+        if os.path.isdir(self.folder):
+            self._observer = _start_observer(self.folder, self._wake)
+        self.mode = "events" if self._observer else "polling"
+        self._thread = threading.Thread(target=self._run, name=f"kb-watcher:{os.path.basename(self.folder)}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Detiene la vigilancia sin esperar al hilo (puede llamarse con cerrojos tomados)."""
+        self._stopped.set()
+        self._wake.set()
+        if self._observer is not None:
+            self._observer.stop()
+
+    def _run(self):
+        poll = PERFORMANCE_CONFIG.get("kb_watch_poll_seconds", 2)
+        debounce = PERFORMANCE_CONFIG.get("kb_watch_debounce_seconds", 1.0)
+        while not self._stopped.is_set():
+            # Con eventos también se revisa de vez en cuando por si se pierde alguno
+            woke = self._wake.wait(poll if self.mode == "polling" else poll * 30)
+            if self._stopped.is_set():
+                break
+            if woke:
+                # Agrupa la ráfaga de eventos de una copia de archivos en una sola recarga
+                self._stopped.wait(debounce)
+                self._wake.clear()
+            try:
+                self.refresh()
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"Error al recargar la base de conocimiento de {self.folder}: {e}")
+
+    def refresh(self):
+        """Revisa la carpeta y publica una nueva versión si ha cambiado. Devuelve True si hubo recarga."""
+        with self._refresh_lock:
+            snapshot = folder_snapshot(self.folder)
+            if set(snapshot) == set(self.kb.files):
+                return False
+            started = time.perf_counter()
+            old = self.kb
+            new, reread = update_knowledge_base(old, snapshot)
+            current = {name for name, _, _ in snapshot}
+            self.kb = new
+            self.stats["reloads"] += 1
+            self.stats["files_reread"] += len(reread)
+            self.stats["files_removed"] += sum(1 for document in old.documents if document.name not in current)
+            self.stats["last_reload_s"] = round(time.perf_counter() - started, 3)
+            print(f"Base de conocimiento {old.version} -> {new.version}: {len(reread)} archivos releídos")
+            if self._on_swap and not self._stopped.is_set():
+                self._on_swap(old, new)
+            return True
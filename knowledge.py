@@ -0,0 +1,505 @@
+import streamlit as st
+import hashlib
+import json
+import mmap
+import os
+import sys
+from collections import deque
+from dataclasses import dataclass
+from functools import cached_property
+from importlib.util import find_spec
+from config import PERFORMANCE_CONFIG
+from retrieval import BM25Index, chunk_documents, format_chunks, select_chunks
+
+_pypdf = None
+
+
+def _import_pypdf():
+    """Módulo pypdf, importado al leer el primer PDF. Devuelve None si no está instalada."""
+    global _pypdf
+    if _pypdf is None:
+        try:
+            import pypdf
+        except ImportError:
+            return None
+        _pypdf = pypdf
+    return _pypdf
+
+
+# Extensiones soportadas por la Base de Conocimiento
+TEXT_EXTENSIONS = ('.txt', '.md', '.csv', '.json', '.py')
+PDF_EXTENSIONS = ('.pdf',)
+# Incrementar si cambia la forma de extraer texto para invalidar la caché persistente
+EXTRACTION_VERSION = "v1"
+# Caracteres del principio de la base que se usan para descubrir roles y temas sin resúmenes
+ANALYSIS_SAMPLE_CHARS = 50000
+
+
+@dataclass(frozen=True)
+class Document:
+    """Documento extraído de la Base de Conocimiento (un texto plano tiene una sola página)."""
+    name: str
+    is_pdf: bool
+    pages: tuple
+
+
+@dataclass(frozen=True)
+class KnowledgeBase:
+    """Base de conocimiento inmutable compartida entre todas las sesiones.
+
+    El texto completo (`text`) solo se construye si se pide: con la recuperación por
+    fragmentos basta con los documentos y el índice.
+    """
+    folder: str
+    version: str
+    documents: tuple = ()
+    index: BM25Index = None
+    cache_hits: int = 0
+    cache_misses: int = 0
+    files: tuple = ()  # (nombre, tamaño, fecha de modificación) de cada archivo al leer la carpeta
+
+    def __bool__(self):
+        return bool(self.documents)
+
+    @cached_property
+    def text(self):
+        """Texto plano completo de la base (se construye en el primer uso)."""
+        return render_documents(self.documents)
+
+    def head(self, max_chars):
+        """Principio del texto plano de la base, sin construir el texto completo."""
+        if "text" in self.__dict__:
+            return self.text[:max_chars]
+        parts = []
+        size = 0
+        for part in _render_parts(self.documents):
+            parts.append(part)
+            size += len(part)
+            if size >= max_chars:
+                break
+        return "".join(parts)[:max_chars]
+
+    def analysis_context(self):
+        """Texto para el análisis de roles y temas.
+
+        Con la caché de contexto de Gemini es la base completa (el mismo prefijo que usan
+        los tests); si no, basta con su principio.
+        """
+        return self.text if PERFORMANCE_CONFIG.get("context_caching") else self.head(ANALYSIS_SAMPLE_CHARS)
+
+    def approx_bytes(self):
+        """Memoria aproximada de la base cargada (texto, páginas, fragmentos e índice)."""
+        size = sys.getsizeof(self.__dict__["text"]) if "text" in self.__dict__ else 0
+        size += sum(sys.getsizeof(page) for document in self.documents for page in document.pages)
+        if self.index:
+            size += sum(sys.getsizeof(chunk.text) for chunk in self.index.chunks)
+            # Cada entrada del índice invertido ocupa del orden de 100 bytes (tupla + lista)
+            size += 100 * sum(len(plist) for plist in self.index.postings.values())
+        return size
+
+    def context_for(self, query):
+        """Contexto para el prompt: los fragmentos más relevantes para la consulta o el texto completo."""
+        # Con la caché de contexto de Gemini el prefijo debe ser estático: se usa la base completa
+        if PERFORMANCE_CONFIG.get("context_caching") or not PERFORMANCE_CONFIG.get("retrieval_enabled") or not self.index:
+            return self.text
+        chunks = select_chunks(self.index, query, PERFORMANCE_CONFIG["retrieval_top_k"],
+                               PERFORMANCE_CONFIG["retrieval_token_budget"])
+        return format_chunks(chunks)
+
+
+def folder_snapshot(folder_path):
+    """Nombre, tamaño y fecha de modificación de cada archivo soportado, en el orden del directorio."""
+    if not os.path.isdir(folder_path):
+        return ()
+    entries = []
+    for entry in os.scandir(folder_path):
+        if entry.is_file() and entry.name.endswith(TEXT_EXTENSIONS + PDF_EXTENSIONS):
+            stat = entry.stat()
+            entries.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    return tuple(entries)
+
+
+def snapshot_fingerprint(snapshot):
+    """Huella de una instantánea de la carpeta (no depende del orden del directorio)."""
+    digest = hashlib.sha256()
+    for name, size, mtime in sorted(snapshot):
+        digest.update(f"{name}\0{size}\0{mtime}\n".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def folder_fingerprint(folder_path):
+    """Huella de la carpeta basada en nombre, tamaño y fecha de modificación de cada archivo."""
+    return snapshot_fingerprint(folder_snapshot(folder_path))
+
+
+def _file_sha256(file_path):
+    """Calcula el SHA-256 del contenido de un archivo leyéndolo por bloques."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _extract_pdf_page_range(file_path, start, stop):
+    """Extrae un rango de páginas de un PDF. Se ejecuta en los procesos del pool."""
+    reader = _import_pypdf().PdfReader(file_path)
+    return [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+
+def _extraction_workers():
+    """Número de procesos para la extracción (0 = uno por núcleo)."""
+    workers = PERFORMANCE_CONFIG.get("extraction_workers", 0)
+    return workers if workers > 0 else (os.cpu_count() or 1)
+
+
+def _cache_path(sha):
+    return os.path.join(PERFORMANCE_CONFIG["extraction_cache_folder"], f"{EXTRACTION_VERSION}-{sha}.json")
+
+
+def touch_cache_entry(path):
+    """Marca una entrada de la caché como usada ahora (prune_cache borra primero las más antiguas)."""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _read_cached_pages(sha):
+    """Devuelve las páginas cacheadas para un hash de contenido, o None si no existen."""
+    path = _cache_path(sha)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            pages = json.load(f)["pages"]
+    except (OSError, ValueError, KeyError):
+        return None
+    touch_cache_entry(path)
+    return pages
+
+
+def _write_cached_pages(sha, pages):
+    """Guarda las páginas extraídas de forma atómica (escritura temporal + rename). Devuelve True si se guardaron."""
+    path = _cache_path(sha)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"pages": pages}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        return True
+    except OSError as e:
+        print(f"No se pudo escribir la caché de extracción: {e}")
+        return False
+
+
+def prune_cache(max_bytes=None):
+    """Borra las entradas de la caché usadas hace más tiempo hasta quedar bajo 'extraction_cache_max_mb'.
+
+    La carpeta la comparten todas las bases de conocimiento (y los resúmenes de logic.py),
+    así que una carga no sabe qué entradas siguen en uso en otra: se borra por antigüedad
+    de uso, que los aciertos actualizan. Devuelve el número de archivos borrados.
+    """
+    folder = PERFORMANCE_CONFIG["extraction_cache_folder"]
+    if max_bytes is None:
+        max_bytes = PERFORMANCE_CONFIG.get("extraction_cache_max_mb", 1024) * 1024 * 1024
+    try:
+        with os.scandir(folder) as it:
+            entries = [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in it if entry.is_file()]
+    except OSError:
+        return 0
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+
+def _open_pool(workers):
+    """Pool de procesos para extraer páginas de PDF."""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # 'spawn' evita heredar los hilos del servidor de Streamlit en los procesos hijos
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def _extract_pdf(file_path, budget, workers, pools):
+    """Extrae un PDF en orden de páginas hasta cubrir `budget` bytes. Devuelve (páginas, completo).
+
+    Con varios procesos las páginas se reparten en tareas de 'extraction_pages_per_task'
+    y solo hay unas pocas en curso a la vez: al agotar el presupuesto no se extrae el
+    resto. El pool se crea en el primer uso y se guarda en `pools` para los demás PDF.
+    """
+    reader = _import_pypdf().PdfReader(file_path)
+    page_count = len(reader.pages)
+    pages_per_task = max(1, PERFORMANCE_CONFIG.get("extraction_pages_per_task", 8))
+    pages = []
+    used = 0
+
+    if workers <= 1 or page_count <= pages_per_task:
+        for page in reader.pages:
+            if used >= budget:
+                return pages, False
+            text = page.extract_text() or ""
+            pages.append(text)
+            used += len(text.encode('utf-8'))
+        return pages, True
+
+    if not pools:
+        pools.append(_open_pool(workers))
+    pool = pools[0]
+    starts = iter(range(0, page_count, pages_per_task))
+    in_flight = deque()
+
+    def submit():
+        start = next(starts, None)
+        if start is not None:
+            in_flight.append(pool.submit(_extract_pdf_page_range, file_path, start,
+                                         min(start + pages_per_task, page_count)))
+
+    for _ in range(workers * 2):
+        submit()
+    while in_flight:
+        for text in in_flight.popleft().result():
+            pages.append(text)
+            used += len(text.encode('utf-8'))
+        if used >= budget and len(pages) < page_count:
+            for future in in_flight:
+                future.cancel()
+            return pages, False
+        submit()
+    return pages, True
+
+
+def _read_pdf(file_path, budget, cache_stats, workers, pools):
+    """Páginas de un PDF desde la caché persistente o extrayéndolas (solo se cachean completas)."""
+    sha = _file_sha256(file_path)
+    pages = _read_cached_pages(sha)
+    if pages is not None:
+        cache_stats["hits"] += 1
+        return pages
+    cache_stats["misses"] += 1
+    pages, complete = _extract_pdf(file_path, budget, workers, pools)
+    if complete:
+        _write_cached_pages(sha, pages)
+    return pages
+
+
+def _decode_utf8(data, truncated):
+    """Decodifica UTF-8; si el contenido se ha cortado, descarta el carácter incompleto del final."""
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError as e:
+        if not truncated or e.start < len(data) - 3:
+            raise
+        text = data[:e.start].decode('utf-8')
+    # Mismo resultado que abrir el archivo en modo texto (saltos de línea universales)
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+def _read_text(file_path, budget):
+    """Lee como mucho `budget` bytes de un archivo de texto; los grandes se leen con mmap.
+
+    Devuelve (texto, bytes leídos, truncado).
+    """
+    size = os.path.getsize(file_path)
+    limit = min(size, budget)
+    if size >= PERFORMANCE_CONFIG.get("kb_mmap_min_bytes", 1024 * 1024):
+        with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            data = mapped[:limit]
+    else:
+        with open(file_path, 'rb') as f:
+            data = f.read(limit)
+    truncated = size > limit
+    return _decode_utf8(data, truncated), limit, truncated
+
+
+def _limit_pages(pages, budget):
+    """Recorta las páginas de un PDF al presupuesto de bytes. Devuelve (páginas, bytes usados, truncado)."""
+    kept = []
+    used = 0
+    for page in pages:
+        size = len(page.encode('utf-8'))
+        if used + size > budget:
+            remaining = page.encode('utf-8')[:budget - used]
+            kept.append(remaining.decode('utf-8', errors='ignore'))
+            return kept, budget, True
+        kept.append(page)
+        used += size
+    return kept, used, False
+
+
+def _list_files(folder_path):
+    """Archivos soportados de la carpeta, en el orden del directorio."""
+    # Filtramos por extensiones de texto comunes (y PDF si pypdf está disponible)
+    extensions = TEXT_EXTENSIONS + (PDF_EXTENSIONS if find_spec("pypdf") is not None else ())
+    file_paths = []
+    for filename in os.listdir(folder_path):
+        file_path = os.path.join(folder_path, filename)
+        if os.path.isfile(file_path) and filename.endswith(extensions):
+            file_paths.append(file_path)
+    return file_paths
+
+
+def iter_documents(folder_path, cache_stats=None, workers=None, names=None, total_bytes=None, warn=None):
+    """Genera los Document de la carpeta uno a uno, en el orden del directorio.
+
+    Cada archivo se limita a PERFORMANCE_CONFIG['kb_max_file_bytes'] y el conjunto a
+    'kb_max_total_bytes': lo que excede se trunca u omite con un aviso. Cada documento
+    se lee cuando le llega el turno y con el presupuesto que queda: los PDF nuevos se
+    extraen (páginas en paralelo) solo hasta cubrirlo y se guardan en la caché al terminar.
+
+    `names` limita la lectura a esos archivos y `total_bytes` sustituye al límite global
+    (recargas incrementales). Los avisos se muestran con `warn` (por defecto st.warning).
+    """
+    warn = warn or st.warning
+    if cache_stats is None:
+        cache_stats = {"hits": 0, "misses": 0}
+    if workers is None:
+        workers = _extraction_workers()
+    if not os.path.exists(folder_path):
+        return
+
+    file_paths = _list_files(folder_path)
+    if names is not None:
+        file_paths = [p for p in file_paths if os.path.basename(p) in names]
+    max_file_bytes = PERFORMANCE_CONFIG.get("kb_max_file_bytes", 20 * 1024 * 1024)
+    remaining = total_bytes if total_bytes is not None else PERFORMANCE_CONFIG.get("kb_max_total_bytes", 200 * 1024 * 1024)
+    skipped = []
+    pools = []
+
+    try:
+        for file_path in file_paths:
+            filename = os.path.basename(file_path)
+            is_pdf = filename.endswith(PDF_EXTENSIONS)
+            if remaining <= 0:
+                skipped.append(filename)
+                continue
+            budget = min(max_file_bytes, remaining)
+            try:
+                if is_pdf:
+                    pages = _read_pdf(file_path, budget, cache_stats, workers, pools)
+                    pages, used, truncated = _limit_pages(pages, budget)
+                else:
+                    text, used, truncated = _read_text(file_path, budget)
+                    pages = [text]
+            except Exception as e:
+                if is_pdf:
+                    warn(f"No se pudo leer PDF {filename}: {e}")
+                else:
+                    warn(f"No se pudo leer {filename}: {e}")
+                continue
+            if truncated:
+                warn(f"{filename} supera el límite de tamaño de la base de conocimiento: se ha recortado.")
+            remaining -= used
+            yield Document(name=filename, is_pdf=is_pdf, pages=tuple(pages))
+    finally:
+        for pool in pools:
+            pool.shutdown(cancel_futures=True)
+
+    if skipped:
+        warn(f"Límite total de la base de conocimiento alcanzado: se omiten {', '.join(skipped)}")
+
+
+def read_documents(folder_path, cache_stats=None, workers=None):
+    """Lee los documentos de la carpeta como lista de Document, en el orden del directorio."""
+    return list(iter_documents(folder_path, cache_stats, workers))
+
+
+def _render_parts(documents):
+    for document in documents:
+        if document.is_pdf:
+            yield f"\n\n--- Documento PDF: {document.name} ---\n"
+            for page in document.pages:
+                yield page
+                yield "\n"
+        else:
+            yield f"\n\n--- Documento: {document.name} ---\n"
+            yield document.pages[0]
+
+
+def render_documents(documents):
+    """Concatena los documentos (lista o generador) en el texto plano de contexto, con una única unión."""
+    return "".join(_render_parts(documents))
+
+
+def load_knowledge_base(folder_path, cache_stats=None, workers=None):
+    """Lee archivos de texto de la carpeta especificada para crear el contexto."""
+    # Los documentos se consumen según se leen: solo se conserva el texto final
+    return render_documents(iter_documents(folder_path, cache_stats, workers))
+
+
+def build_knowledge_base(folder_path, snapshot=None):
+    """Lee la carpeta y construye la Base de Conocimiento con su índice de recuperación.
+
+    La versión es la huella de `snapshot` (instantánea tomada antes de leer la carpeta).
+    """
+    if snapshot is None:
+        snapshot = folder_snapshot(folder_path)
+    version = snapshot_fingerprint(snapshot)
+    cache_stats = {"hits": 0, "misses": 0}
+    documents = read_documents(folder_path, cache_stats)
+    print(f"Base de conocimiento {version}: caché de extracción {cache_stats['hits']} aciertos, {cache_stats['misses']} fallos")
+    if cache_stats["misses"]:
+        prune_cache()
+    # El índice de recuperación se construye una sola vez por versión
+    chunks = chunk_documents(documents, PERFORMANCE_CONFIG["chunk_chars"], PERFORMANCE_CONFIG["chunk_overlap_chars"])
+    return KnowledgeBase(folder=folder_path, version=version, documents=tuple(documents), index=BM25Index(chunks),
+                         cache_hits=cache_stats["hits"], cache_misses=cache_stats["misses"], files=snapshot)
+
+
+def update_knowledge_base(kb, snapshot, warn=print):
+    """Nueva versión de `kb` para la instantánea `snapshot` de su carpeta.
+
+    Solo se releen los archivos añadidos o modificados (y los que no se pudieron leer
+    antes), y el índice reutiliza los términos de los fragmentos que no han cambiado.
+    Devuelve (nueva base, nombres releídos).
+    """
+    previous = {name: (size, mtime) for name, size, mtime in kb.files}
+    documents = {document.name: document for document in kb.documents}
+    changed = {
+        name for name, size, mtime in snapshot
+        if previous.get(name) != (size, mtime) or name not in documents
+    }
+    current = {name for name, _, _ in snapshot}
+    kept = {name: document for name, document in documents.items() if name in current and name not in changed}
+
+    used = sum(len(page.encode('utf-8')) for document in kept.values() for page in document.pages)
+    total_bytes = max(0, PERFORMANCE_CONFIG.get("kb_max_total_bytes", 200 * 1024 * 1024) - used)
+    cache_stats = {"hits": 0, "misses": 0}
+    fresh = {
+        document.name: document
+        for document in iter_documents(kb.folder, cache_stats, names=changed, total_bytes=total_bytes, warn=warn)
+    }
+
+    # Mismo orden que una lectura completa: el del directorio
+    ordered = [kept.get(name) or fresh.get(name) for name, _, _ in snapshot]
+    ordered = [document for document in ordered if document is not None]
+
+    chunk_chars, overlap_chars = PERFORMANCE_CONFIG["chunk_chars"], PERFORMANCE_CONFIG["chunk_overlap_chars"]
+    old_chunks = {}
+    if kb.index:
+        for chunk in kb.index.chunks:
+            old_chunks.setdefault(chunk.document, []).append(chunk)
+    chunks = []
+    for document in ordered:
+        if document.name in kept:
+            chunks.extend(old_chunks.get(document.name, ()))
+        else:
+            chunks.extend(chunk_documents([document], chunk_chars, overlap_chars))
+    index = kb.index.updated(chunks) if kb.index else BM25Index(chunks)
+    if cache_stats["misses"]:
+        prune_cache()
+
+    new_kb = KnowledgeBase(folder=kb.folder, version=snapshot_fingerprint(snapshot), documents=tuple(ordered), index=index,
+                           cache_hits=cache_stats["hits"], cache_misses=cache_stats["misses"], files=snapshot)
+    return new_kb, sorted(changed & set(fresh))
@@ -1,21 +1,16 @@
-try:
-    from google import genai
-    from google.genai import types
-except ImportError:
-    genai = None
-try:
-    import pypdf
-except ImportError:
-    pypdf = None
-try:
-    from streamlit_gsheets import GSheetsConnection
-except ImportError:
-    GSheetsConnection = None
-import pandas as pd
 import streamlit as st
+import hashlib
 import json
 import os
-from config import CLIENT_CONFIG, SECURITY_CONFIG
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from config import CLIENT_CONFIG, SECURITY_CONFIG, PERFORMANCE_CONFIG
+from retrieval import estimate_tokens, split_text
+from storage import _to_int, get_user_store
+from scheduler import llm_scheduler, is_rate_limit_error, PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+from telemetry import llm_telemetry
 
 # Definición de Cinturones (Gamificación)
 BELTS = [
@@ -56,54 +51,265 @@ def get_next_belt_data(score):
     
     return {"next_name": "Maestría Total", "threshold": score, "progress": 1.0}
 
-def init_gemini():
-    """Inicializa la API de Gemini. Requiere st.secrets o variable de entorno."""
-    if genai is None:
-        st.error("La librería 'google-genai' no está instalada. Por favor ejecuta: pip install -r requirements.txt vOVM")
-        return None
+# google-genai se importa en el primer uso para no retrasar el arranque de la app
+genai = None
+types = None
+_genai_import_lock = threading.Lock()
+
+def _import_genai():
+    """Importa google-genai de forma perezosa. Devuelve False si no está instalada."""
+    global genai, types
+    if genai is not None:
+        return True
+    with _genai_import_lock:
+        if genai is None:
+            try:
+                from google import genai as genai_module
+                from google.genai import types as types_module
+            except ImportError:
+                return False
+            types = types_module
+            genai = genai_module
+    return True
+
+# Cliente de Gemini compartido por todo el proceso (reutiliza el pool de conexiones HTTP)
+_gemini_client = None
+_gemini_client_key = None
+_gemini_client_lock = threading.Lock()
 
+def _resolve_api_key():
+    """Obtiene la API Key de las variables de entorno o de st.secrets."""
     api_key = os.environ.get("GOOGLE_API_KEY")
     if not api_key:
         try:
             api_key = st.secrets.get("GOOGLE_API_KEY")
         except Exception:
             api_key = None
+    return api_key
+
+def gemini_available():
+    """Indica si hay librería y API Key para llamar a Gemini (sin mostrar errores en la interfaz)."""
+    return bool(_resolve_api_key()) and _import_genai()
+
+def get_gemini_client(api_key):
+    """Devuelve el cliente compartido, creándolo de forma perezosa o al cambiar la API Key o el endpoint."""
+    global _gemini_client, _gemini_client_key
+    base_url = PERFORMANCE_CONFIG.get("gemini_base_url")
+    key = (api_key, base_url)
+    with _gemini_client_lock:
+        if _gemini_client is None or _gemini_client_key != key:
+            http_options = types.HttpOptions(base_url=base_url) if base_url else None
+            _gemini_client = genai.Client(api_key=api_key, http_options=http_options)
+            _gemini_client_key = key
+        return _gemini_client
+
+def init_gemini():
+    """Inicializa la API de Gemini. Requiere st.secrets o variable de entorno."""
+    if not _import_genai():
+        st.error("La librería 'google-genai' no está instalada. Por favor ejecuta: pip install -r requirements.txt vOVM")
+        return None
 
+    api_key = _resolve_api_key()
     if not api_key:
         st.error("Falta la API Key de Google. Configúrala en .streamlit/secrets.toml o variables de entorno.")
         return None
     
-    return genai.Client(api_key=api_key)
+    return get_gemini_client(api_key)
 
-def load_knowledge_base(folder_path):
-    """Lee archivos de texto de la carpeta especificada para crear el contexto."""
-    context_text = ""
-    if not os.path.exists(folder_path):
-        return ""
-        
-    for filename in os.listdir(folder_path):
-        file_path = os.path.join(folder_path, filename)
-        # Filtramos por extensiones de texto comunes
-        if os.path.isfile(file_path):
-            if filename.endswith(('.txt', '.md', '.csv', '.json', '.py')):
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        context_text += f"\n\n--- Documento: {filename} ---\n{f.read()}"
-                except Exception as e:
-                    st.warning(f"No se pudo leer {filename}: {e}")
-            elif filename.endswith('.pdf') and pypdf:
-                try:
-                    reader = pypdf.PdfReader(file_path)
-                    text = ""
-                    for page in reader.pages:
-                        text += page.extract_text() + "\n"
-                    context_text += f"\n\n--- Documento PDF: {filename} ---\n{text}"
-                except Exception as e:
-                    st.warning(f"No se pudo leer PDF {filename}: {e}")
-    return context_text
-
-def generate_quiz_questions(topic, difficulty, role, knowledge_context=""):
-    """Genera 5 preguntas usando Gemini en formato JSON."""
+# Cachés de contexto registradas en Gemini, una por prefijo estático (cada cliente tiene
+# el suyo): hash del prefijo -> {"name", "expires_at"}, de la menos a la más usada
+_context_caches = OrderedDict()
+# Prefijos que Gemini ha rechazado (p. ej. demasiado cortos): hash -> no reintentar hasta
+_context_cache_failures = {}
+_context_caches_lock = threading.Lock()
+
+def _context_cache_key(model_name, system_instruction, knowledge_context):
+    """Hash del prefijo estático (modelo + prompt de sistema + base de conocimiento)."""
+    digest = hashlib.sha256()
+    for part in (model_name, system_instruction or "", knowledge_context):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def _create_cached_context(client, model_name, kind, key, system_instruction, knowledge_context, ttl):
+    """Registra el prefijo estático como contenido cacheado en Gemini y devuelve su nombre."""
+    config = types.CreateCachedContentConfig(
+        display_name=f"{kind}-{key[:12]}",
+        system_instruction=system_instruction,
+        contents=[types.Content(
+            role="user",
+            parts=[types.Part.from_text(text=f"Información de Contexto (Base de Conocimiento):\n{knowledge_context}")]
+        )],
+        ttl=f"{ttl}s"
+    )
+    with llm_telemetry.track("context_cache", model_name) as call:
+        cache = llm_scheduler.run(
+            lambda: client.caches.create(model=model_name, config=config),
+            PRIORITY_INTERACTIVE, on_retry=call.record_retry
+        )
+    return cache.name
+
+def _renew_cached_context(client, model_name, name, ttl):
+    """Amplía el TTL de una caché de contexto existente."""
+    with llm_telemetry.track("context_cache", model_name) as call:
+        llm_scheduler.run(
+            lambda: client.caches.update(name=name, config=types.UpdateCachedContentConfig(ttl=f"{ttl}s")),
+            PRIORITY_INTERACTIVE, on_retry=call.record_retry
+        )
+
+def get_cached_context(client, model_name, kind, knowledge_context, system_instruction=None):
+    """Devuelve el nombre de la caché de contexto para el prefijo estático, creándola o renovándola si hace falta.
+
+    Devuelve None si la caché de contexto está deshabilitada o Gemini la rechaza (p. ej. contexto demasiado corto).
+    """
+    if not PERFORMANCE_CONFIG.get("context_caching") or not knowledge_context.strip():
+        return None
+
+    key = _context_cache_key(model_name, system_instruction, knowledge_context)
+    ttl = PERFORMANCE_CONFIG.get("context_cache_ttl_seconds", 3600)
+    margin = PERFORMANCE_CONFIG.get("context_cache_refresh_margin_seconds", 300)
+
+    with _context_caches_lock:
+        now = time.time()
+        if _context_cache_failures.get(key, 0) > now:
+            return None
+        entry = _context_caches.get(key)
+        renew = None
+        if entry and entry["expires_at"] > now:
+            _context_caches.move_to_end(key)
+            if entry["expires_at"] - now > margin or entry["renewing"]:
+                return entry["name"]
+            entry["renewing"] = True
+            renew = entry
+
+    if renew is not None:
+        # Renovar antes de que caduque el TTL (una sola sesión; las demás siguen usando la caché)
+        try:
+            _renew_cached_context(client, model_name, renew["name"], ttl)
+            renew["expires_at"] = time.time() + ttl
+        except Exception as e:
+            print(f"No se pudo renovar la caché de contexto {renew['name']}: {e}")
+        finally:
+            renew["renewing"] = False
+        return renew["name"] if renew["expires_at"] > time.time() else None
+
+    def create():
+        # La creación (llamada de red) se hace fuera del cerrojo global: una por prefijo
+        try:
+            name = _create_cached_context(client, model_name, kind, key, system_instruction, knowledge_context, ttl)
+        except Exception as e:
+            print(f"No se pudo crear la caché de contexto de Gemini: {e}")
+            with _context_caches_lock:
+                now = time.time()
+                for failed in [k for k, until in _context_cache_failures.items() if until <= now]:
+                    del _context_cache_failures[failed]
+                _context_cache_failures[key] = now + PERFORMANCE_CONFIG.get("context_cache_failure_backoff_seconds", 600)
+            return None
+        with _context_caches_lock:
+            _context_caches[key] = {"name": name, "expires_at": time.time() + ttl, "renewing": False}
+            _context_caches.move_to_end(key)
+            # Las menos usadas se olvidan pero no se eliminan en Gemini: caducan solas por su TTL
+            # y así no se rompen las peticiones en curso que las referencian
+            while len(_context_caches) > PERFORMANCE_CONFIG.get("context_cache_max_entries", 16):
+                _context_caches.popitem(last=False)
+        return name
+
+    try:
+        return _context_cache_flight.do(key, create, PERFORMANCE_CONFIG.get("single_flight_timeout_seconds", 120))
+    except TimeoutError:
+        return None
+
+def _request_tokens(*texts):
+    """Tokens estimados de una petición (entrada + reserva de salida) para el límite por minuto."""
+    return sum(estimate_tokens(text) for text in texts if text) + PERFORMANCE_CONFIG.get("llm_output_tokens_estimate", 1000)
+
+class SingleFlight:
+    """Agrupa llamadas idénticas concurrentes: solo la primera se ejecuta y el resto espera su resultado.
+
+    Si la llamada falla, todas las que esperaban reciben la misma excepción. Las que
+    esperan más de `timeout` segundos reciben TimeoutError (la llamada original sigue).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}  # clave -> {"done": Event, "result", "error"}
+        self.stats = {"calls": 0, "coalesced": 0, "failures": 0, "timeouts": 0}
+
+    def do(self, key, fn, timeout=None):
+        with self._lock:
+            self.stats["calls"] += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = {"done": threading.Event(), "result": None, "error": None}
+                self._flights[key] = flight
+            else:
+                self.stats["coalesced"] += 1
+
+        if leader:
+            try:
+                flight["result"] = fn()
+                return flight["result"]
+            except Exception as e:
+                flight["error"] = e
+                with self._lock:
+                    self.stats["failures"] += 1
+                raise
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight["done"].set()
+
+        if not flight["done"].wait(timeout):
+            with self._lock:
+                self.stats["timeouts"] += 1
+            raise TimeoutError(f"Sin respuesta de la llamada en curso tras {timeout} s")
+        if flight["error"] is not None:
+            raise flight["error"]
+        return flight["result"]
+
+# Instancia global: las sesiones que piden el mismo prompt a la vez comparten una única llamada
+llm_single_flight = SingleFlight()
+# Creaciones de cachés de contexto en curso (las sesiones con el mismo prefijo esperan a la primera)
+_context_cache_flight = SingleFlight()
+
+def prompt_fingerprint(model_name, prompt, cache_name=None, response_mime_type=None):
+    """Huella de una petición a Gemini (modelo, prompt, caché de contexto y formato de respuesta)."""
+    digest = hashlib.sha256()
+    for part in (model_name, prompt, cache_name or "", response_mime_type or ""):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def _coalesced_json_call(feature, client, model_name, prompt, cache_name, priority=PRIORITY_BACKGROUND):
+    """Llamada a Gemini con respuesta JSON, agrupada con las peticiones idénticas en curso."""
+    def call():
+        # Los errores (de la API o del JSON devuelto) quedan registrados en la telemetría
+        with llm_telemetry.track(feature, model_name, context_cache=cache_name) as tracked:
+            response = llm_scheduler.run(
+                lambda: client.models.generate_content(
+                    model=model_name,
+                    contents=prompt,
+                    config=types.GenerateContentConfig(
+                        response_mime_type="application/json",
+                        cached_content=cache_name
+                    )
+                ),
+                priority, _request_tokens(prompt), on_retry=tracked.record_retry
+            )
+            tracked.observe(response)
+            return json.loads(response.text)
+
+    key = prompt_fingerprint(model_name, prompt, cache_name, "application/json")
+    result = llm_single_flight.do(key, call, PERFORMANCE_CONFIG.get("single_flight_timeout_seconds", 120))
+    # Cada sesión recibe su propia copia del resultado compartido
+    return list(result) if isinstance(result, list) else result
+
+def generate_quiz_questions(topic, difficulty, role, knowledge_context="", priority=PRIORITY_INTERACTIVE):
+    """Genera 5 preguntas usando Gemini en formato JSON.
+
+    El banco de tests las pide con PRIORITY_BACKGROUND para no retrasar el chat.
+    """
     client = init_gemini()
     if not client:
         # Retorno Mock si no hay API Key para que la app no rompa al probar
@@ -116,13 +322,20 @@ def generate_quiz_questions(topic, difficulty, role, knowledge_context=""):
         ]
 
     model_name = CLIENT_CONFIG.get("ai_model", "gemini-2.0-flash")
+    cache_name = get_cached_context(client, model_name, "kb", knowledge_context)
+    if cache_name:
+        knowledge_section = "Ver la Base de Conocimiento adjunta en el contexto."
+    elif knowledge_context.strip():
+        knowledge_section = knowledge_context
+    else:
+        knowledge_section = "No hay documentos cargados. Usa conocimiento general."
 
     prompt = f"""
     Actúa como un generador de exámenes experto y dinámico.
     Tu objetivo es crear un test de evaluación de 5 preguntas adaptado a los contenidos proporcionados.
     
     BASE DE CONOCIMIENTO (CONTENIDO FUENTE):
-    {knowledge_context if knowledge_context.strip() else "No hay documentos cargados. Usa conocimiento general."}
+    {knowledge_section}
     
     CONFIGURACIÓN DEL EXAMEN:
     - Tema sugerido: '{topic}'
@@ -141,15 +354,21 @@ def generate_quiz_questions(topic, difficulty, role, knowledge_context=""):
     """
     
     try:
-        response = client.models.generate_content(
-            model=model_name,
-            contents=prompt,
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json"
+        with llm_telemetry.track("quiz", model_name, context_cache=cache_name) as call:
+            response = llm_scheduler.run(
+                lambda: client.models.generate_content(
+                    model=model_name,
+                    contents=prompt,
+                    config=types.GenerateContentConfig(
+                        response_mime_type="application/json",
+                        cached_content=cache_name
+                    )
+                ),
+                priority, _request_tokens(prompt), on_retry=call.record_retry
             )
-        )
-        text_response = response.text
-        return json.loads(text_response)
+            call.observe(response)
+            text_response = response.text
+            return json.loads(text_response)
     except Exception as e:
         st.error(f"Error generando preguntas: {e}")
         return []
@@ -176,15 +395,83 @@ def evaluate_quiz(questions, user_answers):
         
     return score, results
 
-def get_chat_response(history, user_input, system_instruction, knowledge_context=""):
-    """Obtiene respuesta del chat de Gemini."""
-    client = init_gemini()
-    if not client:
-        return "Modo demostración: Configura tu API Key para chatear con Gemini real."
+CHAT_DEMO_MESSAGE = "Modo demostración: Configura tu API Key para chatear con Gemini real."
+CHAT_ERROR_PREFIX = "⚠️ **Error de conexión con la IA:**"
+
+def _chat_error_message(error):
+    if is_rate_limit_error(error):
+        return f"{CHAT_ERROR_PREFIX} el servicio está saturado en este momento. Vuelve a intentarlo en unos segundos."
+    return f"{CHAT_ERROR_PREFIX} {error}.\n\nPor favor, verifica que tu API Key en `.streamlit/secrets.toml` sea correcta y válida."
+
+def _summarize_messages(client, model_name, previous_summary, messages):
+    """Actualiza el resumen de la conversación con los mensajes nuevos (resumen incremental)."""
+    transcript = "\n".join(
+        f"{'Usuario' if msg['role'] == 'user' else 'Coach'}: {msg['content']}" for msg in messages
+    )
+    max_words = PERFORMANCE_CONFIG.get("chat_summary_max_words", 200)
+    prompt = f"""
+    Actualiza el resumen de una sesión de coaching. Conserva el rol del usuario, el tema elegido,
+    el modo (simulación o caso real), los escenarios planteados, las puntuaciones asignadas y los
+    compromisos o dudas pendientes. Máximo {max_words} palabras.
+    
+    RESUMEN ACTUAL:
+    {previous_summary or "(vacío)"}
     
+    NUEVOS MENSAJES:
+    {transcript}
+    
+    Responde ÚNICAMENTE con el resumen actualizado.
+    """
+    with llm_telemetry.track("chat_summary", model_name) as call:
+        response = llm_scheduler.run(
+            lambda: client.models.generate_content(model=model_name, contents=prompt),
+            PRIORITY_INTERACTIVE, _request_tokens(prompt), on_retry=call.record_retry
+        )
+        call.observe(response)
+    return (response.text or "").strip()
+
+def budget_chat_history(client, model_name, history, system_instruction, knowledge_context, summary_state):
+    """Ajusta el historial al presupuesto de tokens del chat.
+
+    Si historial + prompt de sistema + base de conocimiento superan el presupuesto, los
+    mensajes antiguos se sustituyen por un resumen acumulado guardado en summary_state
+    ({"text", "covered"}), manteniendo literales los últimos mensajes. El resumen solo se
+    amplía con los mensajes que han salido de la ventana, y por lotes.
+    """
+    budget = PERFORMANCE_CONFIG.get("chat_token_budget", 12000)
+    fixed_tokens = estimate_tokens(system_instruction) + estimate_tokens(knowledge_context)
+    history_tokens = sum(estimate_tokens(msg["content"]) for msg in history)
+    if summary_state is None or fixed_tokens + history_tokens <= budget:
+        return history
+
+    keep = PERFORMANCE_CONFIG.get("chat_keep_recent_messages", 6)
+    batch = PERFORMANCE_CONFIG.get("chat_summary_batch_messages", 6)
+    window_start = max(len(history) - keep, 0)
+    covered = min(summary_state.get("covered", 0), window_start)
+    pending = history[covered:window_start]
+
+    if len(pending) >= batch:
+        try:
+            summary_state["text"] = _summarize_messages(client, model_name, summary_state.get("text", ""), pending)
+            summary_state["covered"] = covered = window_start
+        except Exception as e:
+            print(f"Error resumiendo el historial del chat: {e}")
+
+    # Mensajes aún no resumidos (menos de un lote) se envían literalmente
+    recent = [dict(msg) for msg in history[covered:]]
+    if summary_state.get("text") and recent:
+        prefix = f"[Resumen de la conversación anterior]\n{summary_state['text']}"
+        if recent[0]["role"] == "user":
+            recent[0]["content"] = f"{prefix}\n\n{recent[0]['content']}"
+        else:
+            recent.insert(0, {"role": "user", "content": prefix})
+    return recent
+
+def _build_chat_request(client, history, system_instruction, knowledge_context, summary_state=None):
+    """Construye el modelo, historial y configuración de una petición de chat."""
     model_name = CLIENT_CONFIG.get("ai_model", "gemini-2.0-flash")
+    history = budget_chat_history(client, model_name, history, system_instruction, knowledge_context, summary_state)
     
-    full_prompt = f"Instrucción del sistema: {system_instruction}\n\nInformación de Contexto (Base de Conocimiento):\n{knowledge_context}\n\nUsuario: {user_input}"
     # Construir historial estructurado para Gemini
     contents = []
     for msg in history:
@@ -196,136 +483,496 @@ def get_chat_response(history, user_input, system_instruction, knowledge_context
             )
         )
     
-    full_system_instruction = f"{system_instruction}\n\nInformación de Contexto (Base de Conocimiento):\n{knowledge_context}"
+    # Con caché de contexto, el prompt de sistema y la base de conocimiento ya están en Gemini
+    cache_name = get_cached_context(client, model_name, "chat", knowledge_context, system_instruction)
+    if cache_name:
+        generation_config = types.GenerateContentConfig(cached_content=cache_name)
+    else:
+        full_system_instruction = f"{system_instruction}\n\nInformación de Contexto (Base de Conocimiento):\n{knowledge_context}"
+        generation_config = types.GenerateContentConfig(system_instruction=full_system_instruction)
+    return model_name, contents, generation_config
+
+def get_chat_response(history, user_input, system_instruction, knowledge_context="", summary_state=None):
+    """Obtiene respuesta del chat de Gemini."""
+    client = init_gemini()
+    if not client:
+        return CHAT_DEMO_MESSAGE
+    
+    model_name, contents, generation_config = _build_chat_request(client, history, system_instruction, knowledge_context, summary_state)
+    
+    tokens = _request_tokens(system_instruction, knowledge_context, *(msg["content"] for msg in history))
     
     try:
-        response = client.models.generate_content(
-            model=model_name,
-            contents=contents,
-            config=types.GenerateContentConfig(
-                system_instruction=full_system_instruction
+        with llm_telemetry.track("chat", model_name, context_cache=generation_config.cached_content) as call:
+            response = llm_scheduler.run(
+                lambda: client.models.generate_content(
+                    model=model_name,
+                    contents=contents,
+                    config=generation_config
+                ),
+                PRIORITY_INTERACTIVE, tokens, on_retry=call.record_retry
             )
-        )
+            call.observe(response)
         return response.text
     except Exception as e:
-        return f"⚠️ **Error de conexión con la IA:** {e}.\n\nPor favor, verifica que tu API Key en `.streamlit/secrets.toml` sea correcta y válida."
+        return _chat_error_message(e)
+
+def stream_chat_response(history, user_input, system_instruction, knowledge_context="", summary_state=None):
+    """Variante en streaming de get_chat_response: genera los fragmentos de texto según llegan."""
+    client = init_gemini()
+    if not client:
+        yield CHAT_DEMO_MESSAGE
+        return
+    
+    model_name, contents, generation_config = _build_chat_request(client, history, system_instruction, knowledge_context, summary_state)
+    
+    tokens = _request_tokens(system_instruction, knowledge_context, *(msg["content"] for msg in history))
+    
+    received = False
+    try:
+        with llm_telemetry.track("chat", model_name, context_cache=generation_config.cached_content) as call:
+            for chunk in llm_scheduler.stream(
+                lambda: client.models.generate_content_stream(
+                    model=model_name,
+                    contents=contents,
+                    config=generation_config
+                ),
+                PRIORITY_INTERACTIVE, tokens, on_retry=call.record_retry
+            ):
+                call.observe(chunk)
+                if chunk.text:
+                    call.first_token()
+                    received = True
+                    yield chunk.text
+    except Exception as e:
+        # El error se muestra a continuación del texto ya recibido
+        yield ("\n\n" if received else "") + _chat_error_message(e)
+
+# Incrementar si cambian los prompts de resumen para invalidar los resúmenes guardados
+DIGEST_VERSION = "v1"
+
+def _model_file_key(model_name):
+    """Nombre de modelo apto para un nombre de archivo ("models/..." o "tunedModels/..." llevan "/")."""
+    readable = "".join(c if c.isalnum() or c in "._-" else "_" for c in model_name)
+    return f"{readable}-{hashlib.sha256(model_name.encode('utf-8')).hexdigest()[:8]}"
+
+def _digest_cache_path(model_name, sha):
+    return os.path.join(PERFORMANCE_CONFIG["extraction_cache_folder"], f"digest-{DIGEST_VERSION}-{_model_file_key(model_name)}-{sha}.json")
+
+def _read_digest(model_name, sha):
+    path = _digest_cache_path(model_name, sha)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            digest = json.load(f)["digest"]
+        # La carpeta se poda por antigüedad de uso (knowledge.prune_cache): un resumen usado no debe caducar
+        os.utime(path)
+    except (OSError, ValueError, KeyError):
+        return None
+    return digest
+
+def _write_digest(model_name, sha, digest):
+    path = _digest_cache_path(model_name, sha)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"digest": digest}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"No se pudo guardar el resumen del documento: {e}")
+
+def _digest_call(client, model_name, prompt):
+    with llm_telemetry.track("digest", model_name) as call:
+        response = llm_scheduler.run(
+            lambda: client.models.generate_content(model=model_name, contents=prompt),
+            PRIORITY_BACKGROUND, _request_tokens(prompt), on_retry=call.record_retry
+        )
+        call.observe(response)
+    return (response.text or "").strip()
+
+def _summarize_part(client, model_name, name, part, number, total):
+    """Fase map: resumen de un documento o de una de sus partes."""
+    max_words = PERFORMANCE_CONFIG.get("digest_max_words", 150)
+    where = f"la parte {number} de {total} del documento" if total > 1 else "el documento"
+    prompt = f"""
+    Resume {where} "{name}" en un máximo de {max_words} palabras para catalogar material de formación.
+    Indica los temas principales, los conceptos y metodologías clave y el perfil profesional al que se dirige.
+    
+    CONTENIDO:
+    {part}
+    
+    Responde ÚNICAMENTE con el resumen.
+    """
+    return _digest_call(client, model_name, prompt)
+
+def _combine_summaries(client, model_name, name, summaries):
+    """Fase reduce: une los resúmenes de las partes de un documento grande."""
+    max_words = PERFORMANCE_CONFIG.get("digest_max_words", 150)
+    joined = "\n\n".join(f"Parte {i}: {summary}" for i, summary in enumerate(summaries, start=1))
+    prompt = f"""
+    Combina los resúmenes parciales del documento "{name}" en un único resumen de un máximo de {max_words} palabras.
+    Conserva los temas principales, los conceptos y metodologías clave y el perfil profesional al que se dirige.
+    
+    RESÚMENES PARCIALES:
+    {joined}
+    
+    Responde ÚNICAMENTE con el resumen.
+    """
+    return _digest_call(client, model_name, prompt)
+
+def build_document_digests(client, model_name, documents):
+    """Resumen breve de cada documento (map-reduce), guardado en disco por hash de contenido.
+
+    Los documentos cortos se usan tal cual; los largos se dividen en partes que se resumen
+    en paralelo y después se combinan. Devuelve una lista de (nombre, resumen) en el orden
+    de los documentos y si todos los resúmenes están completos (si alguno falla se usa el
+    principio del documento y el resultado no debe memorizarse).
+    """
+    part_chars = PERFORMANCE_CONFIG.get("digest_part_chars", 30000)
+    min_chars = PERFORMANCE_CONFIG.get("digest_min_chars", 1500)
+    digests = {}
+    complete = True
+    pending = {}  # nombre -> (sha, partes)
+    for document in documents:
+        text = "\n".join(document.pages).strip()
+        if len(text) <= min_chars:
+            digests[document.name] = text
+            continue
+        sha = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        cached = _read_digest(model_name, sha)
+        if cached:
+            digests[document.name] = cached
+        else:
+            pending[document.name] = (sha, split_text(text, part_chars, 0))
+
+    if pending:
+        # Todas las partes de todos los documentos se reparten en un único pool; el planificador limita la concurrencia
+        with ThreadPoolExecutor(max_workers=max(1, PERFORMANCE_CONFIG.get("digest_workers", 4))) as pool:
+            part_futures = {
+                name: [pool.submit(_summarize_part, client, model_name, name, part, i, len(parts))
+                       for i, part in enumerate(parts, start=1)]
+                for name, (_, parts) in pending.items()
+            }
+            done = {}  # nombre -> resumen
+            reduce_futures = {}
+            for name, futures in part_futures.items():
+                try:
+                    summaries = [future.result() for future in futures]
+                except Exception:
+                    continue
+                if len(summaries) == 1:
+                    done[name] = summaries[0]
+                else:
+                    reduce_futures[name] = pool.submit(_combine_summaries, client, model_name, name, summaries)
+            for name, future in reduce_futures.items():
+                try:
+                    done[name] = future.result()
+                except Exception:
+                    pass
+
+        for name, (sha, parts) in pending.items():
+            if done.get(name):
+                digests[name] = done[name]
+                _write_digest(model_name, sha, done[name])
+            else:
+                # Sin resumen (error ya registrado en la telemetría): se usa el principio del documento
+                digests[name] = parts[0][:min_chars]
+                complete = False
+
+    return [(document.name, digests[document.name]) for document in documents if digests.get(document.name)], complete
+
+# Parte mínima del presupuesto para el resumen de un documento; si no llega, se omiten documentos
+DIGEST_MIN_SHARE_CHARS = 200
+
+def render_digests(digests, token_budget=None):
+    """Texto de contexto con el resumen de cada documento, limitado a PERFORMANCE_CONFIG['digest_context_tokens'].
+
+    Si no caben todos, se recortan primero los resúmenes más largos (cada documento recibe
+    la misma parte del presupuesto) y, si ni así caben, se omiten los últimos documentos.
+    """
+    token_budget = token_budget or PERFORMANCE_CONFIG.get("digest_context_tokens", 30000)
+    max_chars = token_budget * 4  # Misma equivalencia que estimate_tokens
+    headers = [f"\n\n--- Resumen de {name} ---\n" for name, _ in digests]
+    if sum(map(len, headers)) + sum(len(digest) for _, digest in digests) <= max_chars:
+        return "".join(header + digest for header, (_, digest) in zip(headers, digests))
+
+    # Documentos que caben con al menos la parte mínima cada uno
+    kept, used = 0, 0
+    note_room = len(f"\n\n(Y {len(digests)} documentos más sin resumen por límite de tamaño.)")
+    for header in headers:
+        if used + len(header) + DIGEST_MIN_SHARE_CHARS + note_room > max_chars:
+            break
+        used += len(header) + DIGEST_MIN_SHARE_CHARS
+        kept += 1
+    omitted = len(digests) - kept
+    note = f"\n\n(Y {omitted} documentos más sin resumen por límite de tamaño.)" if omitted else ""
+
+    # Reparto equitativo: los resúmenes cortos se quedan enteros y el resto se recorta al mismo tope
+    available = max_chars - sum(map(len, headers[:kept])) - len(note)
+    lengths = sorted(len(digest) for _, digest in digests[:kept])
+    cap = None
+    for i, length in enumerate(lengths):
+        share = available // (kept - i)
+        if length > share:
+            cap = share
+            break
+        available -= length
+    parts = []
+    for header, (_, digest) in zip(headers[:kept], digests[:kept]):
+        if cap is not None and len(digest) > cap:
+            digest = digest[:max(cap - 1, 0)].rstrip() + "…"
+        parts.append(header + digest)
+    return "".join(parts) + note
+
+DEFAULT_ROLES = ("Principiante", "Intermedio", "Avanzado", "Experto")
+DEFAULT_TOPICS = ("Conocimiento General",)
 
-def generate_dynamic_roles(knowledge_context):
-    """Genera roles/niveles jerárquicos basados en el contenido."""
+def _discovery_sample(client, model_name, knowledge_context, digested):
+    """Contenido para descubrir roles y temas: los resúmenes completos o una muestra de la base."""
+    if digested:
+        return knowledge_context, None, "CONTENIDO (Resumen de cada documento)"
+    cache_name = get_cached_context(client, model_name, "kb", knowledge_context)
+    sample = "Ver la Base de Conocimiento adjunta en el contexto." if cache_name else knowledge_context[:50000]
+    return sample, cache_name, "CONTENIDO (Muestra)"
+
+def generate_dynamic_roles(knowledge_context, digested=False):
+    """Genera roles/niveles jerárquicos basados en el contenido (o en los resúmenes si `digested`)."""
     client = init_gemini()
     # Roles por defecto si falla la IA o no hay contenido
-    default_roles = ["Principiante", "Intermedio", "Avanzado", "Experto"]
+    default_roles = list(DEFAULT_ROLES)
     
     if not client or not knowledge_context.strip():
         return default_roles
 
     model_name = CLIENT_CONFIG.get("ai_model", "gemini-2.0-flash")
+    sample, cache_name, heading = _discovery_sample(client, model_name, knowledge_context, digested)
     
     prompt = f"""
     Analiza el siguiente contenido educativo y define 4 niveles o roles jerárquicos adecuados para un estudiante de este material.
     Los roles deben ser temáticos y específicos al contenido proporcionado.
     Deben ir de menor a mayor experiencia.
     
-    CONTENIDO (Muestra):
-    {knowledge_context[:50000]} 
+    {heading}:
+    {sample} 
     
     Responde ÚNICAMENTE con un JSON válido que sea una lista de 4 strings.
     Ejemplo: ["Aprendiz de Cocina", "Cocinero de Línea", "Sous Chef", "Chef Ejecutivo"]
     """
     
     try:
-        response = client.models.generate_content(
-            model=model_name,
-            contents=prompt,
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json"
-            )
-        )
-        roles = json.loads(response.text)
+        roles = _coalesced_json_call("roles", client, model_name, prompt, cache_name)
         if isinstance(roles, list) and len(roles) > 0:
             return roles
         return default_roles
-    except Exception as e:
-        print(f"Error generando roles dinámicos: {e}")
+    except Exception:
         return default_roles
 
-def generate_dynamic_topics(knowledge_context):
-    """Genera temas de examen basados en el contenido."""
+def generate_dynamic_topics(knowledge_context, digested=False):
+    """Genera temas de examen basados en el contenido (o en los resúmenes si `digested`)."""
     client = init_gemini()
-    default_topics = ["Conocimiento General"]
+    default_topics = list(DEFAULT_TOPICS)
     
     if not client or not knowledge_context.strip():
         return default_topics
 
     model_name = CLIENT_CONFIG.get("ai_model", "gemini-2.0-flash")
+    sample, cache_name, heading = _discovery_sample(client, model_name, knowledge_context, digested)
     
     prompt = f"""
     Analiza el siguiente contenido educativo y extrae una lista de 5 a 8 temas principales sobre los que se podría evaluar al usuario.
     Los temas deben ser breves, descriptivos y cubrir diferentes aspectos del contenido.
     
-    CONTENIDO (Muestra):
-    {knowledge_context[:50000]} 
+    {heading}:
+    {sample} 
     
     Responde ÚNICAMENTE con un JSON válido que sea una lista de strings.
     Ejemplo: ["Historia", "Conceptos Básicos", "Metodología", "Casos de Uso"]
     """
     
     try:
-        response = client.models.generate_content(
-            model=model_name,
-            contents=prompt,
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json"
-            )
-        )
-        topics = json.loads(response.text)
+        topics = _coalesced_json_call("topics", client, model_name, prompt, cache_name)
         if isinstance(topics, list) and len(topics) > 0:
             return topics
         return default_topics
-    except Exception as e:
-        print(f"Error generando temas dinámicos: {e}")
+    except Exception:
         return default_topics
 
-def calculate_roi_metrics(time_saved_per_interaction, cost_per_hour, participation_threshold=10):
-    """Calcula las métricas de ROI basado en la fórmula de Olivia España."""
-    data = {}
-    try:
-        if GSheetsConnection:
-            conn = st.connection("gsheets", type=GSheetsConnection)
-            df = conn.read(worksheet="Users", ttl=0)
-            
-            url = None
-            try:
-                url = st.secrets["connections"]["gsheets"]["spreadsheet"]
-            except Exception:
-                pass
-            
-            df = conn.read(spreadsheet=url, worksheet="Users", ttl=0) if url else conn.read(worksheet="Users", ttl=0)
-            
-            if not df.empty and "username" in df.columns:
-                data = df.set_index("username").to_dict(orient="index")
-    except Exception:
-        pass
+# Análisis de la base de conocimiento (roles y temas) memorizado por versión: versión -> (roles, temas).
+# Solo se conservan las versiones más recientes (con la recarga en caliente cada cambio crea una)
+_kb_analysis = OrderedDict()
+_kb_analysis_locks = {}
+_kb_analysis_lock = threading.Lock()
+# Versiones cuyo análisis es provisional (sobre el principio de la base) mientras se resumen los documentos
+_kb_analysis_provisional = set()
+_kb_digest_jobs = {}  # versión -> hilo que resume los documentos
+_kb_digest_retry_at = {}  # versión -> momento a partir del cual reintentar tras un resumen fallido
 
-    if not data:
+def _analysis_cache_path(kb_version):
+    model_name = CLIENT_CONFIG.get("ai_model", "gemini-2.0-flash")
+    return os.path.join(PERFORMANCE_CONFIG["extraction_cache_folder"], f"analysis-{_model_file_key(model_name)}-{kb_version}.json")
+
+def _read_kb_analysis(kb_version):
+    try:
+        with open(_analysis_cache_path(kb_version), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return data["roles"], data["topics"]
+    except (OSError, ValueError, KeyError):
         return None
 
-    # Excluir admin del cálculo para medir solo usuarios reales
-    users = [u for k, u in data.items() if k != 'admin']
-    N = len(users)
-    
+def _write_kb_analysis(kb_version, roles, topics):
+    path = _analysis_cache_path(kb_version)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"roles": roles, "topics": topics}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"No se pudo guardar el análisis de la base de conocimiento: {e}")
+
+def _remember_analysis(kb_version, analysis):
+    """Memoriza el análisis de una versión y olvida las menos recientes (con el cerrojo global tomado)."""
+    _kb_analysis[kb_version] = analysis
+    _kb_analysis.move_to_end(kb_version)
+    while len(_kb_analysis) > PERFORMANCE_CONFIG.get("kb_analysis_max_versions", 4):
+        old_version, _ = _kb_analysis.popitem(last=False)
+        _kb_analysis_provisional.discard(old_version)
+        _kb_digest_retry_at.pop(old_version, None)
+
+def _discover(knowledge_context, digested=False):
+    """Lanza en paralelo las llamadas de roles y temas. Devuelve (roles, temas, ok)."""
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        roles_future = pool.submit(generate_dynamic_roles, knowledge_context, digested)
+        topics_future = pool.submit(generate_dynamic_topics, knowledge_context, digested)
+        roles, topics = roles_future.result(), topics_future.result()
+    # Los valores por defecto indican un fallo
+    return roles, topics, roles != list(DEFAULT_ROLES) and topics != list(DEFAULT_TOPICS)
+
+def _digest_job(client, kb_version, documents):
+    """Resume los documentos y repite el análisis sobre los resúmenes (en segundo plano)."""
+    ok = False
+    try:
+        model_name = CLIENT_CONFIG.get("ai_model", "gemini-2.0-flash")
+        digests, complete = build_document_digests(client, model_name, documents)
+        roles, topics, ok = _discover(render_digests(digests), digested=True)
+        # Con algún resumen sustituido por el principio del documento el análisis no es definitivo
+        ok = ok and complete
+    except Exception as e:
+        print(f"Error resumiendo la base de conocimiento {kb_version}: {e}")
+    with _kb_analysis_lock:
+        _kb_digest_jobs.pop(kb_version, None)
+        if ok:
+            _remember_analysis(kb_version, (roles, topics))
+            _kb_analysis_provisional.discard(kb_version)
+            _kb_digest_retry_at.pop(kb_version, None)
+        else:
+            _kb_digest_retry_at[kb_version] = time.time() + PERFORMANCE_CONFIG.get("digest_retry_seconds", 120)
+    if ok:
+        _write_kb_analysis(kb_version, roles, topics)
+
+def _start_digest_job(client, kb_version, documents):
+    """Lanza el resumen de los documentos si no está en marcha (con el cerrojo global tomado)."""
+    if kb_version in _kb_digest_jobs or _kb_digest_retry_at.get(kb_version, 0) > time.time():
+        return
+    thread = threading.Thread(target=_digest_job, args=(client, kb_version, documents),
+                              name=f"kb-digest:{kb_version}", daemon=True)
+    _kb_digest_jobs[kb_version] = thread
+    thread.start()
+
+def kb_analysis_pending(kb_version):
+    """True mientras el análisis de la versión es provisional (los resúmenes aún no están listos)."""
+    with _kb_analysis_lock:
+        return kb_version in _kb_analysis_provisional
+
+def analyze_knowledge_base(knowledge_context, kb_version, documents=()):
+    """Obtiene roles y temas de la base de conocimiento, una sola vez por versión.
+
+    Si se pasan los documentos, el análisis definitivo se hace sobre el resumen de cada
+    uno (build_document_digests), que se calcula en segundo plano: mientras tanto se
+    devuelve un análisis provisional sobre el principio de la base (kb_analysis_pending).
+    Ambas llamadas a Gemini se lanzan en paralelo y el resultado definitivo se memoriza
+    en memoria y en disco, de modo que solo la primera sesión de cada versión espera.
+    """
+    if not knowledge_context.strip():
+        return list(DEFAULT_ROLES), list(DEFAULT_TOPICS)
+
+    # Un cerrojo por versión: las sesiones que piden la misma versión esperan al primer análisis
+    with _kb_analysis_lock:
+        version_lock = _kb_analysis_locks.setdefault(kb_version, threading.Lock())
+
+    try:
+        with version_lock:
+            return _analyze_locked(knowledge_context, kb_version, documents)
+    finally:
+        # El análisis ya está memorizado (o ha fallado): el cerrojo de la versión no hace falta
+        with _kb_analysis_lock:
+            if _kb_analysis_locks.get(kb_version) is version_lock:
+                del _kb_analysis_locks[kb_version]
+
+def _analyze_locked(knowledge_context, kb_version, documents):
+    digested = bool(documents) and PERFORMANCE_CONFIG.get("digest_enabled", True)
+    with _kb_analysis_lock:
+        cached = _kb_analysis.get(kb_version)
+        provisional = kb_version in _kb_analysis_provisional
+        if cached:
+            _kb_analysis.move_to_end(kb_version)
+    if cached and provisional:
+        # Reintentar los resúmenes si el intento anterior falló
+        client = init_gemini()
+        if client:
+            with _kb_analysis_lock:
+                _start_digest_job(client, kb_version, documents)
+        return cached
+    cached = cached or _read_kb_analysis(kb_version)
+    if cached:
+        with _kb_analysis_lock:
+            _remember_analysis(kb_version, cached)
+        return cached
+
+    # Comprobar el cliente en el hilo del script, donde st.error es visible
+    client = init_gemini()
+    if not client:
+        return list(DEFAULT_ROLES), list(DEFAULT_TOPICS)
+
+    if digested:
+        with _kb_analysis_lock:
+            running = kb_version in _kb_digest_jobs
+            _kb_analysis_provisional.add(kb_version)
+            _start_digest_job(client, kb_version, documents)
+        if running:
+            # El análisis provisional ya falló y los resúmenes siguen en marcha
+            return list(DEFAULT_ROLES), list(DEFAULT_TOPICS)
+
+    roles, topics, ok = _discover(knowledge_context)
+    if ok:
+        with _kb_analysis_lock:
+            # El hilo de resúmenes puede haber terminado antes: su resultado prevalece
+            if not (digested and kb_version not in _kb_analysis_provisional):
+                _remember_analysis(kb_version, (roles, topics))
+            roles, topics = _kb_analysis.get(kb_version, (roles, topics))
+        if not digested:
+            _write_kb_analysis(kb_version, roles, topics)
+    return roles, topics
+
+def _numeric_column(df, column):
+    """Columna numérica como array float (NaN si falta o no es numérico), 0 si no existe."""
+    import numpy as np
+    import pandas as pd
+    if column not in df.columns:
+        return np.zeros(len(df))
+    return pd.to_numeric(df[column], errors="coerce").to_numpy(dtype=float)
+
+def _roi_from_aggregates(N, n_active, sum_sessions, sum_belt_idx, time_saved_per_interaction, cost_per_hour):
+    """Aplica la fórmula de ROI a los agregados de usuarios (sin admin)."""
     if N == 0:
         return {"N": 0, "P": 0, "F": 0, "AH_op": 0, "Me": 1.0, "Total_Value": 0.0, "active_count": 0}
 
-    # P: Tasa de participación (usuarios con >= 10 usos)
-    # Usamos 'active_sessions' como métrica de uso
-    active_users = [u for u in users if u.get("active_sessions", 0) >= participation_threshold]
-    n_active = len(active_users)
+    # P: Tasa de participación (usuarios con >= umbral de usos)
     P = n_active / N
     
     # F: Frecuencia media (de los usuarios activos)
     if n_active > 0:
-        avg_freq = sum(u.get("active_sessions", 0) for u in active_users) / n_active
+        avg_freq = float(sum_sessions) / n_active
     else:
         avg_freq = 0
         
@@ -333,29 +980,11 @@ def calculate_roi_metrics(time_saved_per_interaction, cost_per_hour, participati
     AH_op = (N * P) * (avg_freq * time_saved_per_interaction)
     
     # Me: Multiplicador de Evolución
-    # Promedio del multiplicador de los usuarios activos
+    # Promedio de 1 + (Nivel Actual - 1) / Nivel Máximo sobre los usuarios activos.
+    # La suma de índices es entera, así que solo se redondea en la división final.
     max_level_idx = len(BELTS) - 1
     if max_level_idx < 1: max_level_idx = 1
-    
-    sum_me = 0
-    if n_active > 0:
-        for u in active_users:
-            score = u.get("score", 0)
-            # Encontrar índice del cinturón (0 a 6)
-            idx = 0
-            for i, belt in enumerate(BELTS):
-                if score >= belt["threshold"]:
-                    idx = i
-                else:
-                    break
-            
-            # Fórmula: 1 + (Nivel Actual - 1) / Nivel Máximo
-            # Dado que idx es base 0, equivale a (Nivel Actual - 1)
-            me_user = 1 + (idx / max_level_idx)
-            sum_me += me_user
-        Me = sum_me / n_active
-    else:
-        Me = 1.0
+    Me = 1 + int(sum_belt_idx) / (max_level_idx * n_active) if n_active > 0 else 1.0
         
     # Valor Total
     total_value = (AH_op * Me) * cost_per_hour
@@ -368,4 +997,140 @@ def calculate_roi_metrics(time_saved_per_interaction, cost_per_hour, participati
         "Me": Me,
         "Total_Value": total_value,
         "active_count": n_active
-    }
\ No newline at end of file
+    }
+
+def compute_roi_metrics(users_df, time_saved_per_interaction, cost_per_hour, participation_threshold=10):
+    """Calcula las métricas de ROI de forma vectorizada sobre un DataFrame indexado por usuario."""
+    import numpy as np
+
+    # Excluir admin del cálculo para medir solo usuarios reales
+    users = users_df[users_df.index != 'admin']
+    sessions = _numeric_column(users, "active_sessions")
+    # Puntuaciones como storage._to_int (lo mismo que belt_index): se truncan y lo no numérico cuenta como 0
+    scores = np.nan_to_num(np.trunc(_numeric_column(users, "score")), nan=0.0, posinf=0.0, neginf=0.0)
+
+    # Usamos 'active_sessions' como métrica de uso (NaN nunca cuenta como activo)
+    active = sessions >= participation_threshold
+    n_active = int(np.count_nonzero(active))
+
+    # Índice del cinturón (0 a 6): último umbral <= puntuación. Negativos -> 0
+    thresholds = np.array([belt["threshold"] for belt in BELTS])
+    idx = np.clip(np.searchsorted(thresholds, scores[active], side="right") - 1, 0, None)
+
+    return _roi_from_aggregates(len(users), n_active, sessions[active].sum(), idx.sum(),
+                                time_saved_per_interaction, cost_per_hour)
+
+def belt_index(score):
+    """Índice (0 a 6) del cinturón correspondiente a una puntuación (texto de Sheets incluido; 0 si no es numérica)."""
+    score = _to_int(score)
+    idx = 0
+    for i, belt in enumerate(BELTS):
+        if score >= belt["threshold"]:
+            idx = i
+        else:
+            break
+    return idx
+
+class RoiAggregates:
+    """Agregados de ROI mantenidos de forma incremental a medida que cambia el progreso.
+
+    Guarda un histograma por número de sesiones y, para cada umbral de participación
+    consultado, los totales acumulados (usuarios activos, suma de sesiones y suma de
+    índices de cinturón). Cada cambio de un usuario actualiza esos totales en tiempo
+    constante por umbral, y el dashboard solo aplica la fórmula.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}  # usuario -> (sesiones o None, índice de cinturón)
+        self._histogram = {}  # sesiones -> [usuarios, suma de índices de cinturón]
+        self._by_threshold = {}  # umbral -> [activos, suma de sesiones, suma de índices]
+        self._has_rows = False
+        self.ready = False
+
+    @staticmethod
+    def _state(sessions, score):
+        try:
+            sessions = float(sessions)
+        except (TypeError, ValueError):
+            sessions = None
+        if sessions is not None and sessions != sessions:  # NaN
+            sessions = None
+        return sessions, belt_index(score)
+
+    def _add(self, state, sign):
+        sessions, idx = state
+        if sessions is None:
+            return
+        bucket = self._histogram.setdefault(sessions, [0, 0])
+        bucket[0] += sign
+        bucket[1] += sign * idx
+        if bucket[0] == 0:
+            del self._histogram[sessions]
+        for threshold, totals in self._by_threshold.items():
+            if sessions >= threshold:
+                totals[0] += sign
+                totals[1] += sign * sessions
+                totals[2] += sign * idx
+
+    def rebuild(self, users):
+        """Recalcula todos los agregados a partir de la tabla completa {usuario: fila}."""
+        with self._lock:
+            self._users = {}
+            self._histogram = {}
+            self._by_threshold = {}
+            self._has_rows = bool(users)
+            for username, user in users.items():
+                if username == 'admin':
+                    continue
+                state = self._state(user.get("active_sessions", 0), user.get("score", 0))
+                self._users[username] = state
+                self._add(state, 1)
+            self.ready = True
+
+    def update(self, username, active_sessions, score):
+        """Sustituye el estado de un usuario y ajusta los agregados."""
+        if username == 'admin':
+            return
+        with self._lock:
+            old = self._users.get(username)
+            if old is not None:
+                self._add(old, -1)
+            new = self._state(active_sessions, score)
+            self._users[username] = new
+            self._add(new, 1)
+            self._has_rows = True
+
+    def metrics(self, time_saved_per_interaction, cost_per_hour, participation_threshold=10):
+        """Métricas de ROI a partir de los agregados; None si no hay usuarios."""
+        with self._lock:
+            if not self._has_rows:
+                return None
+            totals = self._by_threshold.get(participation_threshold)
+            if totals is None:
+                # Primer uso de este umbral: se suma el histograma (valores distintos de sesiones)
+                totals = [0, 0, 0]
+                for sessions, (count, idx_sum) in self._histogram.items():
+                    if sessions >= participation_threshold:
+                        totals[0] += count
+                        totals[1] += count * sessions
+                        totals[2] += idx_sum
+                if len(self._by_threshold) >= 64:
+                    self._by_threshold.clear()
+                self._by_threshold[participation_threshold] = totals
+            n_active, sum_sessions, sum_idx = totals
+            return _roi_from_aggregates(len(self._users), n_active, sum_sessions, sum_idx,
+                                        time_saved_per_interaction, cost_per_hour)
+
+def calculate_roi_metrics(time_saved_per_interaction, cost_per_hour, participation_threshold=10, store=None):
+    """Calcula las métricas de ROI basado en la fórmula de Olivia España (store: almacenamiento del cliente)."""
+    users_df = None
+    try:
+        users_df = (store or get_user_store()).load_users_frame()
+    except Exception:
+        pass
+
+    if users_df is None or users_df.empty:
+        return None
+
+    return compute_roi_metrics(users_df, time_saved_per_interaction, cost_per_hour, participation_threshold)
@@ -0,0 +1,157 @@
+import hashlib
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from config import PERFORMANCE_CONFIG
+from logic import gemini_available, generate_quiz_questions
+from scheduler import PRIORITY_BACKGROUND
+
+
+def question_fingerprint(question):
+    """Huella normalizada de una pregunta para detectar repeticiones."""
+    text = " ".join(str(question.get("question", "")).lower().split())
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def validate_questions(questions):
+    """Devuelve solo las preguntas bien formadas (opciones y respuesta incluida en ellas)."""
+    if not isinstance(questions, list):
+        return []
+    valid = []
+    for q in questions:
+        if not isinstance(q, dict):
+            continue
+        options = q.get("options")
+        if (isinstance(q.get("question"), str) and q["question"].strip()
+                and isinstance(options, list) and len(options) >= 2
+                and q.get("answer") in options):
+            valid.append(q)
+    return valid
+
+
+class QuizBank:
+    """Banco de tests pregenerados por (versión de la base, tema, dificultad, rol).
+
+    Un hilo en segundo plano rellena cada reserva cuando baja del mínimo, de modo que
+    empezar un test es sacar un elemento de una cola. Mientras el usuario solo cambia la
+    selección se prepara un único test por combinación; la reserva completa se genera
+    cuando esa combinación se usa de verdad. Si la reserva está vacía, la app genera el
+    test en directo como antes.
+    """
+
+    def __init__(self, generate=generate_quiz_questions):
+        self._generate = generate
+        self._pools = OrderedDict()  # clave -> deque de tests
+        self._fingerprints = {}  # clave -> huellas de las preguntas ya en reserva
+        self._contexts = {}  # clave -> contexto de conocimiento para generar
+        self._targets = {}  # clave -> tests que debe tener la reserva
+        self._pending = set()
+        self._failures = {}  # clave -> instante del último fallo
+        self._jobs = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = []
+        self.stats = {"hits": 0, "misses": 0, "generated": 0, "discarded": 0}
+
+    def _ensure_workers(self):
+        if self._workers:
+            return
+        for i in range(max(1, PERFORMANCE_CONFIG.get("quiz_bank_workers", 1))):
+            worker = threading.Thread(target=self._run, name=f"quiz-bank-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _pool(self, key):
+        """Reserva de una clave, descartando las menos usadas si se supera el máximo."""
+        if key not in self._pools:
+            self._pools[key] = deque()
+            self._fingerprints[key] = set()
+            while len(self._pools) > PERFORMANCE_CONFIG.get("quiz_bank_max_keys", 64):
+                old_key, _ = self._pools.popitem(last=False)
+                self._fingerprints.pop(old_key, None)
+                self._contexts.pop(old_key, None)
+                self._targets.pop(old_key, None)
+        self._pools.move_to_end(key)
+        return self._pools[key]
+
+    def prefetch(self, key, knowledge_context="", size=1):
+        """Programa el relleno de la reserva hasta `size` tests si está por debajo del mínimo.
+
+        Por defecto basta un test: la selección del usuario cambia a menudo y no merece
+        generar la reserva completa de cada combinación que solo se ha mirado.
+        """
+        if not PERFORMANCE_CONFIG.get("quiz_bank_enabled") or not gemini_available():
+            return
+        with self._lock:
+            self._contexts[key] = knowledge_context
+            pool = self._pool(key)
+            target = self._targets[key] = max(self._targets.get(key, 1), size)
+            if len(pool) >= target or len(pool) > PERFORMANCE_CONFIG.get("quiz_bank_low_water", 1) or key in self._pending:
+                return
+            if time.time() - self._failures.get(key, 0) < PERFORMANCE_CONFIG.get("quiz_bank_retry_seconds", 30):
+                return
+            self._pending.add(key)
+        self._ensure_workers()
+        self._jobs.put(key)
+
+    def pop(self, key, seen=(), knowledge_context=""):
+        """Saca un test de la reserva evitando preguntas ya vistas; None si no hay ninguno."""
+        questions = None
+        with self._lock:
+            pool = self._pool(key)
+            for i, candidate in enumerate(pool):
+                if not any(question_fingerprint(q) in seen for q in candidate):
+                    del pool[i]
+                    questions = candidate
+                    self._fingerprints[key].difference_update(question_fingerprint(q) for q in candidate)
+                    break
+            self.stats["hits" if questions else "misses"] += 1
+        # La combinación se está usando: completar la reserva mientras el usuario responde
+        self.prefetch(key, knowledge_context, size=PERFORMANCE_CONFIG.get("quiz_bank_target_size", 3))
+        return questions
+
+    def _run(self):
+        while True:
+            key = self._jobs.get()
+            try:
+                self._refill(key)
+            except Exception as e:
+                print(f"Error rellenando el banco de tests: {e}")
+                with self._lock:
+                    self._failures[key] = time.time()
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+
+    def _refill(self, key):
+        _, topic, difficulty, role = key
+        min_questions = PERFORMANCE_CONFIG.get("quiz_bank_min_questions", 3)
+        while True:
+            with self._lock:
+                if key not in self._pools or len(self._pools[key]) >= self._targets.get(key, 1):
+                    return
+                knowledge_context = self._contexts.get(key, "")
+
+            questions = validate_questions(self._generate(topic, difficulty, role, knowledge_context, priority=PRIORITY_BACKGROUND))
+
+            with self._lock:
+                if key not in self._pools:
+                    return
+                # Descartar preguntas repetidas respecto a las que ya hay en reserva
+                fingerprints = self._fingerprints[key]
+                unique = []
+                for q in questions:
+                    fp = question_fingerprint(q)
+                    if fp not in fingerprints:
+                        fingerprints.add(fp)
+                        unique.append(q)
+                if len(unique) < min_questions:
+                    fingerprints.difference_update(question_fingerprint(q) for q in unique)
+                    self.stats["discarded"] += 1
+                    self._failures[key] = time.time()
+                    return
+                self._pools[key].append(unique)
+                self.stats["generated"] += 1
+
+
+quiz_bank = QuizBank()
@@ -0,0 +1,180 @@
+import hashlib
+import math
+import threading
+import time
+from collections import Counter, OrderedDict
+from config import PERFORMANCE_CONFIG
+from logic import CHAT_DEMO_MESSAGE, CHAT_ERROR_PREFIX
+from retrieval import tokenize, words
+
+
+# Palabras que invierten o cambian el sentido de una pregunta: nunca se descartan y
+# dos mensajes solo se consideran paráfrasis si contienen las mismas
+NEGATIONS = frozenset("no ni sin nunca jamas tampoco nada nadie ninguno ninguna excepto salvo not without never".split())
+
+
+def normalize_message(text):
+    """Normaliza un mensaje para la coincidencia exacta (minúsculas, sin tildes, puntuación ni espacios extra)."""
+    return " ".join(words(text))
+
+
+def semantic_terms(text):
+    """Términos para el nivel semántico: sin palabras vacías, pero conservando las negaciones."""
+    return tokenize(text, keep=NEGATIONS)
+
+
+class ChatResponseCache:
+    """Caché de respuestas del chat en dos niveles.
+
+    - Exacto: LRU con TTL por mensaje normalizado + versión de la base + cola del historial.
+    - Semántico: encuentra paráfrasis por similitud coseno TF-IDF dentro del mismo contexto.
+
+    Las conversaciones ya avanzadas (flujo de coaching en curso) no usan la caché.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._exact = OrderedDict()  # clave -> (respuesta, caduca_en)
+        self._semantic = OrderedDict()  # id -> {"scope", "tf", "negations", "response", "expires_at"}
+        self._postings = {}  # término -> ids de entradas semánticas que lo contienen
+        self._doc_freq = Counter()
+        self._next_id = 0
+        self.stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "bypassed": 0}
+
+    # --- Claves y ámbito ---
+
+    @staticmethod
+    def _scope(history, kb_version):
+        """Ámbito de la entrada: versión de la base y los últimos mensajes del historial."""
+        tail = history[-PERFORMANCE_CONFIG.get("chat_cache_history_tail", 2):] if history else []
+        digest = hashlib.sha1(kb_version.encode("utf-8"))
+        for msg in tail:
+            digest.update(f"\0{msg['role']}\0{normalize_message(msg['content'])}".encode("utf-8"))
+        return digest.hexdigest()
+
+    @staticmethod
+    def should_bypass(history):
+        """True si la conversación ya está en mitad de un flujo de coaching."""
+        if not PERFORMANCE_CONFIG.get("chat_cache_enabled"):
+            return True
+        user_turns = sum(1 for msg in history if msg["role"] == "user")
+        return user_turns >= PERFORMANCE_CONFIG.get("chat_cache_bypass_after_turns", 2)
+
+    # --- Nivel semántico (TF-IDF) ---
+
+    def _idf(self, term):
+        n = len(self._semantic)
+        return math.log((1 + n) / (1 + self._doc_freq.get(term, 0))) + 1
+
+    def _weights(self, tf):
+        weights = {term: freq * self._idf(term) for term, freq in tf.items()}
+        norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+        return {term: w / norm for term, w in weights.items()}
+
+    def _remove_semantic(self, entry_id):
+        entry = self._semantic.pop(entry_id)
+        for term in entry["tf"]:
+            self._doc_freq[term] -= 1
+            if self._doc_freq[term] <= 0:
+                del self._doc_freq[term]
+            ids = self._postings.get(term)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self._postings[term]
+
+    def _semantic_lookup(self, scope, tf, now):
+        query = self._weights(tf)
+        negations = NEGATIONS.intersection(tf)
+        candidates = set()
+        for term in tf:
+            candidates.update(self._postings.get(term, ()))
+
+        best_id, best_score = None, 0.0
+        for entry_id in candidates:
+            entry = self._semantic[entry_id]
+            if entry["scope"] != scope or entry["expires_at"] < now or entry["negations"] != negations:
+                continue
+            vector = self._weights(entry["tf"])
+            score = sum(weight * vector.get(term, 0.0) for term, weight in query.items())
+            if score > best_score:
+                best_id, best_score = entry_id, score
+
+        if best_id is not None and best_score >= PERFORMANCE_CONFIG.get("chat_cache_semantic_threshold", 0.85):
+            self._semantic.move_to_end(best_id)
+            return self._semantic[best_id]["response"]
+        return None
+
+    # --- API pública ---
+
+    def get(self, message, history, kb_version):
+        """Devuelve la respuesta cacheada para el mensaje, o None."""
+        if self.should_bypass(history):
+            with self._lock:
+                self.stats["bypassed"] += 1
+            return None
+
+        scope = self._scope(history, kb_version)
+        key = (scope, normalize_message(message))
+        now = time.time()
+        with self._lock:
+            entry = self._exact.get(key)
+            if entry and entry[1] >= now:
+                self._exact.move_to_end(key)
+                self.stats["exact_hits"] += 1
+                return entry[0]
+            if entry:
+                del self._exact[key]
+
+            tf = Counter(semantic_terms(message))
+            response = self._semantic_lookup(scope, tf, now) if tf else None
+            if response is not None:
+                self.stats["semantic_hits"] += 1
+                return response
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, message, history, kb_version, response):
+        """Guarda una respuesta válida (no se cachean errores ni el modo demostración)."""
+        if self.should_bypass(history) or not isinstance(response, str) or not response.strip():
+            return
+        if response == CHAT_DEMO_MESSAGE or CHAT_ERROR_PREFIX in response:
+            return
+
+        scope = self._scope(history, kb_version)
+        max_entries = PERFORMANCE_CONFIG.get("chat_cache_max_entries", 512)
+        expires_at = time.time() + PERFORMANCE_CONFIG.get("chat_cache_ttl_seconds", 3600)
+        tf = Counter(semantic_terms(message))
+        with self._lock:
+            key = (scope, normalize_message(message))
+            self._exact[key] = (response, expires_at)
+            self._exact.move_to_end(key)
+            while len(self._exact) > max_entries:
+                self._exact.popitem(last=False)
+
+            if not tf:
+                return
+            entry_id = self._next_id
+            self._next_id += 1
+            self._semantic[entry_id] = {"scope": scope, "tf": tf, "negations": NEGATIONS.intersection(tf),
+                                        "response": response, "expires_at": expires_at}
+            for term in tf:
+                self._doc_freq[term] += 1
+                self._postings.setdefault(term, set()).add(entry_id)
+            while len(self._semantic) > max_entries:
+                self._remove_semantic(next(iter(self._semantic)))
+
+    def hit_rates(self):
+        """Tasa de aciertos por nivel sobre las consultas no omitidas."""
+        with self._lock:
+            lookups = self.stats["exact_hits"] + self.stats["semantic_hits"] + self.stats["misses"]
+            if not lookups:
+                return {"exact": 0.0, "semantic": 0.0, "total": 0.0}
+            return {
+                "exact": self.stats["exact_hits"] / lookups,
+                "semantic": self.stats["semantic_hits"] / lookups,
+                "total": (self.stats["exact_hits"] + self.stats["semantic_hits"]) / lookups,
+            }
+
+
+chat_cache = ChatResponseCache()
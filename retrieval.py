@@ -0,0 +1,188 @@
+import heapq
+import math
+import re
+import unicodedata
+from collections import Counter
+from dataclasses import dataclass
+
+# Palabras vacías más frecuentes (español/inglés) que no aportan a la relevancia
+STOPWORDS = frozenset("""
+a al algo como con de del el en es esta este esto la las lo los mas me mi no o para pero por que se si sin
+su sus te tu un una uno y ya the of and to in is it for on that this with are be as
+""".split())
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+@dataclass(frozen=True)
+class Chunk:
+    """Fragmento de la Base de Conocimiento con su procedencia (documento y página)."""
+    document: str
+    page: int  # 1-based; 0 si el documento no tiene páginas (texto plano)
+    text: str
+
+    @property
+    def source(self):
+        return f"{self.document}, pág. {self.page}" if self.page else self.document
+
+
+def estimate_tokens(text):
+    """Estimación rápida de tokens (~4 caracteres por token)."""
+    return len(text) // 4 + 1
+
+
+def fold_text(text):
+    """Minúsculas y sin tildes."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def words(text):
+    """Todas las palabras del texto normalizado, sin descartar ninguna."""
+    return _TOKEN_RE.findall(fold_text(text))
+
+
+def tokenize(text, keep=frozenset()):
+    """Normaliza (minúsculas, sin tildes) y separa en términos, descartando palabras vacías.
+
+    Las palabras de `keep` se conservan aunque sean vacías (por ejemplo, las negaciones).
+    """
+    return [t for t in words(text) if t in keep or (t not in STOPWORDS and len(t) > 1)]
+
+
+def split_text(text, chunk_chars, overlap_chars):
+    """Divide un texto en fragmentos solapados, cortando preferentemente en espacios."""
+    text = text.strip()
+    if len(text) <= chunk_chars:
+        return [text] if text else []
+
+    pieces = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_chars, len(text))
+        if end < len(text):
+            cut = text.rfind(" ", start + chunk_chars // 2, end)
+            if cut > start:
+                end = cut
+        pieces.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        # El siguiente fragmento empieza en un límite de palabra dentro del solapamiento
+        next_start = max(end - overlap_chars, start + 1)
+        space = text.find(" ", next_start, end)
+        start = space + 1 if space != -1 else next_start
+    return pieces
+
+
+def chunk_documents(documents, chunk_chars=1500, overlap_chars=200):
+    """Convierte los documentos (nombre, páginas) en fragmentos solapados con procedencia."""
+    chunks = []
+    for document in documents:
+        numbered = len(document.pages) > 1 or document.is_pdf
+        for page_number, page in enumerate(document.pages, start=1):
+            for piece in split_text(page, chunk_chars, overlap_chars):
+                chunks.append(Chunk(document.name, page_number if numbered else 0, piece))
+    return chunks
+
+
+class BM25Index:
+    """Índice invertido en memoria con ranking BM25 sobre los fragmentos."""
+
+    def __init__(self, chunks, k1=1.5, b=0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self.postings = {}  # término -> lista de (id de fragmento, frecuencia)
+        self.lengths = []
+        for chunk_id, chunk in enumerate(chunks):
+            terms = tokenize(chunk.text)
+            self.lengths.append(len(terms))
+            for term, freq in Counter(terms).items():
+                self.postings.setdefault(term, []).append((chunk_id, freq))
+        self._compute_stats()
+
+    def _compute_stats(self):
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+        n = len(self.chunks)
+        self.idf = {
+            term: math.log(1 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+            for term, plist in self.postings.items()
+        }
+
+    def updated(self, chunks):
+        """Nuevo índice para `chunks` que solo tokeniza los fragmentos que no estaban en este.
+
+        Los fragmentos conservados (mismo documento, página y texto) se recolocan a partir
+        de las listas invertidas actuales. El índice original no se modifica.
+        """
+        old_ids = {}
+        for chunk_id, chunk in enumerate(self.chunks):
+            old_ids.setdefault(chunk, chunk_id)
+
+        index = BM25Index([], self.k1, self.b)
+        index.chunks = chunks
+        new_ids = {}  # id en este índice -> ids en el nuevo
+        for chunk_id, chunk in enumerate(chunks):
+            old_id = old_ids.get(chunk)
+            if old_id is None:
+                continue
+            new_ids.setdefault(old_id, []).append(chunk_id)
+        index.lengths = [0] * len(chunks)
+        for old_id, ids in new_ids.items():
+            for chunk_id in ids:
+                index.lengths[chunk_id] = self.lengths[old_id]
+        for term, plist in self.postings.items():
+            moved = [(chunk_id, freq) for old_id, freq in plist for chunk_id in new_ids.get(old_id, ())]
+            if moved:
+                index.postings[term] = moved
+
+        for chunk_id, chunk in enumerate(chunks):
+            if chunk not in old_ids:
+                terms = tokenize(chunk.text)
+                index.lengths[chunk_id] = len(terms)
+                for term, freq in Counter(terms).items():
+                    index.postings.setdefault(term, []).append((chunk_id, freq))
+        index._compute_stats()
+        return index
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def search(self, query, top_k=8):
+        """Devuelve los (puntuación, fragmento) más relevantes para la consulta."""
+        scores = {}
+        avg_length = self.avg_length or 1.0
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for chunk_id, freq in self.postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[chunk_id] / avg_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * freq * (self.k1 + 1) / (freq + norm)
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+        return [(score, self.chunks[chunk_id]) for chunk_id, score in best]
+
+
+def format_chunks(chunks):
+    """Da formato de contexto a los fragmentos, indicando su procedencia."""
+    return "".join(f"\n\n--- Fragmento de {chunk.source} ---\n{chunk.text}" for chunk in chunks)
+
+
+def select_chunks(index, query, top_k=8, token_budget=6000):
+    """Selecciona los fragmentos más relevantes sin superar el presupuesto de tokens.
+
+    Si la consulta no coincide con ningún fragmento se usan los primeros de la base.
+    """
+    candidates = [chunk for _, chunk in index.search(query, top_k)] if query else []
+    if not candidates:
+        candidates = index.chunks[:top_k]
+
+    selected = []
+    used = 0
+    for chunk in candidates:
+        cost = estimate_tokens(chunk.text)
+        if used + cost > token_budget:
+            continue
+        selected.append(chunk)
+        used += cost
+    return selected
@@ -0,0 +1,205 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from collections import deque
+from config import PERFORMANCE_CONFIG
+from telemetry import percentile
+
+# Prioridades (menor = antes): el chat interactivo adelanta al trabajo en segundo plano
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BACKGROUND: "background"}
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+def error_status(error):
+    """Código HTTP de un error de google-genai (APIError.code) o de httpx, si lo tiene."""
+    for attr in ("code", "status_code"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(error, "response", None)
+    value = getattr(response, "status_code", None)
+    return value if isinstance(value, int) else None
+
+
+def is_rate_limit_error(error):
+    """True si Gemini ha rechazado la petición por cuota (429 / RESOURCE_EXHAUSTED)."""
+    return error_status(error) == 429 or "RESOURCE_EXHAUSTED" in str(error)
+
+
+def is_retryable(error):
+    """Errores transitorios: cuota, sobrecarga del servidor, timeouts y cortes de conexión."""
+    if is_rate_limit_error(error) or error_status(error) in RETRYABLE_STATUS:
+        return True
+    # Errores de transporte de httpx (ConnectError, ReadTimeout...) sin importar httpx
+    return isinstance(error, (ConnectionError, TimeoutError)) or type(error).__name__ in (
+        "ConnectError", "ConnectTimeout", "ReadTimeout", "ReadError", "RemoteProtocolError",
+    )
+
+
+class TokenBucket:
+    """Cubo de tokens que se rellena de forma continua hasta `per_minute` unidades por minuto."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self._rate = per_minute / 60.0
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def wait_time(self, amount, now):
+        """Segundos hasta disponer de `amount` unidades (0 si ya hay suficientes)."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self._rate
+
+    def consume(self, amount):
+        # Puede quedar en negativo al ajustar con el consumo real: se compensa con el relleno
+        self.level -= amount
+
+
+class LLMScheduler:
+    """Planificador común de las llamadas a Gemini del proceso.
+
+    - Limita peticiones y tokens por minuto (cubos de tokens) y llamadas simultáneas.
+    - Atiende primero la prioridad más alta (el chat antes que roles, temas o el banco de tests).
+    - Reintenta los errores transitorios (429, 5xx, cortes de conexión) con espera
+      exponencial con jitter.
+    - Expone profundidad de la cola y tiempos de espera por prioridad.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queue = []  # heap de (prioridad, orden, entrada)
+        self._order = itertools.count()
+        self._active = 0
+        self._requests = TokenBucket(PERFORMANCE_CONFIG.get("llm_requests_per_minute", 60))
+        self._tokens = TokenBucket(PERFORMANCE_CONFIG.get("llm_tokens_per_minute", 1_000_000))
+        self._waits = {}  # prioridad -> deque de esperas recientes (s)
+        self.stats = {"admitted": 0, "retries": 0, "rate_limited": 0, "failures": 0, "max_queue_depth": 0}
+
+    # --- Admisión ---
+
+    def _acquire(self, priority, tokens):
+        """Bloquea hasta que la petición tiene turno, hueco de concurrencia y cuota."""
+        max_concurrency = max(1, PERFORMANCE_CONFIG.get("llm_max_concurrency", 4))
+        entry = object()
+        queued_at = time.monotonic()
+        with self._cond:
+            heapq.heappush(self._queue, (priority, next(self._order), entry))
+            self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], len(self._queue))
+            while True:
+                timeout = None
+                if self._queue[0][2] is entry and self._active < max_concurrency:
+                    now = time.monotonic()
+                    timeout = max(self._requests.wait_time(1, now), self._tokens.wait_time(tokens, now))
+                    if timeout == 0:
+                        heapq.heappop(self._queue)
+                        self._active += 1
+                        self._requests.consume(1)
+                        self._tokens.consume(tokens)
+                        self.stats["admitted"] += 1
+                        break
+                self._cond.wait(timeout)
+            waits = self._waits.setdefault(priority, deque(maxlen=1000))
+            waits.append(time.monotonic() - queued_at)
+            # El siguiente de la cola puede tener ya turno
+            self._cond.notify_all()
+
+    def _release(self, estimated_tokens, usage):
+        with self._cond:
+            self._active -= 1
+            total = getattr(usage, "total_token_count", None)
+            if isinstance(total, int):
+                self._tokens.consume(total - estimated_tokens)
+            self._cond.notify_all()
+
+    def _backoff(self, attempt, error, on_retry):
+        """Espera exponencial con jitter completo antes del siguiente intento."""
+        base = PERFORMANCE_CONFIG.get("llm_backoff_base_seconds", 1.0)
+        cap = PERFORMANCE_CONFIG.get("llm_backoff_max_seconds", 30.0)
+        delay = random.uniform(0, min(cap, base * 2 ** attempt))
+        with self._cond:
+            self.stats["retries"] += 1
+            if is_rate_limit_error(error):
+                self.stats["rate_limited"] += 1
+        if on_retry:
+            on_retry(error)
+        time.sleep(delay)
+
+    def _give_up(self, error, attempt):
+        if not is_retryable(error) or attempt >= PERFORMANCE_CONFIG.get("llm_max_retries", 4):
+            with self._cond:
+                self.stats["failures"] += 1
+                if is_rate_limit_error(error):
+                    self.stats["rate_limited"] += 1
+            return True
+        return False
+
+    # --- API pública ---
+
+    def run(self, fn, priority=PRIORITY_INTERACTIVE, tokens=0, on_retry=None):
+        """Ejecuta fn() con el turno, la cuota y los reintentos del planificador y devuelve su resultado."""
+        attempt = 0
+        while True:
+            self._acquire(priority, tokens)
+            result = None
+            try:
+                result = fn()
+                return result
+            except Exception as e:
+                if self._give_up(e, attempt):
+                    raise
+                error = e
+            finally:
+                self._release(tokens, getattr(result, "usage_metadata", None))
+            self._backoff(attempt, error, on_retry)
+            attempt += 1
+
+    def stream(self, fn, priority=PRIORITY_INTERACTIVE, tokens=0, on_retry=None):
+        """Variante para generate_content_stream: mantiene el turno mientras se consume el stream.
+
+        Solo se reintenta si el error llega antes del primer fragmento.
+        """
+        attempt = 0
+        while True:
+            self._acquire(priority, tokens)
+            usage = None
+            received = False
+            try:
+                for chunk in fn():
+                    received = True
+                    usage = getattr(chunk, "usage_metadata", None) or usage
+                    yield chunk
+                return
+            except Exception as e:
+                if received or self._give_up(e, attempt):
+                    raise
+                error = e
+            finally:
+                self._release(tokens, usage)
+            self._backoff(attempt, error, on_retry)
+            attempt += 1
+
+    def metrics(self):
+        """Profundidad de la cola, llamadas en curso y esperas (p50/p95) por prioridad."""
+        with self._cond:
+            waits = {PRIORITY_NAMES.get(p, str(p)): sorted(w) for p, w in self._waits.items()}
+            snapshot = dict(self.stats, queue_depth=len(self._queue), active=self._active)
+        snapshot["wait_s"] = {
+            name: {"p50": percentile(values, 50), "p95": percentile(values, 95), "samples": len(values)}
+            for name, values in waits.items()
+        }
+        return snapshot
+
+
+# Instancia global: todas las llamadas a Gemini del proceso pasan por aquí
+llm_scheduler = LLMScheduler()
@@ -0,0 +1,294 @@
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import threading
+from importlib.util import find_spec
+import streamlit as st
+from config import SECURITY_CONFIG
+
+USER_FIELDS = ("password_hash", "score", "active_sessions", "role")
+
+
+class UserStore:
+    """Interfaz de almacenamiento de usuarios usada por AuthManager.
+
+    Los usuarios se representan como diccionario usuario -> fila, igual que la hoja Users.
+    """
+
+    available = True
+
+    def load_users(self):
+        """Devuelve todos los usuarios. Lanza excepción si la lectura falla."""
+        raise NotImplementedError
+
+    def save_users(self, data):
+        """Sustituye la tabla completa de usuarios. Lanza excepción si la escritura falla."""
+        raise NotImplementedError
+
+    def apply_progress(self, batch):
+        """Aplica un lote de cambios {usuario: {"score": valor o None, "sessions": incremento}}."""
+        raise NotImplementedError
+
+    def ensure_users(self, data):
+        """Crea los usuarios que falten y actualiza la contraseña de los existentes sin tocar su progreso.
+
+        Implementación genérica: fusiona sobre una lectura reciente y reescribe la tabla.
+        """
+        users = self.load_users()
+        for username, user in data.items():
+            if username in users:
+                users[username]["password_hash"] = user["password_hash"]
+            else:
+                users[username] = dict(user)
+        self.save_users(users)
+
+    def load_users_frame(self):
+        """Devuelve los usuarios como DataFrame indexado por username (para cálculos por columnas)."""
+        import pandas as pd
+        df = pd.DataFrame.from_dict(self.load_users(), orient="index")
+        df.index.name = "username"
+        return df
+
+
+def merge_progress(data, batch):
+    """Aplica un lote de cambios de progreso sobre una tabla de usuarios en memoria."""
+    for username, change in batch.items():
+        user = data.setdefault(username, {"score": 0, "active_sessions": 0})
+        if change["score"] is not None:
+            user["score"] = change["score"]
+        if change["sessions"]:
+            user["active_sessions"] = user.get("active_sessions", 0) + change["sessions"]
+    return data
+
+
+class GSheetsUserStore(UserStore):
+    """Almacenamiento en la pestaña Users de Google Sheets.
+
+    streamlit_gsheets y pandas se importan en la primera lectura o escritura.
+    """
+
+    # Comprobar si el paquete está instalado no requiere importarlo
+    available = find_spec("streamlit_gsheets") is not None
+
+    def __init__(self, connection_name="gsheets"):
+        self.connection_name = connection_name
+
+    def _connection(self):
+        from streamlit_gsheets import GSheetsConnection
+        return st.connection(self.connection_name, type=GSheetsConnection)
+
+    def load_users_frame(self):
+        import pandas as pd
+        if not self.available:
+            return pd.DataFrame()
+        conn = self._connection()
+        df = conn.read(worksheet="Users", ttl=0)
+        if df.empty:
+            return pd.DataFrame()
+        df = df.dropna(how="all")
+        if "username" not in df.columns:
+            return pd.DataFrame()
+        return df.set_index("username")
+
+    def load_users(self):
+        df = self.load_users_frame()
+        return df.to_dict(orient="index") if not df.empty else {}
+
+    def save_users(self, data):
+        if not self.available:
+            return
+        import pandas as pd
+        df = pd.DataFrame.from_dict(data, orient="index")
+        df.index.name = "username"
+        df.reset_index(inplace=True)
+        conn = self._connection()
+        conn.update(worksheet="Users", data=df)
+
+    def apply_progress(self, batch):
+        # La conexión solo permite reescribir la hoja completa: el lote se fusiona
+        # sobre una lectura reciente para no pisar cambios de otros procesos.
+        if not self.available:
+            return
+        self.save_users(merge_progress(self.load_users(), batch))
+
+
+class SQLiteUserStore(UserStore):
+    """Almacenamiento local en SQLite (modo WAL) con actualizaciones atómicas por fila."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    username TEXT PRIMARY KEY,
+                    password_hash TEXT,
+                    score INTEGER NOT NULL DEFAULT 0,
+                    active_sessions INTEGER NOT NULL DEFAULT 0,
+                    role TEXT
+                )
+            """)
+
+    def _connect(self):
+        """Conexión propia de cada hilo (las sesiones de Streamlit corren en hilos distintos)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def load_users(self):
+        rows = self._connect().execute("SELECT * FROM users").fetchall()
+        return {row["username"]: {field: row[field] for field in USER_FIELDS} for row in rows}
+
+    def load_users_frame(self):
+        import pandas as pd
+        return pd.read_sql_query("SELECT * FROM users", self._connect(), index_col="username")
+
+    def upsert_users(self, data, replace=False):
+        """Inserta o actualiza usuarios; con replace=True sustituye la tabla completa."""
+        with self._connect() as conn:
+            if replace:
+                conn.execute("DELETE FROM users")
+            conn.executemany(
+                """
+                INSERT INTO users (username, password_hash, score, active_sessions, role)
+                VALUES (:username, :password_hash, :score, :active_sessions, :role)
+                ON CONFLICT(username) DO UPDATE SET
+                    password_hash = excluded.password_hash,
+                    score = excluded.score,
+                    active_sessions = excluded.active_sessions,
+                    role = excluded.role
+                """,
+                [_normalize_row(username, user) for username, user in data.items()],
+            )
+
+    def save_users(self, data):
+        self.upsert_users(data, replace=True)
+
+    def ensure_users(self, data):
+        # Solo se tocan las filas indicadas: el progreso que esté volcando el diario se conserva
+        with self._connect() as conn:
+            conn.executemany(
+                """
+                INSERT INTO users (username, password_hash, score, active_sessions, role)
+                VALUES (:username, :password_hash, :score, :active_sessions, :role)
+                ON CONFLICT(username) DO UPDATE SET password_hash = excluded.password_hash
+                """,
+                [_normalize_row(username, user) for username, user in data.items()],
+            )
+
+    def apply_progress(self, batch):
+        # Cada usuario se actualiza con una sentencia atómica dentro de una única transacción
+        with self._connect() as conn:
+            conn.executemany(
+                """
+                INSERT INTO users (username, score, active_sessions) VALUES (?, COALESCE(?, 0), ?)
+                ON CONFLICT(username) DO UPDATE SET
+                    score = COALESCE(?, score),
+                    active_sessions = active_sessions + ?
+                """,
+                [(username, change["score"], change["sessions"], change["score"], change["sessions"])
+                 for username, change in batch.items()],
+            )
+
+
+def _to_int(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError, OverflowError):
+        return 0
+
+
+def _normalize_row(username, user):
+    """Adapta una fila de JSON, CSV o Sheets (valores vacíos o NaN) al esquema SQLite."""
+    def text(value):
+        if value is None or value == "" or (isinstance(value, float) and value != value):
+            return None
+        return str(value)
+
+    return {
+        "username": str(username),
+        "password_hash": text(user.get("password_hash")),
+        "score": _to_int(user.get("score")),
+        "active_sessions": _to_int(user.get("active_sessions")),
+        "role": text(user.get("role")),
+    }
+
+
+def import_json(store, path):
+    """Importa usuarios desde un archivo JSON {usuario: {...}} como user_progress.json."""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    store.upsert_users(data)
+    return len(data)
+
+
+def import_sheets_csv(store, path):
+    """Importa usuarios desde una exportación CSV de la pestaña Users de Google Sheets."""
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        data = {row["username"]: row for row in csv.DictReader(f) if row.get("username")}
+    store.upsert_users(data)
+    return len(data)
+
+
+def import_from_sheets(store, connection_name="gsheets"):
+    """Importa usuarios directamente desde la pestaña Users de Google Sheets."""
+    data = GSheetsUserStore(connection_name).load_users()
+    store.upsert_users(data)
+    return len(data)
+
+
+def sync_to_sheets(store, connection_name="gsheets"):
+    """Copia la tabla de usuarios local a Google Sheets (solo para informes)."""
+    data = store.load_users()
+    GSheetsUserStore(connection_name).save_users(data)
+    return len(data)
+
+
+def create_user_store(security_config=None):
+    """Crea el almacenamiento configurado en security_config['storage_backend'] (por defecto SECURITY_CONFIG)."""
+    security_config = security_config or SECURITY_CONFIG
+    backend = security_config.get("storage_backend", "gsheets")
+    if backend == "sqlite":
+        os.makedirs(os.path.dirname(security_config["sqlite_file"]) or ".", exist_ok=True)
+        return SQLiteUserStore(security_config["sqlite_file"])
+    if backend == "gsheets":
+        return GSheetsUserStore(security_config.get("gsheets_connection", "gsheets"))
+    raise ValueError(f"Backend de almacenamiento desconocido: {backend}")
+
+
+_user_store = None
+_user_store_lock = threading.Lock()
+
+
+def get_user_store():
+    """Almacenamiento de usuarios compartido por todo el proceso."""
+    global _user_store
+    with _user_store_lock:
+        if _user_store is None:
+            _user_store = create_user_store()
+        return _user_store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Importa usuarios a la base SQLite local.")
+    parser.add_argument("--json", help="Archivo JSON de progreso (p. ej. user_progress.json)")
+    parser.add_argument("--csv", help="Exportación CSV de la pestaña Users de Google Sheets")
+    parser.add_argument("--sheets", action="store_true", help="Leer directamente la hoja Users configurada en los secrets")
+    args = parser.parse_args()
+
+    sqlite_store = SQLiteUserStore(SECURITY_CONFIG["sqlite_file"])
+    if args.json:
+        print(f"✅ {import_json(sqlite_store, args.json)} usuarios importados desde {args.json}")
+    if args.csv:
+        print(f"✅ {import_sheets_csv(sqlite_store, args.csv)} usuarios importados desde {args.csv}")
+    if args.sheets:
+        print(f"✅ {import_from_sheets(sqlite_store)} usuarios importados desde Google Sheets")
+    if not args.json and not args.csv and not args.sheets:
+        parser.print_help()
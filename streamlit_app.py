@@ -1,12 +1,29 @@
 import streamlit as st
 import os
-from config import CLIENT_CONFIG, SECURITY_CONFIG, apply_custom_styles
-from logic import get_current_belt, get_next_belt_data, generate_quiz_questions, evaluate_quiz, get_chat_response, load_knowledge_base, generate_dynamic_roles, generate_dynamic_topics, calculate_roi_metrics
-from auth import auth_manager
+from config import TENANT_CONFIG, apply_custom_styles
+from logic import get_current_belt, get_next_belt_data, generate_quiz_questions, evaluate_quiz, stream_chat_response, analyze_knowledge_base, kb_analysis_pending, calculate_roi_metrics, llm_single_flight, DEFAULT_ROLES, DEFAULT_TOPICS
+from quiz_bank import quiz_bank, question_fingerprint
+from response_cache import chat_cache
+from storage import sync_to_sheets
+from scheduler import llm_scheduler
+from telemetry import llm_telemetry
+from tenants import tenant_registry
+
+# --- Cliente (tenant) ---
+# Se elige por parámetro de URL (?tenant=...) o en el login y queda fijo durante la sesión
+url_tenant = tenant_registry.resolve(st.query_params.get(TENANT_CONFIG["query_param"]))
+if url_tenant and st.session_state.get("tenant_id") not in (None, url_tenant):
+    # La URL apunta a otro cliente: se descarta la sesión del anterior
+    st.session_state.clear()
+if "tenant_id" not in st.session_state:
+    st.session_state.tenant_id = url_tenant or TENANT_CONFIG["default_tenant"]
+tenant = tenant_registry.tenant(st.session_state.tenant_id)
+client_config = tenant.client
+auth_manager = tenant_registry.auth(tenant.id)
 
 # --- Configuración de Página ---
-st.set_page_config(page_title=CLIENT_CONFIG["client_name"], page_icon="🎓")
-apply_custom_styles()
+st.set_page_config(page_title=client_config["client_name"], page_icon="🎓")
+apply_custom_styles(client_config)
 
 # --- Inicialización de Estado ---
 if "user_role" not in st.session_state:
@@ -19,37 +36,40 @@ if "session_interaction_recorded" not in st.session_state:
     st.session_state.session_interaction_recorded = False
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
+if "chat_summary" not in st.session_state:
+    st.session_state.chat_summary = {"text": "", "covered": 0}
 if "quiz_active" not in st.session_state:
     st.session_state.quiz_active = False
 if "current_questions" not in st.session_state:
     st.session_state.current_questions = []
-if "knowledge_base" not in st.session_state or not st.session_state.knowledge_base:
-    # Cargar documentos al inicio de la sesión
-    kb_path = CLIENT_CONFIG.get("knowledge_base_folder", "knowledge_base")
-    # Asegurar ruta absoluta para evitar errores de contexto tras el login
-    if not os.path.isabs(kb_path):
-        kb_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), kb_path)
-    st.session_state.knowledge_base = load_knowledge_base(kb_path)
+if "seen_questions" not in st.session_state:
+    st.session_state.seen_questions = set()
 if "dynamic_roles" not in st.session_state:
     st.session_state.dynamic_roles = []
 if "dynamic_topics" not in st.session_state:
     st.session_state.dynamic_topics = []
 
 # --- Control de Acceso (Login) ---
-if SECURITY_CONFIG.get("enable_auth", False):
+if tenant.security.get("enable_auth", False):
     if "logged_in" not in st.session_state:
         st.session_state.logged_in = False
         
     if not st.session_state.logged_in:
         st.title("🔐 Acceso a Formación")
         with st.form("login_form"):
+            # Sin cliente en la URL y con varios clientes dados de alta, se pide la organización
+            ask_tenant = not url_tenant and len(tenant_registry.tenant_ids()) > 1
+            org = st.text_input("Organización", value=tenant.id) if ask_tenant else tenant.id
             u = st.text_input("Usuario")
             p = st.text_input("Contraseña", type="password")
             if st.form_submit_button("Entrar"):
-                if auth_manager.authenticate(u, p):
+                login_tenant = tenant_registry.resolve(org)
+                login_auth = tenant_registry.auth(login_tenant) if login_tenant else None
+                if login_auth and login_auth.authenticate(u, p):
+                    st.session_state.tenant_id = login_tenant
                     st.session_state.logged_in = True
                     st.session_state.username = u
-                    user_data = auth_manager.get_user_progress(u) # Cargar datos guardados
+                    user_data = login_auth.get_user_progress(u) # Cargar datos guardados
                     st.session_state.score = user_data["score"]
                     st.session_state.active_sessions = user_data["active_sessions"]
                     st.rerun()
@@ -57,20 +77,26 @@ if SECURITY_CONFIG.get("enable_auth", False):
                     st.error("Credenciales incorrectas")
         st.stop() # Detiene la ejecución si no está logueado
 
+# --- Base de Conocimiento ---
+# Se carga después del login para que la pantalla de acceso se muestre de inmediato.
+# Base de conocimiento compartida por proceso (y entre clientes con la misma carpeta):
+# la sesión solo guarda una referencia y se recarga únicamente cuando cambia el contenido.
+st.session_state.knowledge_base = tenant_registry.knowledge_base(tenant.id)
+
 # --- Sidebar: Perfil y Navegación ---
 with st.sidebar:
-    if os.path.exists(CLIENT_CONFIG.get("logo_path", "")):
-        st.image(CLIENT_CONFIG["logo_path"], width=100)
+    if os.path.exists(client_config.get("logo_path", "")):
+        st.image(client_config["logo_path"], width=100)
     else:
-        st.warning("⚠️ Logo no encontrado en images/logo.png")
-    st.title(CLIENT_CONFIG["client_name"])
+        st.warning(f"⚠️ Logo no encontrado en {client_config.get('logo_path', 'images/logo.png')}")
+    st.title(client_config["client_name"])
     
     if st.session_state.get("logged_in"):
         st.caption(f"Usuario: {st.session_state.username}")
         if st.button("Cerrar Sesión"):
             # Limpiar variables de sesión para asegurar que el próximo usuario cargue datos limpios
-            keys_to_reset = ["logged_in", "username", "score", "active_sessions", "chat_history", 
-                             "quiz_active", "current_questions", "session_interaction_recorded", "user_role"]
+            keys_to_reset = ["logged_in", "username", "score", "active_sessions", "chat_history", "chat_summary",
+                             "quiz_active", "current_questions", "seen_questions", "session_interaction_recorded", "user_role"]
             for key in keys_to_reset:
                 if key in st.session_state:
                     del st.session_state[key]
@@ -79,16 +105,25 @@ with st.sidebar:
     # Indicador de estado de la Base de Conocimiento
     if st.session_state.knowledge_base:
         st.success(f"📚 Base de conocimiento conectada")
+        kb = st.session_state.knowledge_base
+        st.caption(f"Versión {kb.version} · Caché de extracción: {kb.cache_hits} aciertos / {kb.cache_misses} fallos")
     else:
         st.warning("⚠️ Base de conocimiento vacía")
     
-    # Generar roles dinámicos si no existen
-    if not st.session_state.dynamic_roles:
-        if st.session_state.knowledge_base:
-            with st.spinner("Analizando contenido para definir niveles..."):
-                st.session_state.dynamic_roles = generate_dynamic_roles(st.session_state.knowledge_base)
+    # Generar roles y temas dinámicos (una vez por versión de la base de conocimiento; mientras
+    # el análisis sea provisional se vuelve a consultar en cada rerun hasta tener el definitivo)
+    kb = st.session_state.knowledge_base
+    if (not st.session_state.dynamic_roles or st.session_state.get("dynamic_kb_version") != kb.version
+            or st.session_state.get("dynamic_analysis_provisional")):
+        if kb:
+            with st.spinner("Analizando contenido para definir niveles y temas..."):
+                roles, topics = analyze_knowledge_base(kb.analysis_context(), kb.version, kb.documents)
         else:
-            st.session_state.dynamic_roles = ["Principiante", "Intermedio", "Avanzado", "Experto"]
+            roles, topics = list(DEFAULT_ROLES), list(DEFAULT_TOPICS)
+        st.session_state.dynamic_roles = roles
+        st.session_state.dynamic_topics = topics
+        st.session_state.dynamic_kb_version = kb.version
+        st.session_state.dynamic_analysis_provisional = bool(kb) and kb_analysis_pending(kb.version)
 
     # Selector de Rol
     st.session_state.user_role = st.selectbox(
@@ -118,6 +153,10 @@ with st.sidebar:
     nav_options = ["Asistente Formativo", "Dojo (Ponerse a prueba)"]
     if st.session_state.get("username") == "admin":
         nav_options.append("ROI Dashboard (Admin)")
+        # Telemetría, planificador y vigilancia de carpetas son de todo el proceso (de todos los
+        # clientes): solo los ve el administrador del cliente por defecto, que opera el despliegue
+        if tenant.id == TENANT_CONFIG["default_tenant"]:
+            nav_options.append("Rendimiento IA (Admin)")
     mode = st.radio("Navegación", nav_options)
 
 # --- Pantalla 1: Asistente Formativo (Chat) ---
@@ -145,10 +184,18 @@ if mode == "Asistente Formativo":
 
         # Generar respuesta
         with st.chat_message("assistant"):
-            with st.spinner("Consultando base de conocimiento..."):
-                system_prompt = CLIENT_CONFIG["system_prompt"].format(client_name=CLIENT_CONFIG["client_name"])
-                response = get_chat_response(st.session_state.chat_history, prompt, system_prompt, st.session_state.knowledge_base)
+            kb = st.session_state.knowledge_base
+            previous_history = st.session_state.chat_history[:-1]
+            # El prompt de sistema depende del cliente: la caché se separa por cliente
+            cache_scope = f"{tenant.id}:{kb.version}"
+            response = chat_cache.get(prompt, previous_history, cache_scope)
+            if response is not None:
                 st.markdown(response)
+            else:
+                system_prompt = client_config["system_prompt"].format(client_name=client_config["client_name"])
+                # Se muestra la respuesta a medida que llegan los tokens
+                response = st.write_stream(stream_chat_response(st.session_state.chat_history, prompt, system_prompt, kb.context_for(prompt), st.session_state.chat_summary))
+                chat_cache.put(prompt, previous_history, cache_scope, response)
         
         st.session_state.chat_history.append({"role": "assistant", "content": response})
 
@@ -158,27 +205,27 @@ elif mode == "Dojo (Ponerse a prueba)":
     st.write("Demuestra tu conocimiento para subir de cinturón.")
 
     if not st.session_state.quiz_active:
-        # Generar temas dinámicos si no existen
-        if not st.session_state.dynamic_topics:
-            if st.session_state.knowledge_base:
-                with st.spinner("Identificando temas clave para el examen..."):
-                    st.session_state.dynamic_topics = generate_dynamic_topics(st.session_state.knowledge_base)
-            else:
-                st.session_state.dynamic_topics = ["Conocimiento General"]
-
         col1, col2 = st.columns(2)
         with col1:
             topic = st.selectbox("Tema del examen", st.session_state.dynamic_topics)
         with col2:
             difficulty = st.select_slider("Dificultad", options=["Fácil", "Medio", "Difícil"])
             
+        # Preparar en segundo plano el test de la selección actual
+        bank_key = (st.session_state.knowledge_base.version, topic, difficulty, st.session_state.user_role)
+        quiz_context = st.session_state.knowledge_base.context_for(topic)
+        quiz_bank.prefetch(bank_key, quiz_context)
+            
         if st.button("Comenzar Desafío"):
-            with st.spinner("El Sensei (IA) está preparando tus preguntas..."):
-                questions = generate_quiz_questions(topic, difficulty, st.session_state.user_role, st.session_state.knowledge_base)
-                if questions:
-                    st.session_state.current_questions = questions
-                    st.session_state.quiz_active = True
-                    st.rerun()
+            questions = quiz_bank.pop(bank_key, st.session_state.seen_questions, quiz_context)
+            if not questions:
+                with st.spinner("El Sensei (IA) está preparando tus preguntas..."):
+                    questions = generate_quiz_questions(topic, difficulty, st.session_state.user_role, quiz_context)
+            if questions:
+                st.session_state.seen_questions.update(question_fingerprint(q) for q in questions)
+                st.session_state.current_questions = questions
+                st.session_state.quiz_active = True
+                st.rerun()
     
     else:
         # Mostrar Formulario de Quiz
@@ -229,9 +276,18 @@ elif mode == "Dojo (Ponerse a prueba)":
 
 # --- Pantalla 3: ROI Dashboard (Admin) ---
 elif mode == "ROI Dashboard (Admin)":
-    st.header("💰 Calculadora de ROI - Olivia España")
+    st.header(f"💰 Calculadora de ROI - {client_config['client_name']}")
     st.markdown("Análisis de impacto económico basado en adopción y evolución de conocimiento.")
     
+    # Con almacenamiento local, Google Sheets se usa solo como copia para informes
+    if tenant.security.get("storage_backend") == "sqlite":
+        if st.button("Sincronizar usuarios con Google Sheets"):
+            try:
+                synced = sync_to_sheets(tenant_registry.store(tenant.id), tenant.security["gsheets_connection"])
+                st.success(f"{synced} usuarios sincronizados con Google Sheets.")
+            except Exception as e:
+                st.error(f"Error sincronizando con Google Sheets: {e}")
+    
     col1, col2, col3 = st.columns(3)
     with col1:
         ts = st.number_input("Tiempo ahorrado por interacción (h)", value=0.25, step=0.05, format="%.2f")
@@ -240,7 +296,20 @@ elif mode == "ROI Dashboard (Admin)":
     with col3:
         threshold = st.number_input("Mín. sesiones para ROI", value=10, min_value=1, step=1)
         
-    metrics = calculate_roi_metrics(ts, ch, threshold)
+    # Agregados incrementales: cambiar los parámetros no relee ni recorre la tabla de usuarios
+    metrics = auth_manager.get_roi_metrics(ts, ch, threshold)
+    
+    if st.button("Verificar consistencia (recálculo completo)"):
+        # Los agregados incluyen los cambios aún en el diario: se vuelcan antes de releer el almacén
+        if not auth_manager.flush_progress():
+            st.warning("No se pudo volcar el progreso pendiente; el recálculo puede no incluirlo.")
+        metrics = auth_manager.get_roi_metrics(ts, ch, threshold)
+        full = calculate_roi_metrics(ts, ch, threshold, store=tenant_registry.store(tenant.id))
+        if full == metrics or (full and metrics and all(abs(full[k] - metrics[k]) <= 1e-9 * max(1.0, abs(full[k])) for k in full)):
+            st.success("Los agregados coinciden con el recálculo completo.")
+        else:
+            st.warning("Los agregados no coinciden con el recálculo completo; se recargará la tabla de usuarios.")
+            auth_manager.invalidate_users()
     
     if metrics:
         st.divider()
@@ -268,3 +337,66 @@ elif mode == "ROI Dashboard (Admin)":
         st.metric("Ahorro Económico Total", f"{final_val:,.2f} €", delta="ROI Estimado")
     else:
         st.warning("No hay datos de usuarios suficientes para calcular el ROI.")
+
+# --- Pantalla 4: Rendimiento de la IA (Admin) ---
+elif mode == "Rendimiento IA (Admin)":
+    st.header("⏱️ Rendimiento de la IA")
+    st.caption("Latencia y tokens por funcionalidad de las últimas llamadas a Gemini (búfer en memoria de este proceso).")
+    
+    summary = llm_telemetry.summary()
+    if summary:
+        st.dataframe(summary, use_container_width=True, hide_index=True, column_config={
+            "feature": "Funcionalidad",
+            "calls": "Llamadas",
+            "errors": "Errores",
+            "retries": "Reintentos",
+            "p50_s": st.column_config.NumberColumn("p50 (s)", format="%.2f"),
+            "p95_s": st.column_config.NumberColumn("p95 (s)", format="%.2f"),
+            "p99_s": st.column_config.NumberColumn("p99 (s)", format="%.2f"),
+            "ttft_p50_s": st.column_config.NumberColumn("1er fragmento p50 (s)", format="%.2f"),
+            "ttft_p95_s": st.column_config.NumberColumn("1er fragmento p95 (s)", format="%.2f"),
+            "avg_prompt_tokens": "Tokens entrada (media)",
+            "avg_output_tokens": "Tokens salida (media)",
+            "avg_cached_tokens": "Tokens cacheados (media)",
+        })
+        
+        rates = chat_cache.hit_rates()
+        c1, c2, c3, c4 = st.columns(4)
+        c1.metric("Aciertos caché del chat", f"{rates['total']:.0%}")
+        c2.metric("Aciertos banco de tests", quiz_bank.stats["hits"])
+        c3.metric("Fallos banco de tests", quiz_bank.stats["misses"])
+        c4.metric("Llamadas agrupadas", llm_single_flight.stats["coalesced"],
+                  help="Peticiones idénticas concurrentes que reutilizaron una llamada en curso")
+        
+        sched = llm_scheduler.metrics()
+        st.subheader("Planificador de llamadas")
+        s1, s2, s3, s4 = st.columns(4)
+        s1.metric("En cola", sched["queue_depth"], help=f"Máximo observado: {sched['max_queue_depth']}")
+        s2.metric("En curso", sched["active"])
+        s3.metric("Reintentos", sched["retries"])
+        s4.metric("Rechazos por cuota (429)", sched["rate_limited"])
+        if sched["wait_s"]:
+            st.dataframe(
+                [{"prioridad": name, "espera p50 (s)": w["p50"], "espera p95 (s)": w["p95"], "muestras": w["samples"]}
+                 for name, w in sched["wait_s"].items()],
+                use_container_width=True, hide_index=True,
+            )
+        
+        errors = llm_telemetry.recent_errors()
+        if errors:
+            with st.expander(f"Últimos errores ({len(errors)})"):
+                st.dataframe(errors, use_container_width=True, hide_index=True)
+    else:
+        st.info("Todavía no se ha registrado ninguna llamada a Gemini en este proceso.")
+    
+    watchers = tenant_registry.watchers()
+    if watchers:
+        st.subheader("Recarga de la base de conocimiento")
+        st.caption(f"Versiones publicadas sin reiniciar: {tenant_registry.stats['kb_reloads']}")
+        st.dataframe(
+            [{"carpeta": w["folder"], "modo": "eventos" if w["mode"] == "events" else "sondeo", "versión": w["version"],
+              "recargas": w["reloads"], "archivos releídos": w["files_reread"], "archivos eliminados": w["files_removed"],
+              "última recarga (s)": w["last_reload_s"], "errores": w["errors"]}
+             for w in watchers],
+            use_container_width=True, hide_index=True,
+        )
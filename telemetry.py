@@ -0,0 +1,152 @@
+import json
+import math
+import threading
+import time
+from collections import deque
+from config import PERFORMANCE_CONFIG
+
+
+def percentile(values, pct):
+    """Percentil por rango más cercano (values debe estar ordenado)."""
+    if not values:
+        return None
+    rank = max(math.ceil(pct / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+class LLMCall:
+    """Medición de una llamada a Gemini: se rellena dentro de LLMTelemetry.track()."""
+
+    def __init__(self, feature, model):
+        self.feature = feature
+        self.model = model
+        self.started = time.perf_counter()
+        self.ttft = None
+        self.retries = 0
+        self.usage = None
+        self.context_cache = False
+
+    def first_token(self):
+        """Marca la llegada del primer fragmento (solo cuenta la primera vez)."""
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.started
+
+    def record_retry(self, error=None):
+        """Cuenta un reintento de la llamada (lo invoca el planificador)."""
+        self.retries += 1
+
+    def observe(self, response):
+        """Toma usage_metadata de la respuesta o del último fragmento del stream."""
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None:
+            self.usage = usage
+
+
+class LLMTelemetry:
+    """Telemetría por llamada a Gemini.
+
+    Cada llamada registra tiempo total, tiempo hasta el primer fragmento, tokens de
+    entrada, salida y cacheados (usage_metadata), reintentos y errores. Los registros
+    se guardan en un búfer circular en memoria (para el panel de administración) y se
+    añaden a un log JSONL local.
+    """
+
+    def __init__(self, buffer_size=None, log_file=None):
+        self._records = deque(maxlen=buffer_size or PERFORMANCE_CONFIG.get("telemetry_buffer_size", 1000))
+        self._log_file = log_file if log_file is not None else PERFORMANCE_CONFIG.get("telemetry_log_file")
+        self._lock = threading.Lock()
+
+    def track(self, feature, model, context_cache=False):
+        """Context manager que mide una llamada; las excepciones se registran y se propagan."""
+        return _Tracker(self, LLMCall(feature, model), context_cache)
+
+    def _finish(self, call, status, error=None):
+        usage = call.usage
+        record = {
+            "ts": time.time(),
+            "feature": call.feature,
+            "model": call.model,
+            "status": status,
+            "latency_s": round(time.perf_counter() - call.started, 4),
+            "ttft_s": round(call.ttft, 4) if call.ttft is not None else None,
+            "prompt_tokens": getattr(usage, "prompt_token_count", None),
+            "output_tokens": getattr(usage, "candidates_token_count", None),
+            "cached_tokens": getattr(usage, "cached_content_token_count", None),
+            "context_cache": call.context_cache,
+            "retries": call.retries,
+            "error": f"{type(error).__name__}: {error}" if error is not None else None,
+        }
+        with self._lock:
+            self._records.append(record)
+            if self._log_file:
+                try:
+                    with open(self._log_file, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                except OSError as e:
+                    print(f"No se pudo escribir el log de telemetría: {e}")
+        return record
+
+    def records(self, feature=None):
+        """Copia de los registros en memoria, opcionalmente filtrados por funcionalidad."""
+        with self._lock:
+            return [r for r in self._records if feature is None or r["feature"] == feature]
+
+    def summary(self):
+        """Percentiles de latencia y medias de tokens por funcionalidad."""
+        by_feature = {}
+        for record in self.records():
+            by_feature.setdefault(record["feature"], []).append(record)
+
+        rows = []
+        for feature, records in sorted(by_feature.items()):
+            ok = [r for r in records if r["status"] == "ok"]
+            latencies = sorted(r["latency_s"] for r in ok)
+            ttfts = sorted(r["ttft_s"] for r in ok if r["ttft_s"] is not None)
+
+            def mean(field):
+                values = [r[field] for r in ok if r[field] is not None]
+                return round(sum(values) / len(values), 1) if values else None
+
+            rows.append({
+                "feature": feature,
+                "calls": len(records),
+                "errors": sum(1 for r in records if r["status"] == "error"),
+                "retries": sum(r["retries"] for r in records),
+                "p50_s": percentile(latencies, 50),
+                "p95_s": percentile(latencies, 95),
+                "p99_s": percentile(latencies, 99),
+                "ttft_p50_s": percentile(ttfts, 50),
+                "ttft_p95_s": percentile(ttfts, 95),
+                "avg_prompt_tokens": mean("prompt_tokens"),
+                "avg_output_tokens": mean("output_tokens"),
+                "avg_cached_tokens": mean("cached_tokens"),
+            })
+        return rows
+
+    def recent_errors(self, limit=20):
+        """Últimos errores registrados, del más reciente al más antiguo."""
+        errors = [r for r in self.records() if r["status"] == "error"]
+        return errors[-limit:][::-1]
+
+
+class _Tracker:
+    def __init__(self, telemetry, call, context_cache):
+        self._telemetry = telemetry
+        self._call = call
+        self._call.context_cache = bool(context_cache)
+
+    def __enter__(self):
+        return self._call
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is None:
+            self._telemetry._finish(self._call, "ok")
+        elif isinstance(exc, Exception):
+            self._telemetry._finish(self._call, "error", exc)
+        else:
+            # GeneratorExit / KeyboardInterrupt: el stream se cerró antes de terminar
+            self._telemetry._finish(self._call, "cancelled")
+        return False
+
+
+llm_telemetry = LLMTelemetry()
@@ -0,0 +1,284 @@
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from config import BASE_DIR, CLIENT_CONFIG, PERFORMANCE_CONFIG, SECURITY_CONFIG, TENANT_CONFIG, TENANTS
+from auth import DEFAULT_CREDENTIALS, AuthManager, hash_password
+from kb_watcher import KnowledgeBaseWatcher
+from knowledge import build_knowledge_base, folder_snapshot, snapshot_fingerprint
+from storage import create_user_store, get_user_store
+
+TENANT_ID_PATTERN = re.compile(TENANT_CONFIG["id_pattern"])
+# Claves de configuración que son rutas (se resuelven respecto a la carpeta de la app)
+PATH_KEYS = ("knowledge_base_folder", "logo_path", "sqlite_file", "progress_journal_file")
+# Memoria aproximada de una fila de usuario en la tabla en memoria de AuthManager
+USER_ROW_BYTES = 600
+
+
+@dataclass(frozen=True, eq=False)
+class Tenant:
+    """Cliente servido por el despliegue: CLIENT_CONFIG y SECURITY_CONFIG con sus valores propios."""
+    id: str
+    client: dict
+    security: dict
+
+    @property
+    def knowledge_base_folder(self):
+        return self.client["knowledge_base_folder"]
+
+
+def build_tenant(tenant_id, overrides):
+    """Combina la configuración base con los valores propios del cliente."""
+    client = dict(CLIENT_CONFIG)
+    security = dict(SECURITY_CONFIG)
+    if tenant_id != TENANT_CONFIG["default_tenant"]:
+        # Datos aislados por cliente dentro de tenants/<id>/
+        folder = os.path.join(TENANT_CONFIG["tenants_folder"], tenant_id)
+        client["knowledge_base_folder"] = os.path.join(folder, "knowledge_base")
+        security["sqlite_file"] = os.path.join(folder, "users.db")
+        security["progress_journal_file"] = os.path.join(folder, ".progress_journal.jsonl")
+        security["gsheets_connection"] = f"gsheets_{tenant_id}"
+    for key, value in overrides.items():
+        if key in PATH_KEYS and isinstance(value, str) and not os.path.isabs(value):
+            value = os.path.join(BASE_DIR, value)
+        (security if key in SECURITY_CONFIG or key == "gsheets_connection" else client)[key] = value
+    return Tenant(id=tenant_id, client=client, security=security)
+
+
+def default_users(tenant):
+    """Cuentas que AuthManager crea al arrancar para el cliente.
+
+    Las credenciales de código (DEFAULT_CREDENTIALS) son solo del cliente por defecto; los
+    demás tienen únicamente el admin con la contraseña fijada en su alta, si la hay.
+    """
+    if tenant.id == TENANT_CONFIG["default_tenant"]:
+        return {
+            user: {"password_hash": hash_password(password), "role": "admin" if user == "admin" else "user"}
+            for user, password in DEFAULT_CREDENTIALS.items()
+        }
+    if tenant.security.get("admin_password_hash"):
+        return {"admin": {"password_hash": tenant.security["admin_password_hash"], "role": "admin"}}
+    return {}
+
+
+class _TenantRuntime:
+    """Estado en ejecución de un cliente: almacenamiento, AuthManager y base de conocimiento en uso."""
+
+    def __init__(self, tenant):
+        self.tenant = tenant
+        self.kb_key = None
+        self._store = None
+        self._store_lock = threading.Lock()
+        if tenant.id == TENANT_CONFIG["default_tenant"]:
+            # El cliente por defecto reutiliza el almacenamiento global del proceso
+            self._store_factory = get_user_store
+        else:
+            self._store_factory = lambda: create_user_store(tenant.security)
+        self.auth = AuthManager(self.store, security=tenant.security, default_users=default_users(tenant))
+
+    def store(self):
+        with self._store_lock:
+            if self._store is None:
+                self._store = self._store_factory()
+            return self._store
+
+
+class TenantRegistry:
+    """Registro de clientes de un único despliegue.
+
+    Cada cliente tiene su configuración, carpeta de documentos y almacenamiento de
+    usuarios. El cliente de Gemini, el planificador, la caché de extracción y las bases
+    de conocimiento (por carpeta y versión) se comparten en el proceso. Con
+    PERFORMANCE_CONFIG['kb_watch_enabled'], cada carpeta cargada se vigila y su nueva
+    versión sustituye a la anterior para todos los clientes que la usan. Si la memoria
+    estimada supera TENANT_CONFIG['memory_cap_mb'], se descargan la base de conocimiento
+    y la tabla de usuarios de los clientes usados hace más tiempo.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._runtimes = OrderedDict()  # id -> _TenantRuntime, del menos al más reciente
+        self._kbs = {}  # (carpeta, versión) -> KnowledgeBase
+        self._kb_sizes = {}  # (carpeta, versión) -> bytes estimados
+        self._kb_locks = {}
+        self._watchers = {}  # carpeta -> (KnowledgeBaseWatcher, clave de la versión publicada)
+        self._definitions = None
+        self._definitions_mtime = None
+        self.stats = {"kb_loads": 0, "kb_reloads": 0, "evictions": 0}
+
+    # --- Definiciones ---
+
+    def definitions(self):
+        """Clientes definidos en config.TENANTS y en tenants.json (se relee si cambia)."""
+        path = TENANT_CONFIG.get("tenants_file")
+        try:
+            mtime = os.stat(path).st_mtime_ns if path else None
+        except OSError:
+            mtime = None
+        with self._lock:
+            if self._definitions is None or mtime != self._definitions_mtime:
+                definitions = {tenant_id: dict(values) for tenant_id, values in TENANTS.items()}
+                if mtime is not None:
+                    try:
+                        with open(path, 'r', encoding='utf-8') as f:
+                            definitions.update(json.load(f))
+                    except (OSError, ValueError) as e:
+                        print(f"No se pudo leer {path}: {e}")
+                invalid = sorted(tenant_id for tenant_id in definitions if not TENANT_ID_PATTERN.match(tenant_id))
+                if invalid:
+                    print(f"Clientes ignorados por tener un identificador no válido ({TENANT_CONFIG['id_pattern']}): {invalid}")
+                self._definitions = {
+                    tenant_id: values for tenant_id, values in definitions.items() if tenant_id not in invalid
+                }
+                self._definitions_mtime = mtime
+            return self._definitions
+
+    def tenant_ids(self):
+        return sorted(self.definitions())
+
+    def resolve(self, tenant_id):
+        """Normaliza un identificador recibido por URL o login; None si no es un cliente conocido."""
+        tenant_id = (tenant_id or "").strip().lower()
+        return tenant_id if tenant_id in self.definitions() else None
+
+    # --- Estado por cliente ---
+
+    def _runtime(self, tenant_id):
+        definitions = self.definitions()
+        with self._lock:
+            runtime = self._runtimes.get(tenant_id)
+            if runtime is None:
+                if tenant_id not in definitions:
+                    raise KeyError(f"Cliente desconocido: {tenant_id}")
+                runtime = _TenantRuntime(build_tenant(tenant_id, definitions[tenant_id]))
+                self._runtimes[tenant_id] = runtime
+            self._runtimes.move_to_end(tenant_id)
+            return runtime
+
+    def tenant(self, tenant_id):
+        return self._runtime(tenant_id).tenant
+
+    def auth(self, tenant_id):
+        return self._runtime(tenant_id).auth
+
+    def store(self, tenant_id):
+        return self._runtime(tenant_id).store()
+
+    def knowledge_base(self, tenant_id):
+        """Base de conocimiento del cliente, compartida con otros clientes con la misma carpeta y versión."""
+        runtime = self._runtime(tenant_id)
+        folder = runtime.tenant.knowledge_base_folder
+
+        with self._lock:
+            watched = self._watchers.get(folder)
+            if watched is not None:
+                # La carpeta está vigilada: la versión publicada ya está al día
+                key = watched[1]
+                self._assign(runtime, key)
+                return self._kbs[key]
+
+        snapshot = folder_snapshot(folder)
+        key = (folder, snapshot_fingerprint(snapshot))
+        with self._lock:
+            kb = self._kbs.get(key)
+            if kb is not None:
+                self._assign(runtime, key)
+                return kb
+            kb_lock = self._kb_locks.setdefault(key, threading.Lock())
+
+        # Un cerrojo por versión: los clientes que piden la misma base esperan a la primera carga
+        with kb_lock:
+            with self._lock:
+                kb = self._kbs.get(key)
+            if kb is None:
+                kb = build_knowledge_base(folder, snapshot)
+                size = kb.approx_bytes()
+                with self._lock:
+                    self._kbs[key] = kb
+                    self._kb_sizes[key] = size
+                    self.stats["kb_loads"] += 1
+                    if PERFORMANCE_CONFIG.get("kb_watch_enabled") and folder not in self._watchers:
+                        watcher = KnowledgeBaseWatcher(kb, on_swap=self._swap_kb)
+                        self._watchers[folder] = (watcher, key)
+                        watcher.start()
+
+        with self._lock:
+            self._assign(runtime, key)
+            self._kb_locks.pop(key, None)
+            self._enforce_memory_cap(keep=tenant_id)
+        return kb
+
+    def _assign(self, runtime, key):
+        """Asocia la base al cliente y libera la anterior si nadie más la usa (con el cerrojo tomado)."""
+        previous, runtime.kb_key = runtime.kb_key, key
+        if previous is not None and previous != key:
+            self._release_kb(previous)
+
+    def _release_kb(self, key):
+        if not any(r.kb_key == key for r in self._runtimes.values()):
+            self._kbs.pop(key, None)
+            self._kb_sizes.pop(key, None)
+            watched = self._watchers.get(key[0])
+            if watched is not None and watched[1] == key:
+                # Sin nadie que la use, no merece la pena mantenerla al día
+                del self._watchers[key[0]]
+                watched[0].stop()
+
+    def _swap_kb(self, old, new):
+        """Publica la nueva versión de una carpeta vigilada (la llama el hilo del vigilante)."""
+        size = new.approx_bytes()
+        with self._lock:
+            watched = self._watchers.get(old.folder)
+            if watched is None or watched[0].kb is not new:
+                return
+            old_key, new_key = watched[1], (new.folder, new.version)
+            self._watchers[old.folder] = (watched[0], new_key)
+            self._kbs[new_key] = new
+            self._kb_sizes[new_key] = size
+            for runtime in self._runtimes.values():
+                if runtime.kb_key == old_key:
+                    runtime.kb_key = new_key
+            self._kbs.pop(old_key, None)
+            self._kb_sizes.pop(old_key, None)
+            self.stats["kb_reloads"] += 1
+            self._enforce_memory_cap(keep=None)
+
+    def watchers(self):
+        """Estado de la vigilancia de cada carpeta cargada (para el panel de administración)."""
+        with self._lock:
+            watched = [(folder, watcher) for folder, (watcher, _) in self._watchers.items()]
+        return [
+            dict(watcher.stats, folder=folder, mode=watcher.mode, version=watcher.kb.version)
+            for folder, watcher in watched
+        ]
+
+    # --- Memoria ---
+
+    def memory_bytes(self):
+        """Memoria estimada de las bases de conocimiento y tablas de usuarios cargadas."""
+        with self._lock:
+            return self._memory_bytes()
+
+    def _memory_bytes(self):
+        users = sum(r.auth.loaded_users() for r in self._runtimes.values())
+        return sum(self._kb_sizes.values()) + users * USER_ROW_BYTES
+
+    def _enforce_memory_cap(self, keep):
+        """Descarga el estado pesado de los clientes menos recientes hasta volver bajo el límite."""
+        cap = TENANT_CONFIG.get("memory_cap_mb", 512) * 1024 * 1024
+        for tenant_id, runtime in list(self._runtimes.items()):
+            if self._memory_bytes() <= cap:
+                return
+            if tenant_id == keep or (runtime.kb_key is None and not runtime.auth.loaded_users()):
+                continue
+            key, runtime.kb_key = runtime.kb_key, None
+            if key is not None:
+                self._release_kb(key)
+            # La tabla de usuarios se relee del almacenamiento en el siguiente uso (el diario se conserva)
+            runtime.auth.invalidate_users()
+            self.stats["evictions"] += 1
+
+
+tenant_registry = TenantRegistry()